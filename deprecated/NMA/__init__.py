@@ -24,4 +24,4 @@
 # *
 # **************************************************************************
 
-from .anm import ANM
\ No newline at end of file
+from .anm import ANM, calcANMModes
\ No newline at end of file
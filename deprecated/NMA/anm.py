@@ -25,13 +25,71 @@
 # **************************************************************************
 
 
+import os
+import hashlib
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
 from prody.dynamics.anm import ANMBase
 from prody.utilities.logger import LOGGER
-from .eigtools import solveEig
+from .eigtools import solveEig, solveEigSparse
 
 
 class ANMBaseFlex(ANMBase):
 
+    def buildSparseHessian(self, coords, cutoff=15., gamma=1.):
+        """Build the Hessian matrix as a sparse matrix. Only the pairs of nodes closer than the cutoff
+        are visited (neighbour list from a KD-tree), so memory and time are linear in the number of contacts.
+
+        :arg coords: a coordinate set or an object with ``getCoords`` method
+        :type coords: :class:`numpy.ndarray`
+
+        :arg cutoff: cutoff distance (Å) for pairwise interactions
+        :type cutoff: float, default is 15.0
+
+        :arg gamma: spring constant
+        :type gamma: float, default is 1.0
+        """
+
+        if hasattr(coords, 'getCoords'):
+            coords = coords.getCoords()
+        coords = np.asarray(coords, dtype=np.float64)
+        n_atoms = coords.shape[0]
+        dof = 3 * n_atoms
+
+        LOGGER.timeit('_anm_sparse_hessian')
+        pairs = cKDTree(coords).query_pairs(cutoff, output_type='ndarray')
+        i, j = pairs[:, 0], pairs[:, 1]
+        d = coords[j] - coords[i]
+        dist2 = np.sum(d * d, axis=1)
+
+        # Off diagonal super elements (-gamma * d d^T / |d|^2)
+        blocks = -gamma * d[:, :, None] * d[:, None, :] / dist2[:, None, None]
+
+        # Diagonal super elements (minus the sum of the off diagonal ones of every row)
+        diag_blocks = np.zeros((n_atoms, 3, 3))
+        np.add.at(diag_blocks, i, -blocks)
+        np.add.at(diag_blocks, j, -blocks)
+
+        # COO entries of all the 3x3 blocks
+        a, b = np.meshgrid(np.arange(3), np.arange(3), indexing='ij')
+        a, b = a.ravel(), b.ravel()
+        rows = np.concatenate([(3 * i[:, None] + a).ravel(), (3 * j[:, None] + a).ravel(),
+                               (3 * np.arange(n_atoms)[:, None] + a).ravel()])
+        cols = np.concatenate([(3 * j[:, None] + b).ravel(), (3 * i[:, None] + b).ravel(),
+                               (3 * np.arange(n_atoms)[:, None] + b).ravel()])
+        values = np.concatenate([blocks.reshape(-1), blocks.reshape(-1), diag_blocks.reshape(-1)])
+        hessian = sparse.coo_matrix((values, (rows, cols)), shape=(dof, dof)).tocsr()
+
+        self._reset()
+        self._cutoff = cutoff
+        self._gamma = gamma
+        self._n_atoms = n_atoms
+        self._dof = dof
+        self._hessian = hessian
+        LOGGER.report('Sparse Hessian was built in %.2fs.', label='_anm_sparse_hessian')
+
     def calcModes(self, n_modes=20, zeros=False, turbo=True, mode="cupy"):
         """Calculate normal modes.  This method uses :func:`scipy.linalg.eigh`
         function to diagonalize the Hessian matrix. When Scipy is not found,
@@ -46,6 +104,10 @@ class ANMBaseFlex(ANMBase):
 
         :arg turbo: Use a memory intensive, but faster way to calculate modes.
         :type turbo: bool, default is **True**
+
+        :arg mode: Dense eigensolver backend. Sparse Hessians (see :meth:`buildSparseHessian`) are solved
+            with ``'lanczos'`` (default) or ``'lobpcg'``, which only compute the requested modes.
+        :type mode: str, default is ``'cupy'``
         """
 
         if self._hessian is None:
@@ -58,8 +120,15 @@ class ANMBaseFlex(ANMBase):
         assert isinstance(turbo, bool), 'turbo must be a boolean'
         self._clear()
         LOGGER.timeit('_anm_calc_modes')
-        values, vectors, vars = solveEig(self._hessian, n_modes=n_modes, zeros=zeros,
-                                         turbo=turbo, expct_n_zeros=6, mode=mode)
+        if sparse.issparse(self._hessian):
+            if n_modes is None:
+                raise ValueError('n_modes must be given for sparse Hessian matrices')
+            solver = mode if mode in ['lanczos', 'lobpcg'] else 'lanczos'
+            values, vectors, vars = solveEigSparse(self._hessian, n_modes=n_modes, zeros=zeros,
+                                                   expct_n_zeros=6, solver=solver)
+        else:
+            values, vectors, vars = solveEig(self._hessian, n_modes=n_modes, zeros=zeros,
+                                             turbo=turbo, expct_n_zeros=6, mode=mode)
         self._eigvals = values
         self._array = vectors
         self._vars = vars
@@ -78,3 +147,42 @@ class ANM(ANMBaseFlex):
 
     def __init__(self, name='Unknown'):
         super(ANM, self).__init__(name)
+
+
+def calcANMModes(coords, n_modes=20, cutoff=15., gamma=1., solver='lanczos', cache_dir=None):
+    """Lowest normal modes of a structure from a sparse ANM Hessian (CPU, no dense matrix). Modes are cached
+    per structure, cutoff, spring constant and number of modes.
+
+    :arg coords: a coordinate set or an object with ``getCoords`` method
+    :arg n_modes: number of non-zero modes to calculate
+    :arg cutoff: cutoff distance (Å) for pairwise interactions
+    :arg gamma: spring constant
+    :arg solver: ``'lanczos'`` or ``'lobpcg'``
+    :arg cache_dir: cache folder, defaults to $TENSORFLOW_TOOLKIT_ANM_CACHE or ~/.cache/tensorflow_toolkit/anm
+
+    :returns: eigenvalues with shape (n_modes,) and eigenvectors with shape (3 * n_atoms, n_modes)
+    """
+    if hasattr(coords, 'getCoords'):
+        coords = coords.getCoords()
+    coords = np.asarray(coords, dtype=np.float64)
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('TENSORFLOW_TOOLKIT_ANM_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'tensorflow_toolkit', 'anm'))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    key = hashlib.sha1(np.round(coords, 3).tobytes())
+    key.update(('%f_%f_%d' % (cutoff, gamma, n_modes)).encode())
+    cache_file = os.path.join(cache_dir, 'anm_modes_%s.npz' % key.hexdigest()[:16])
+
+    if os.path.isfile(cache_file):
+        data = np.load(cache_file)
+        return data['eigvals'], data['eigvecs']
+
+    anm = ANM()
+    anm.buildSparseHessian(coords, cutoff=cutoff, gamma=gamma)
+    anm.calcModes(n_modes=n_modes, mode=solver)
+    eigvals, eigvecs = anm.getEigvals(), anm.getEigvecs()
+    np.savez(cache_file, eigvals=eigvals, eigvecs=eigvecs, cutoff=cutoff, gamma=gamma)
+
+    return eigvals, eigvecs
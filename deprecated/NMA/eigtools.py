@@ -32,7 +32,7 @@ from prody.utilities.misctools import div0
 from prody.utilities.logger import LOGGER
 from .misctools import importLA
 
-__all__ = ['solveEig', 'ZERO']
+__all__ = ['solveEig', 'solveEigSparse', 'ZERO']
 
 ZERO = 1e-6
 
@@ -170,3 +170,55 @@ def solveEig(M, n_modes=None, zeros=False, turbo=True, expct_n_zeros=None, rever
         eigvecs = eigvecs[:, ::-1]
 
     return eigvals, eigvecs, invvals
+
+
+def solveEigSparse(M, n_modes=20, zeros=False, expct_n_zeros=6, solver="lanczos", tol=1e-8, maxiter=None):
+    """Lowest eigenvalues/vectors of a sparse symmetric positive semi-definite matrix (e.g. an ANM Hessian)
+    computed with an iterative solver, so the dense matrix is never built.
+
+    :arg M: sparse matrix with shape (dof, dof)
+    :arg n_modes: number of non-zero eigenvalues/vectors to calculate
+    :arg zeros: if **True**, modes with zero eigenvalues are kept
+    :arg expct_n_zeros: expected number of zero eigenvalues (rigid body motions)
+    :arg solver: ``'lanczos'`` (shift-invert Lanczos with a sparse LU factorization) or ``'lobpcg'``
+        (preconditioned block solver, lower memory for very large systems)
+    """
+    from scipy import sparse
+    from scipy.sparse import linalg as scipy_sparse_la
+
+    M = sparse.csr_matrix(M, dtype=np.float64)
+    dof = M.shape[0]
+    k = min(n_modes + expct_n_zeros, dof - 1)
+
+    if solver == "lanczos":
+        # Shift slightly below zero, so the factorized matrix is not singular and the eigenvalues closest to the
+        # shift are the lowest ones
+        sigma = -1e-3 * M.diagonal().mean()
+        values, vectors = scipy_sparse_la.eigsh(M, k=k, sigma=sigma, which='LM', tol=tol, maxiter=maxiter)
+    elif solver == "lobpcg":
+        # Jacobi preconditioner and random initial block
+        diagonal = M.diagonal()
+        precond = sparse.diags(np.where(diagonal > ZERO, 1. / np.maximum(diagonal, ZERO), 1.))
+        x = np.random.RandomState(0).standard_normal((dof, k))
+        values, vectors = scipy_sparse_la.lobpcg(M, x, M=precond, largest=False, tol=tol,
+                                                 maxiter=maxiter if maxiter is not None else 1000)
+    else:
+        raise ValueError('solver must be one of: lanczos, lobpcg')
+
+    order = np.argsort(values)
+    values, vectors = values[order], vectors[:, order]
+    n_zeros = sum(values < ZERO)
+    if n_zeros != expct_n_zeros:
+        LOGGER.warning('%d zero eigenvalues were calculated (%d expected).' % (n_zeros, expct_n_zeros))
+
+    if not zeros:
+        eigvals = values[n_zeros:n_zeros + n_modes]
+        eigvecs = vectors[:, n_zeros:n_zeros + n_modes]
+        invvals = 1 / eigvals
+    else:
+        eigvals = values[:n_modes]
+        eigvecs = vectors[:, :n_modes]
+        invvals = div0(1, eigvals)
+        invvals[:n_zeros] = 0.
+
+    return eigvals, eigvecs, invvals
@@ -35,6 +35,7 @@ import tensorflow as tf
 
 from tensorflow_toolkit.generators.generator_template import DataGeneratorBase
 from tensorflow_toolkit.utils import euler_matrix_batch
+from deprecated.NMA import calcANMModes
 
 
 class Generator(DataGeneratorBase):
@@ -75,16 +76,17 @@ class Generator(DataGeneratorBase):
         filename = kwargs.pop('filename', None)
 
         if os.path.isfile(filename):
-            # Code to read ANM files generated by ProDy
-            anm = pd.loadModel(str(filename))
+            basis_file = np.load(str(filename))
+            if "eigvecs" in basis_file:
+                # Modes computed with the sparse ANM engine
+                basis = basis_file["eigvecs"]
+            else:
+                # Code to read ANM files generated by ProDy
+                basis = pd.loadModel(str(filename)).getEigvecs()
         else:
-            anm = pd.ANM(coords)
-            anm.buildHessian(coords, **kwargs)
-            kwargs.pop('cutoff', None)
-            anm.calcModes(n_modes=n_modes, **kwargs)
-            pd.saveModel(anm, str(filename))
-
-        basis = anm.getEigvecs()
+            # Sparse Hessian and iterative eigensolver (lowest modes only, cached per structure and cutoff)
+            eigvals, basis = calcANMModes(coords, n_modes=n_modes, **kwargs)
+            np.savez(str(filename), eigvals=eigvals, eigvecs=basis)
 
         return basis
 
@@ -304,7 +304,8 @@ class Generator(DataGeneratorBase):
         c_y = tf.reshape(tf.transpose(c[1]), [batch_size_scope, -1, 1])
         c_sampling = tf.concat([c_y, c_x], axis=2)
 
-        imgs = tf.zeros((batch_size_scope, self.xsize, self.xsize), dtype=self.precision)
+        # Images are accumulated in float32 (also for reduced precision networks)
+        imgs = tf.zeros((batch_size_scope, self.xsize, self.xsize), dtype=tf.float32)
 
         bamp = tf.constant(self.values, dtype=self.precision)[None, ...] + c[2]
 
@@ -330,7 +331,7 @@ class Generator(DataGeneratorBase):
 
         # fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
         # images = tf.map_fn(fn, [imgs, bposall, bampall], fn_output_signature=tf.float32)
-        images = self.batch_scatter_nd_add(imgs, bposall, bampall)
+        images = tf.cast(self.batch_scatter_nd_add(imgs, bposall, tf.cast(bampall, tf.float32)), self.precision)
         # images = tf.vectorized_map(fn, [imgs, bposall, bampall])
 
         images = tf.reshape(images, [-1, self.xsize, self.xsize, 1])
@@ -172,6 +172,7 @@ class Generator(DataGeneratorBase):
             self.full_voxels = self.coords.shape[0]
             self.cube = self.xsize * self.xsize * self.xsize
             self.mask = tf.squeeze(tf.constant(np.argwhere(combined_masks), dtype=tf.int32))
+            self.focused_mapping = tf.constant(self.getFocusedMapping(combined_masks), dtype=tf.int32)
         else:
             self.full_indices = np.copy(self.indices)
             self.full_voxels = self.coords.shape[0]
@@ -206,12 +207,6 @@ class Generator(DataGeneratorBase):
         self.coords = self.coords[::self.step] / self.scale_factor
         self.total_voxels = self.indices.shape[0]
 
-        # Initialize pose information
-        self.rot_batch = np.zeros(self.batch_size)
-        self.tilt_batch = np.zeros(self.batch_size)
-        self.psi_batch = np.zeros(self.batch_size)
-        self.shifts_batch = [np.zeros(self.batch_size), np.zeros(self.batch_size)]
-
         # B-Spline kernel (order 1)
         # b_spline_1d = np.asarray([0.0, 0.5, 1.0, 0.5, 1.0])
         b_spline_1d = np.asarray([0.0, 0.25, 0.5, 1.0, 0.5, 0.25, 1.0])
@@ -223,6 +218,34 @@ class Generator(DataGeneratorBase):
 
     # ----- Utils -----#
 
+    def getFocusedMapping(self, combined_masks):
+        # Mapping from the full (compact) coordinate list to the focus mask voxels. Voxels outside the focus
+        # mask point to an extra (zero) entry. The mapping is fixed for a given mask, so it is stored next to it
+        mapping_path = Path(self.filename.parent, 'mask_focused_mapping.npz')
+        if os.path.isfile(mapping_path):
+            with np.load(mapping_path) as data:
+                if np.array_equal(data["flat_indices"], self.flat_indices) and \
+                        np.array_equal(data["combined_masks"], np.flatnonzero(combined_masks)):
+                    return data["mapping"]
+
+        # Position of each focus mask voxel in the full coordinate list (both lists follow the same voxel order)
+        full_flat_indices = np.flatnonzero(combined_masks)
+        mapping = np.full(full_flat_indices.shape[0], self.flat_indices.shape[0], dtype=np.int32)
+        mapping[np.searchsorted(full_flat_indices, self.flat_indices)] = np.arange(self.flat_indices.shape[0])
+
+        try:
+            np.savez(mapping_path, mapping=mapping, flat_indices=self.flat_indices,
+                     combined_masks=full_flat_indices)
+        except OSError:
+            pass
+
+        return mapping
+
+    def focusedUpdates(self, delta_het):
+        # Place the focus mask updates in the full coordinate list (direct gather, no full cube)
+        delta_het = tf.pad(delta_het, [[0, 0], [0, 1]])
+        return tf.gather(delta_het, self.focused_mapping, axis=1)
+
     def getCoordsGroups(self):
         indices = np.arange(np.sum(self.mask_map), dtype=int)
         indices = [indices[idx::self.step] for idx in range(self.step)]
@@ -239,11 +262,11 @@ class Generator(DataGeneratorBase):
             coords_idx = self.group_coords[idx]
             self.coords = self.all_coords[coords_idx, ...]
 
-    def applyAlignment(self, c_x, c_y, c_z, delta_angles, axis):
+    def applyAlignment(self, c_x, c_y, c_z, delta_angles, euler, axis):
         # Get rotation matrix
-        r = euler_matrix_batch(self.rot_batch + delta_angles[:, 0],
-                               self.tilt_batch + delta_angles[:, 1],
-                               self.psi_batch + delta_angles[:, 2])
+        r = euler_matrix_batch(euler[:, 0] + delta_angles[:, 0],
+                               euler[:, 1] + delta_angles[:, 1],
+                               euler[:, 2] + delta_angles[:, 2])
 
         # Apply alignment
         c_r_1 = tf.multiply(c_x[None, :], tf.cast(tf.gather(r[axis], 0, axis=1), dtype=self.precision)[:, None])
@@ -251,20 +274,23 @@ class Generator(DataGeneratorBase):
         c_r_3 = tf.multiply(c_z[None, :], tf.cast(tf.gather(r[axis], 2, axis=1), dtype=self.precision)[:, None])
         return tf.add(tf.add(c_r_1, c_r_2), c_r_3)
 
-    def applyShifts(self, coord, delta_shifts, axis):
-        shifts_batch = self.shifts_batch[axis] + delta_shifts[:, axis]
+    def applyShifts(self, coord, delta_shifts, shifts, axis):
+        shifts_batch = shifts[:, axis] + delta_shifts[:, axis]
         return tf.add(tf.subtract(coord, shifts_batch[:, None]), self.xmipp_origin[axis])
 
-    def getRotatedGrid(self, angles):
+    def getRotatedGrid(self, x):
+        # Refinement of the angles and Euler angles of the batch (BatchContext)
+        angles, euler = x
+
         # Get coords to move
         c_x = tf.constant(self.coords[:, 0], dtype=self.precision)
         c_y = tf.constant(self.coords[:, 1], dtype=self.precision)
         c_z = tf.constant(self.coords[:, 2], dtype=self.precision)
 
         # Apply alignment
-        c_x_r = self.applyAlignment(c_x, c_y, c_z, angles, 0)
-        c_y_r = self.applyAlignment(c_x, c_y, c_z, angles, 1)
-        c_z_r = self.applyAlignment(c_x, c_y, c_z, angles, 2)
+        c_x_r = self.applyAlignment(c_x, c_y, c_z, angles, euler, 0)
+        c_y_r = self.applyAlignment(c_x, c_y, c_z, angles, euler, 1)
+        c_z_r = self.applyAlignment(c_x, c_y, c_z, angles, euler, 2)
 
         return c_x_r, c_y_r, c_z_r
 
@@ -274,12 +300,13 @@ class Generator(DataGeneratorBase):
         return coords_het
 
     def scatterImgByPass(self, c):
+        # Returns the projections and their support mask (c[3] are the shifts of the batch)
         # Get current batch size (function scope)
         batch_size_scope = tf.shape(c[0][0])[0]
 
         # Apply shifts
-        c_x_2d = self.applyShifts(self.scale_factor * c[0][0], c[1], 0)
-        c_y_2d = self.applyShifts(self.scale_factor * c[0][1], c[1], 1)
+        c_x_2d = self.applyShifts(self.scale_factor * c[0][0], c[1], c[3], 0)
+        c_y_2d = self.applyShifts(self.scale_factor * c[0][1], c[1], c[3], 1)
 
         c_x_2d = c_x_2d[:, :, None]
         c_y_2d = c_y_2d[:, :, None]
@@ -289,10 +316,7 @@ class Generator(DataGeneratorBase):
 
         # Update values within mask
         if self.isFocused:
-            flat_indices = tf.constant(self.flat_indices, dtype=tf.int32)[:, None]
-            fn = lambda inp: tf.scatter_nd(flat_indices, inp, [self.cube])
-            updates = tf.map_fn(fn, c[2], fn_output_signature=self.precision)
-            updates = tf.gather(updates, self.mask, axis=1)
+            updates = self.focusedUpdates(c[2])
         else:
             updates = c[2]
         bamp = tf.tile(self.values[None, :], [batch_size_scope, 1]) + updates
@@ -310,12 +334,12 @@ class Generator(DataGeneratorBase):
         imgs = tf.reshape(imgs, [-1, self.xsize, self.xsize, 1])
 
         # Create projection mask (to improve cost accuracy)
-        self.mask_imgs = tf.zeros((batch_size_scope, self.xsize, self.xsize), dtype=tf.float32)
+        mask_imgs = tf.zeros((batch_size_scope, self.xsize, self.xsize), dtype=tf.float32)
         mask_values = tf.ones([batch_size_scope, self.coords.shape[0]], dtype=tf.float32)
-        self.mask_imgs = tf.map_fn(fn, [self.mask_imgs, bposi, mask_values], fn_output_signature=self.precision)
-        self.mask_imgs = tf.reshape(self.mask_imgs, [-1, self.xsize, self.xsize, 1])
-        self.mask_imgs = tfa.image.gaussian_filter2d(self.mask_imgs, 3, 1)
-        self.mask_imgs = tf.math.divide_no_nan(self.mask_imgs, self.mask_imgs)
+        mask_imgs = tf.map_fn(fn, [mask_imgs, bposi, mask_values], fn_output_signature=self.precision)
+        mask_imgs = tf.reshape(mask_imgs, [-1, self.xsize, self.xsize, 1])
+        mask_imgs = tfa.image.gaussian_filter2d(mask_imgs, 3, 1)
+        mask_imgs = tf.math.divide_no_nan(mask_imgs, mask_imgs)
 
         # TODO: Do we need to comply with line integral?
         # self.mask_imgs = tf.zeros((batch_size_scope, self.xsize, self.xsize), dtype=tf.float32)
@@ -328,7 +352,7 @@ class Generator(DataGeneratorBase):
         # # self.mask_imgs = tf.math.divide_no_nan(self.mask_imgs, self.mask_imgs)
         # imgs = tf.math.divide_no_nan(imgs, self.mask_imgs)
 
-        return imgs
+        return imgs, mask_imgs
 
     def gaussianFilterImage(self, images):
         # This method is redifined as we will fix the step values to 1 or 2 (experimental)
@@ -374,7 +398,7 @@ class Generator(DataGeneratorBase):
 
         return gauss_kernel
 
-    def project_3d_to_2d(self, kernel_3d, delta_angles):
+    def project_3d_to_2d(self, kernel_3d, delta_angles, euler):
         """Projects a 3D Gaussian kernel to 2D using a rotation matrix."""
         batch_size = tf.shape(delta_angles)[0]
         size = tf.shape(kernel_3d)[1]
@@ -384,9 +408,9 @@ class Generator(DataGeneratorBase):
         xyz = tf.reshape(xyz, [-1, size * size * size, 3])  # Shape (B, size*size*size, 3)
 
         # Define rotation matrix
-        rotation_matrix = euler_matrix_batch(self.rot_batch + delta_angles[:, 0],
-                                             self.tilt_batch + delta_angles[:, 1],
-                                             self.psi_batch + delta_angles[:, 2])
+        rotation_matrix = euler_matrix_batch(euler[:, 0] + delta_angles[:, 0],
+                                             euler[:, 1] + delta_angles[:, 1],
+                                             euler[:, 2] + delta_angles[:, 2])
         rotation_matrix = tf.stack(rotation_matrix, axis=2)
         i_rotation_matrix = tf.transpose(rotation_matrix, (0, 2, 1))
 
@@ -415,7 +439,7 @@ class Generator(DataGeneratorBase):
 
     def multivariate_gaussian_3d_filter(self, inputs):
         """Applies a 3D Gaussian filter projected to 2D to a batch of images."""
-        images, kernel_size, mean, cov, delta_angles = inputs
+        images, kernel_size, mean, cov, delta_angles, euler = inputs
 
         # Recover covariance matrix by Cholesky decomposition
         L = tf.stack([cov[:, 0], tf.zeros_like(cov[:, 0]), tf.zeros_like(cov[:, 0]),
@@ -425,7 +449,7 @@ class Generator(DataGeneratorBase):
         cov = tf.matmul(L, tf.transpose(L, (0, 2, 1)))
 
         kernel_3d = self.create_3d_gaussian_kernel(kernel_size, mean, cov)
-        kernel_2d = self.project_3d_to_2d(kernel_3d, delta_angles)
+        kernel_2d = self.project_3d_to_2d(kernel_3d, delta_angles, euler)
         kernel_2d = tf.transpose(kernel_2d, [1, 2, 0])[..., None]
         images = tf.transpose(images[..., 0], [1, 2, 0])[None, ...]
 
@@ -450,8 +474,9 @@ class Generator(DataGeneratorBase):
                   * 1e-6 - tf.cast(images == 1e-6, dtype=self.precision) * images)
         return images
 
-    def ctfFilterImage(self, images):
+    def ctfFilterImage(self, images, ctf):
         images = tf.cast(images, tf.float32)
+        ctf = tf.cast(ctf, tf.float32)
 
         # Get current batch size (function scope)
         batch_size_scope = tf.shape(images)[0]
@@ -462,14 +487,14 @@ class Generator(DataGeneratorBase):
 
         # ft_images = tf.signal.fftshift(tf.signal.rfft2d(images[:, :, :, 0]))
         ft_images = fft_pad(images, pad_size, pad_size)
-        ft_ctf_images_real = tf.multiply(tf.math.real(ft_images), self.ctf)
-        ft_ctf_images_imag = tf.multiply(tf.math.imag(ft_images), self.ctf)
+        ft_ctf_images_real = tf.multiply(tf.math.real(ft_images), ctf)
+        ft_ctf_images_imag = tf.multiply(tf.math.imag(ft_images), ctf)
         ft_ctf_images = tf.complex(ft_ctf_images_real, ft_ctf_images_imag)
         # ctf_images = tf.signal.irfft2d(tf.signal.ifftshift(ft_ctf_images))
         ctf_images = tf.cast(ifft_pad(ft_ctf_images, size, size), self.precision)
         return tf.reshape(ctf_images, [batch_size_scope, self.xsize, self.xsize, 1])
 
-    def wiener2DFilter(self, images):
+    def wiener2DFilter(self, images, ctf):
         images = tf.cast(images, tf.float32)
 
         # Get current batch size (function scope)
@@ -479,13 +504,13 @@ class Generator(DataGeneratorBase):
         pad_size = tf.constant(int(self.pad_factor * self.xsize), dtype=tf.int32)
         size = tf.constant(int(self.xsize), dtype=tf.int32)
 
-        ctf_2 = self.ctf * self.ctf
+        ctf_2 = ctf * ctf
         # epsilon = 1e-5
         epsilon = 0.1 * tf.reduce_mean(ctf_2)
 
         ft_images = fft_pad(images, pad_size, pad_size)
-        ft_w_images_real = tf.math.real(ft_images) * self.ctf / (ctf_2 + epsilon)
-        ft_w_images_imag = tf.math.imag(ft_images) * self.ctf / (ctf_2 + epsilon)
+        ft_w_images_real = tf.math.real(ft_images) * ctf / (ctf_2 + epsilon)
+        ft_w_images_imag = tf.math.imag(ft_images) * ctf / (ctf_2 + epsilon)
         ft_w_images = tf.complex(ft_w_images_real, ft_w_images_imag)
         w_images = tf.cast(ifft_pad(ft_w_images, size, size), self.precision)
         return tf.reshape(w_images, [batch_size_scope, self.xsize, self.xsize, 1])
@@ -93,11 +93,7 @@ class Generator(DataGeneratorBase):
         self.indices = self.indices[::self.step]
         self.total_voxels = self.coords.shape[0]
 
-        # Initialize pose information
-        self.rot_batch = np.zeros(self.batch_size, dtype=np.float32)
-        self.tilt_batch = np.zeros(self.batch_size, dtype=np.float32)
-        self.psi_batch = np.zeros(self.batch_size, dtype=np.float32)
-        self.shifts_batch = [np.zeros(self.batch_size), np.zeros(self.batch_size)]
+        # Refinement of the input poses?
         if np.all(self.angle_rot == 0.0) and np.all(self.angle_tilt == 0.0) and np.all(self.angle_psi == 0.0):
             self.refinement = False
         else:
@@ -37,15 +37,26 @@ import tensorflow as tf
 from tensorflow.keras import backend as K
 import tensorflow_addons as tfa
 
-from tensorflow_toolkit.utils import getXmippOrigin, fft_pad, ifft_pad, full_fft_pad, full_ifft_pad
+from tensorflow_toolkit.utils import getXmippOrigin, fft_pad, ifft_pad, full_fft_pad, full_ifft_pad, \
+    fourier_shell_indices, fourier_shell_correlation, computeCTF, open_particle_cache, \
+    pipeline_options, BatchContext
 
 
 class DataGeneratorBase:
     def __init__(self, md_file, batch_size=32, shuffle=True, step=1, splitTrain=None,
                  radius_mask=2, smooth_mask=True, cost="corr", keepMap=False, pad_factor=2,
-                 sr=1., applyCTF=1, xsize=128, mode=None):
+                 sr=1., applyCTF=1, xsize=128, mode=None, wiener_pipeline=False, wiener_cache=None,
+                 fourier_loss=False):
         # Attributes
         self.step = step
+        # Opt-in image loss on the padded Fourier transforms. It is a different objective than the default real
+        # space loss: the whole padded field is compared, so the decoded images are not cropped back to the
+        # box and their CTF ringing outside it is also penalized
+        self.fourier_loss = fourier_loss
+        self.wiener_pipeline = wiener_pipeline or wiener_cache is not None
+        self.wiener_cache = wiener_cache
+        self.particle_cache = None
+        self.val_file_idx = None
         self.shuffle = shuffle
         self.batch_size = batch_size
         self.indexes = np.arange(self.batch_size)
@@ -79,12 +90,6 @@ class DataGeneratorBase:
         if splitTrain is not None:
             self.getTrainDataset(splitTrain)
 
-        # Prepare CTF
-        self.ctf = np.zeros([self.batch_size, self.pad_factor * self.xsize,
-                             int(0.5 * self.pad_factor * self.xsize + 1)])
-        # self.ctf = np.zeros([self.batch_size, self.xsize,
-        #                      int(0.5 * self.xsize + 1)])
-
         # Prepare alignment
         self.r = [np.zeros([self.batch_size, 3]), np.zeros([self.batch_size, 3]), np.zeros([self.batch_size, 3])]
 
@@ -99,12 +104,19 @@ class DataGeneratorBase:
         circular_mask = tf.signal.fftshift(circular_mask[:, :, :size])
         self.circular_mask = circular_mask[0, :, :]
 
+        # Same mask on the padded Fourier grid (unshifted layout) for the Fourier space losses
+        pad_size = int(self.pad_factor * self.xsize)
+        circular_mask_pad = self.create_circular_mask(pad_size, pad_size, radius_mask=self.pad_factor * radius_mask,
+                                                      smooth_mask=smooth_mask)
+        circular_mask_pad = np.fft.ifftshift(circular_mask_pad)[:, :pad_size // 2 + 1]
+        self.circular_mask_pad = tf.constant(circular_mask_pad, dtype=tf.float32)
+
         # Cap deformation vals
         # self.inv_sqrt_N = tf.constant(1. / np.sqrt(self.coords.shape[0]), dtype=tf.float32)
         # self.inv_bs = tf.constant(1. / self.batch_size, dtype=tf.float32)
 
         # Fourier rings
-        # self.getFourierRings()
+        self.getFourierRings()
         # self.radial_masks, self.spatial_freq = self.get_radial_masks()
 
         # Cost function
@@ -116,6 +128,15 @@ class DataGeneratorBase:
             self.cost_function = self.mae
         elif cost == "mse":
             self.cost_function = self.mse
+        elif cost == "frc":
+            self.cost_function = self.frc_cost
+
+        # Cost function evaluated on the Fourier transforms of the images (no Fourier space formula for mae)
+        fourier_costs = {"corr": self.loss_correlation_ft, "fpc": self.fourier_phase_correlation_ft,
+                         "mse": self.mse_ft, "frc": self.frc_cost_ft}
+        self.fourier_cost_function = fourier_costs.get(cost)
+        if self.fourier_loss and self.fourier_cost_function is None:
+            raise ValueError("Cost %s cannot be evaluated in Fourier space (use corr, fpc, mse or frc)" % cost)
 
         # Generator mode
         if mode is None:
@@ -225,6 +246,8 @@ class DataGeneratorBase:
     def getTrainDataset(self, splitTrain):
         indexes = np.arange(self.file_idx.size)
         if splitTrain > 0:
+            # Remaining particles kept for validation (same generator)
+            self.val_file_idx = self.file_idx[indexes[int(splitTrain * indexes.size):]]
             self.file_idx = self.file_idx[indexes[:int(splitTrain * indexes.size)]]
         elif splitTrain < 0:
             self.file_idx = self.file_idx[indexes[int(splitTrain * indexes.size):]]
@@ -296,13 +319,23 @@ class DataGeneratorBase:
 
         return image  # Ensure pixel values are valid
 
-    def return_tf_dataset(self, preShuffle=False):
+    def return_tf_dataset(self, preShuffle=False, input_context=None, validation=False):
         with tf.device("/CPU:0"):
             metadata = XmippMetaData(file_name=str(self.filename))
-            file_idx = self.file_idx
+            file_idx = self.val_file_idx if validation else self.file_idx
+            if input_context is not None and input_context.num_input_pipelines > 1:
+                # Particles of this worker (shards of the same size, so all the workers run the same steps)
+                shard_size = len(file_idx) // input_context.num_input_pipelines
+                file_idx = file_idx[input_context.input_pipeline_id::input_context.num_input_pipelines][:shard_size]
             if preShuffle:
                 np.random.shuffle(file_idx)
-            images = metadata.getMetaDataImage(file_idx)[..., None]
+            if self.wiener_cache is not None:
+                # Wiener filtered particles are read per batch from the on disk cache (see readCachedBatch),
+                # so only their indexes are sliced here
+                self.particleCache()
+                images = file_idx
+            else:
+                images = metadata.getMetaDataImage(file_idx)[..., None]
             if self.mode == "tomo":
                 subtomo_labels = self.sinusoid_table[metadata[file_idx, "subtomo_labels"].astype(int) - 1]
                 dataset = tf.data.Dataset.from_tensor_slices(((images, subtomo_labels), (file_idx, file_idx)))
@@ -311,7 +344,91 @@ class DataGeneratorBase:
             if self.shuffle:
                 dataset = dataset.shuffle(len(file_idx))
             # dataset = dataset.map(lambda image, label: (self.data_augmentation(image), label))
-            return dataset.batch(self.batch_size).prefetch(2)
+            dataset = dataset.batch(self.batch_size)
+            if self.wiener_cache is not None:
+                dataset = dataset.map(self.readCachedBatch, num_parallel_calls=tf.data.AUTOTUNE)
+
+            # Shards are built by hand, so tf.distribute must not shard them again
+            if input_context is not None:
+                options = tf.data.Options()
+                options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+                dataset = dataset.with_options(options)
+
+            # Input pipeline workers in the threads of the CPU execution profile (if any)
+            options = pipeline_options()
+            if options is not None:
+                dataset = dataset.with_options(options)
+
+            # Per batch preprocessing in parallel workers (overlapped with the training steps)
+            if self.wiener_pipeline and self.wiener_cache is None:
+                dataset = dataset.map(self.preprocessBatch, num_parallel_calls=tf.data.AUTOTUNE,
+                                      deterministic=False)
+                return dataset.prefetch(tf.data.AUTOTUNE)
+            else:
+                return dataset.prefetch(2)
+
+    def return_distributed_dataset(self, strategy, preShuffle=False, validation=False):
+        """
+        Dataset for a distribution strategy. With several workers, every worker only reads its shard of the
+        particles and batch_size is the batch of every replica (the global batch grows with the workers).
+        """
+        if not isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy):
+            return self.return_tf_dataset(preShuffle=preShuffle, validation=validation)
+        return strategy.distribute_datasets_from_function(
+            lambda input_context: self.return_tf_dataset(preShuffle=preShuffle, input_context=input_context,
+                                                         validation=validation))
+
+    def preprocessBatch(self, inputs, labels):
+        # CTF correction (Wiener filter) of the particles, so the networks receive corrected images
+        if self.mode == "tomo":
+            images, indexes = inputs[0], labels[0]
+        else:
+            images, indexes = inputs, labels
+
+        images = self.wiener2DFilter(tf.cast(images, tf.float32), self.batchCTF(indexes))
+
+        if self.mode == "tomo":
+            return (images, inputs[1]), labels
+        else:
+            return images, labels
+
+    def particleCache(self):
+        # Memory mapped Wiener filtered particles (computed once, then reused by later epochs and runs)
+        if self.particle_cache is None:
+            self.particle_cache = open_particle_cache(self, self.wiener_cache)
+        return self.particle_cache
+
+    def readCachedBatch(self, inputs, labels):
+        # Read the particles of a batch from the memory mapped cache (only these rows are loaded in memory)
+        indexes = labels[0] if self.mode == "tomo" else labels
+        read_fn = lambda idx: self.particleCache()["images"][idx][..., None].astype(np.float32)
+        images = tf.numpy_function(read_fn, [indexes], tf.float32)
+        images.set_shape([None, self.xsize, self.xsize, 1])
+
+        if self.mode == "tomo":
+            return (images, inputs[1]), labels
+        else:
+            return images, labels
+
+    def batchCTF(self, indexes):
+        # CTFs of a batch of particles
+        batch_size_scope = tf.shape(indexes)[0]
+        defocusU_batch = tf.gather(self.defocusU, indexes, axis=0)
+        defocusV_batch = tf.gather(self.defocusV, indexes, axis=0)
+        defocusAngle_batch = tf.gather(self.defocusAngle, indexes, axis=0)
+        cs_batch = tf.gather(self.cs, indexes, axis=0)
+        return computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, self.kv,
+                          self.sr, self.pad_factor, [self.xsize, int(0.5 * self.xsize + 1)],
+                          batch_size_scope, self.applyCTF)
+
+    def batchContext(self, indexes):
+        # Alignment and CTFs of a batch of particles (no generator state is modified)
+        euler = tf.stack([tf.gather(self.angle_rot, indexes, axis=0),
+                          tf.gather(self.angle_tilt, indexes, axis=0),
+                          tf.gather(self.angle_psi, indexes, axis=0)], axis=1)
+        shifts = tf.stack([tf.gather(self.shift_x, indexes, axis=0),
+                           tf.gather(self.shift_y, indexes, axis=0)], axis=1)
+        return BatchContext(euler, shifts, self.batchCTF(indexes))
 
     # ----- -------- -----#
 
@@ -324,7 +441,7 @@ class DataGeneratorBase:
         images = tfa.image.gaussian_filter2d(images, 3 * self.step, self.step)
         return images
 
-    def wiener2DFilter(self, images):
+    def wiener2DFilter(self, images, ctf):
         # Get current batch size (function scope)
         batch_size_scope = tf.shape(images)[0]
 
@@ -332,18 +449,18 @@ class DataGeneratorBase:
         pad_size = tf.constant(int(self.pad_factor * self.xsize), dtype=tf.int32)
         size = tf.constant(int(self.xsize), dtype=tf.int32)
 
-        ctf_2 = self.ctf * self.ctf
+        ctf_2 = ctf * ctf
         # epsilon = 1e-5
         epsilon = 0.1 * tf.reduce_mean(ctf_2)
 
         ft_images = fft_pad(images, pad_size, pad_size)
-        ft_w_images_real = tf.math.real(ft_images) * self.ctf / (ctf_2 + epsilon)
-        ft_w_images_imag = tf.math.imag(ft_images) * self.ctf / (ctf_2 + epsilon)
+        ft_w_images_real = tf.math.real(ft_images) * ctf / (ctf_2 + epsilon)
+        ft_w_images_imag = tf.math.imag(ft_images) * ctf / (ctf_2 + epsilon)
         ft_w_images = tf.complex(ft_w_images_real, ft_w_images_imag)
         w_images = ifft_pad(ft_w_images, size, size)
         return tf.reshape(w_images, [batch_size_scope, self.xsize, self.xsize, 1])
 
-    def ctfFilterImage(self, images):
+    def ctfFilterImage(self, images, ctf):
         # Get current batch size (function scope)
         batch_size_scope = tf.shape(images)[0]
 
@@ -353,8 +470,8 @@ class DataGeneratorBase:
 
         # ft_images = tf.signal.fftshift(tf.signal.rfft2d(images[:, :, :, 0]))
         ft_images = fft_pad(images, pad_size, pad_size)
-        ft_ctf_images_real = tf.multiply(tf.math.real(ft_images), self.ctf)
-        ft_ctf_images_imag = tf.multiply(tf.math.imag(ft_images), self.ctf)
+        ft_ctf_images_real = tf.multiply(tf.math.real(ft_images), ctf)
+        ft_ctf_images_imag = tf.multiply(tf.math.imag(ft_images), ctf)
         ft_ctf_images = tf.complex(ft_ctf_images_real, ft_ctf_images_imag)
         # ctf_images = tf.signal.irfft2d(tf.signal.ifftshift(ft_ctf_images))
         ctf_images = ifft_pad(ft_ctf_images, size, size)
@@ -429,17 +546,20 @@ class DataGeneratorBase:
     #     # return tf.math.pow(1000., rmsdef - self.cap_def)
 
     def getFourierRings(self):
-        idx = np.indices((self.xsize, self.xsize)) - self.xsize // 2
-        idx = np.fft.fftshift(idx)
-        idx = idx[:, :, :self.xsize // 2 + 1]
-
-        # self.idxft = (idx / self.xsize).astype(np.float32)
-        # self.rrft = np.sqrt(np.sum(idx ** 2, axis=0)).astype(np.float32)  ## batch, npts, x-y
-
-        rr = np.round(np.sqrt(np.sum(idx ** 2, axis=0))).astype(int)
-        self.rings = np.zeros((self.xsize, self.xsize // 2 + 1, self.xsize // 2), dtype=np.float32)  #### Fourier rings
-        for i in range(self.xsize // 2):
-            self.rings[:, :, i] = (rr == i)
+        # Ring index of every frequency (rfft2d layout). Ring statistics are computed with segment reductions,
+        # so memory is linear in the number of pixels
+        self.rings = tf.constant(fourier_shell_indices(self.xsize, ndim=2), dtype=tf.int32)
+        self.num_rings = self.xsize // 2
+
+        # Rings and Hermitian weights of the padded half plane (Fourier space losses)
+        pad_size = int(self.pad_factor * self.xsize)
+        self.rings_pad = tf.constant(fourier_shell_indices(pad_size, ndim=2), dtype=tf.int32)
+        self.num_rings_pad = pad_size // 2
+        hermitian_weights = np.full(pad_size // 2 + 1, 2.0, dtype=np.float32)
+        hermitian_weights[0] = 1.0
+        if pad_size % 2 == 0:
+            hermitian_weights[-1] = 1.0
+        self.hermitian_weights = tf.constant(hermitian_weights, dtype=tf.float32)
 
         # self.xvec = tf.constant(np.fromfunction(lambda i, j: 1.0 - 2 * ((i + j) % 2),
         #                                         (self.xsize, self.xsize // 2 + 1), dtype=np.float32))
@@ -450,16 +570,15 @@ class DataGeneratorBase:
         ind2 = ind > (r[0] ** 2)
         return ind1 * ind2
 
-    @tf.function
     def get_radial_masks(self):
+        # Radial index of every pixel of the (centered) image instead of one dense mask per radius
         bxsize = self.xsize
         half_bxsize = self.xsize // 2
         freq_nyq = int(np.floor(int(bxsize) / 2.0))
         radii = np.arange(half_bxsize).reshape(half_bxsize, 1)  # image size 256, binning = 3
-        radial_masks = np.apply_along_axis(self.radial_mask, 1, radii, half_bxsize, half_bxsize,
-                                           np.arange(0, bxsize), np.arange(0, bxsize), 1)
-        radial_masks = np.expand_dims(radial_masks, 1)
-        radial_masks = np.expand_dims(radial_masks, 1)
+        sy, sx = np.meshgrid(np.arange(0, bxsize), np.arange(0, bxsize), indexing="ij")
+        radial_masks = np.ceil(np.sqrt((sx - half_bxsize) ** 2 + (sy - half_bxsize) ** 2)).astype(np.int32) - 1
+        radial_masks = np.where(radial_masks < 0, half_bxsize, np.minimum(radial_masks, half_bxsize))
 
         spatial_freq = radii.astype(np.float32) / freq_nyq
         spatial_freq = spatial_freq / max(spatial_freq)
@@ -510,25 +629,74 @@ class DataGeneratorBase:
     def frc_loss(self, y_true, y_pred, minpx=1, maxpx=-1):
         y_true = tf.signal.rfft2d(y_true[:, :, :, 0])
         y_pred = tf.signal.rfft2d(y_pred[:, :, :, 0])
-        mreal, mimag = tf.math.real(y_pred), tf.math.imag(y_pred)
-        dreal, dimag = tf.math.real(y_true), tf.math.imag(y_true)
-        #### normalization per ring
-        nrm_img = mreal ** 2 + mimag ** 2
-        nrm_data = dreal ** 2 + dimag ** 2
-
-        nrm0 = tf.tensordot(nrm_img, self.rings, [[1, 2], [0, 1]])
-        nrm1 = tf.tensordot(nrm_data, self.rings, [[1, 2], [0, 1]])
 
-        nrm = tf.sqrt(nrm0) * tf.sqrt(nrm1)
-        nrm = tf.maximum(nrm, 1e-4)  #### so we do not divide by 0
+        #### FRC per ring (segment sums over the ring indices)
+        frc = fourier_shell_correlation(y_pred, y_true, self.rings, self.num_rings)
 
         #### average FRC per batch
-        ccc = mreal * dreal + mimag * dimag
-        frc = tf.tensordot(ccc, self.rings, [[1, 2], [0, 1]]) / nrm
-
         frcval = tf.reduce_mean(frc[:, minpx:maxpx], axis=1)
         return frcval
 
+    def frc_cost(self, y_true, y_pred):
+        return 1.0 - self.frc_loss(y_true, y_pred)
+
+    def fourierImages(self, images):
+        # Half plane FT of the padded images (unshifted layout). Computed once per batch and shared by
+        # the Fourier space losses, which compare the whole padded field (see fourier_loss)
+        pad_size = int(self.pad_factor * self.xsize)
+        padded_images = tf.image.resize_with_crop_or_pad(tf.cast(images, tf.float32), pad_size, pad_size)
+        return tf.signal.rfft2d(padded_images[:, :, :, 0])
+
+    def ctfFilterFourier(self, ft_images, ctf):
+        # CTFs are stored in the layout of fft_pad, so they are unshifted before the product
+        ctf = tf.signal.ifftshift(tf.cast(ctf, tf.float32))
+        return tf.complex(tf.math.real(ft_images) * ctf, tf.math.imag(ft_images) * ctf)
+
+    def fourierInnerProduct(self, ft_1, ft_2):
+        # Real space inner product over the padded grid of every pair of images (Parseval theorem on the
+        # half plane)
+        prod = tf.math.real(ft_1) * tf.math.real(ft_2) + tf.math.imag(ft_1) * tf.math.imag(ft_2)
+        pad_pixels = float(int(self.pad_factor * self.xsize) ** 2)
+        return tf.reduce_sum(prod * self.hermitian_weights[None, None, :], axis=(1, 2)) / pad_pixels
+
+    def loss_correlation_ft(self, ft_true, ft_pred):
+        # Counterpart of correlation_coefficient_loss on the padded field (means and sums over the whole
+        # batch). Means are taken from the zero frequency of the padded transforms
+        epsilon = 10e-5
+        n = tf.cast(tf.shape(ft_true)[0], tf.float32) * float(self.xsize * self.xsize)
+        s_x = tf.reduce_sum(tf.math.real(ft_true[:, 0, 0]))
+        s_y = tf.reduce_sum(tf.math.real(ft_pred[:, 0, 0]))
+        r_num = tf.reduce_sum(self.fourierInnerProduct(ft_true, ft_pred)) - s_x * s_y / n
+        x_square_sum = tf.reduce_sum(self.fourierInnerProduct(ft_true, ft_true)) - s_x * s_x / n
+        y_square_sum = tf.reduce_sum(self.fourierInnerProduct(ft_pred, ft_pred)) - s_y * s_y / n
+        r_den = tf.sqrt(x_square_sum * y_square_sum)
+        r = r_num / (r_den + epsilon)
+        return 1 - r
+
+    def fourier_phase_correlation_ft(self, ft_true, ft_pred):
+        # Counterpart of fourier_phase_correlation on the padded transforms
+        x = tf.complex(tf.math.real(ft_true) * self.circular_mask_pad, tf.math.imag(ft_true) * self.circular_mask_pad)
+        y = tf.complex(tf.math.real(ft_pred) * self.circular_mask_pad, tf.math.imag(ft_pred) * self.circular_mask_pad)
+
+        epsilon = 10e-5
+        num = tf.abs(tf.reduce_sum(x * tf.math.conj(y), axis=(1, 2)))
+        d_1 = tf.reduce_sum(tf.abs(x) ** 2, axis=(1, 2))
+        d_2 = tf.reduce_sum(tf.abs(y) ** 2, axis=(1, 2))
+        den = tf.sqrt(d_1 * d_2)
+        cross_power_spectrum = num / (den + epsilon)
+
+        return 1 - K.mean(cross_power_spectrum)
+
+    def frc_cost_ft(self, ft_true, ft_pred, minpx=1, maxpx=-1):
+        # Counterpart of frc_cost on the rings of the padded transforms
+        frc = fourier_shell_correlation(ft_pred, ft_true, self.rings_pad, self.num_rings_pad)
+        return 1.0 - tf.reduce_mean(frc[:, minpx:maxpx], axis=1)
+
+    def mse_ft(self, ft_true, ft_pred):
+        # Counterpart of mse on the padded field (normalized by the pixels of the box of every image)
+        ft_diff = ft_true - ft_pred
+        return self.fourierInnerProduct(ft_diff, ft_diff) / float(self.xsize * self.xsize)
+
     def mae(self, y_true, y_pred):
         cost = tf.keras.metrics.mae(y_true, y_pred)
         axis = tf.range(1, tf.rank(cost))
@@ -30,6 +30,8 @@ from tensorflow.keras import layers
 from tensorflow.python.ops.init_ops_v2 import _compute_fans
 from tf_siren.meta.meta_siren import HyperNetBlock
 
+from tensorflow_toolkit.utils import rematerialize
+
 
 class Sine(tf.keras.layers.Layer):
     def __init__(self, w0: float = 1.0, **kwargs):
@@ -99,17 +101,25 @@ class MetaDenseWrapper(tf.keras.layers.Layer):
                  hyper_activation: str = 'relu',
                  use_bias: bool = True,
                  meta_kernel_initializer=None,
+                 remat: bool = False,
                  **kwargs):
 
         super().__init__(**kwargs)
         self.layer = MetaDense(input_units, output_units, hyper_units, num_hyper_layers, w0=w0,
                                hyper_activation=hyper_activation, use_bias=use_bias,
                                meta_kernel_initializer=meta_kernel_initializer, **kwargs)
+        self.remat = remat
 
-    def call(self, inputs):
+    def meta_call(self, inputs):
         param_list = self.layer(inputs)
         return self.layer.inner_call(inputs, param_list)
 
+    def call(self, inputs):
+        # Generated kernels (batch x input x output) are recomputed in the backward pass (once built)
+        if self.remat and self.layer.built:
+            return rematerialize(self.meta_call)(inputs)
+        return self.meta_call(inputs)
+
 
 class _MetaDense(layers.Dense):
     """
@@ -27,7 +27,6 @@
 
 import sys
 import numpy as np
-from scipy.ndimage import gaussian_filter
 
 import tensorflow as tf
 from tensorflow.keras import layers
@@ -42,7 +41,8 @@ except ImportError:
     allow_open3d = False
     print(YELLOW + "Open3D has not been installed. The program will continue without this package" + RESET)
 
-from tensorflow_toolkit.utils import computeCTF, full_fft_pad, full_ifft_pad, create_blur_filters
+from tensorflow_toolkit.utils import computeCTF, full_fft_pad, full_ifft_pad, create_blur_filters, getXmippOrigin, \
+    trilinear_splat, gaussian_filter_fourier, accumulate_gradients, batch_summed, parse_remat_blocks, rematerialize
 from tensorflow_toolkit.layers.siren import SIRENFirstLayerInitializer, SIRENInitializer, Sine
 
 
@@ -102,6 +102,89 @@ def compute_determinant_3x3(matrices):
     return a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
 
 
+def finite_difference_stencil(coords, max_dist=1):
+    """
+    Precompute the central difference stencil of a set of voxel coordinates.
+
+    Args:
+    - coords: Integer voxel coordinates with shape (C, 3).
+    - max_dist: Largest voxel distance searched for a neighbour (useful when coords are subsampled).
+
+    Returns:
+    - neighbours: int32 array with shape (C, 3, 2) with the index of the closest neighbour along each axis
+      in the positive and negative directions. Missing neighbours point to the voxel itself (one sided difference).
+    - spacing: float32 array with shape (C, 3) with the voxel distance between both neighbours (0 if none).
+    """
+    coords = np.round(np.asarray(coords)).astype(int)
+    num_coords = coords.shape[0]
+
+    # Lookup table from voxel position to coordinate index
+    origin = np.amin(coords, axis=0) - max_dist
+    box = np.amax(coords, axis=0) - origin + max_dist + 1
+    lut = np.full(box, -1, dtype=np.int64)
+    pos = coords - origin
+    lut[pos[:, 0], pos[:, 1], pos[:, 2]] = np.arange(num_coords)
+
+    neighbours = np.tile(np.arange(num_coords)[:, None, None], (1, 3, 2))
+    distances = np.zeros((num_coords, 3, 2), dtype=np.float32)
+    for axis in range(3):
+        for side, sign in enumerate((1, -1)):
+            for dist in range(1, max_dist + 1):
+                missing = distances[:, axis, side] == 0
+                pos_n = pos.copy()
+                pos_n[:, axis] += sign * dist
+                idx = lut[pos_n[:, 0], pos_n[:, 1], pos_n[:, 2]]
+                found = missing & (idx >= 0)
+                neighbours[found, axis, side] = idx[found]
+                distances[found, axis, side] = dist
+
+    return neighbours.astype(np.int32), np.sum(distances, axis=-1)
+
+
+def hierarchical_blocks(coords, block_size=4):
+    """
+    Partition a set of voxel coordinates in cubic blocks for hierarchical field evaluation.
+
+    Args:
+    - coords: Integer voxel coordinates with shape (C, 3).
+    - block_size: Size (in voxels) of the blocks.
+
+    Returns a dictionary with:
+    - nodes: Coordinates of the block corners (coarse grid) with shape (K, 3).
+    - corner_idx: Corner nodes of the block enclosing each coordinate with shape (C, 8).
+    - corner_weights: Trilinear interpolation weights of the corners with shape (C, 8).
+    - block_corners: Corner nodes of each block with shape (NB, 8).
+    - block_members: Coordinates inside each block with shape (NB, P). Padded with C.
+    """
+    coords = np.round(np.asarray(coords)).astype(int)
+    num_coords = coords.shape[0]
+    offsets = np.asarray([[(c >> 2) & 1, (c >> 1) & 1, c & 1] for c in range(8)])
+
+    # Blocks and their corners (shared between neighbouring blocks)
+    block_pos = np.floor_divide(coords, block_size)
+    blocks, voxel_block = np.unique(block_pos, axis=0, return_inverse=True)
+    voxel_block = voxel_block.reshape(-1)
+    corners = (blocks[:, None, :] + offsets[None, ...]).reshape(-1, 3)
+    nodes, block_corners = np.unique(corners, axis=0, return_inverse=True)
+    block_corners = block_corners.reshape(-1, 8)
+
+    # Trilinear weights of each voxel within its block
+    frac = (coords - block_size * block_pos) / block_size
+    corner_weights = np.prod(np.where(offsets[None, ...] == 1, frac[:, None, :], 1. - frac[:, None, :]), axis=-1)
+
+    # Padded list of members per block
+    order = np.argsort(voxel_block, kind="stable")
+    counts = np.bincount(voxel_block, minlength=blocks.shape[0])
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    block_members = np.full((blocks.shape[0], np.amax(counts)), num_coords, dtype=np.int32)
+    position = np.arange(num_coords) - np.repeat(starts, counts)
+    block_members[voxel_block[order], position] = order
+
+    return {"nodes": block_size * nodes, "corner_idx": block_corners[voxel_block].astype(np.int32),
+            "corner_weights": corner_weights.astype(np.float32), "block_corners": block_corners.astype(np.int32),
+            "block_members": block_members}
+
+
 class Encoder(tf.keras.Model):
     def __init__(self, latent_dim, input_dim, architecture="convnn", mode="spa", refPose=True, jit_compile=True):
         super(Encoder, self).__init__()
@@ -193,10 +276,12 @@ class Encoder(tf.keras.Model):
 
 
 class FieldDecoder(tf.keras.Model):
-    def __init__(self, generator, latDim=8, jit_compile=True, precision=tf.float32, compute_delta=True):
+    def __init__(self, generator, latDim=8, jit_compile=True, precision=tf.float32, compute_delta=True,
+                 factorized=True):
         super(FieldDecoder, self).__init__()
         self.generator = generator
         self.compute_delta = compute_delta
+        self.factorized = factorized
         first_siren = Sine(30.0)  # TODO: Try 30 again
         siren = Sine(1.0)
         self.compute_delta = compute_delta
@@ -222,8 +307,44 @@ class FieldDecoder(tf.keras.Model):
 
         self.field_decoder = tf.keras.Model(coords_het, layers_comb_field, name="field_decoder")
 
+    def first_layer(self, coords, het):
+        # First layer split as coords @ W_c + het @ W_z + b (same kernel as the tiled layer)
+        dense = self.field_decoder.layers[1]
+        dtype = dense.compute_dtype
+        kernel = tf.cast(dense.kernel, dtype)
+        coords_dim = coords.shape[-1]
+
+        # Coordinate branch is shared by the whole batch when coords is (C, 3)
+        coords_proj = tf.einsum("...i,ij->...j", tf.cast(coords, dtype), kernel[:coords_dim])
+        if coords_proj.shape.rank == 2:
+            coords_proj = coords_proj[None, ...]
+
+        # Latent branch is computed once per sample and broadcast over the coordinates
+        het_proj = tf.matmul(tf.cast(het, dtype), kernel[coords_dim:]) + tf.cast(dense.bias, dtype)
+
+        return dense.activation(coords_proj + het_proj[:, None, :])
+
+    def factorized_call(self, coords, het):
+        layers_comb = self.first_layer(coords, het)
+
+        # Remaining residual SIREN layers (reuse the layers of the tiled model)
+        dense_layers = [layer for layer in self.field_decoder.layers[2:] if isinstance(layer, layers.Dense)]
+        for dense in dense_layers[:-1]:
+            layers_comb = layers_comb + dense(layers_comb)
+
+        return self.field_decoder.layers[-1](dense_layers[-1](layers_comb))
+
     def call(self, inputs):
-        field = self.field_decoder(inputs)
+        # Inputs: coords (C, 3) or (B, M, 3) and latent vectors (B, latDim)
+        coords, het = inputs
+        if self.factorized:
+            field = self.factorized_call(coords, het)
+        else:
+            B = tf.shape(het)[0]
+            if coords.shape.rank == 2:
+                coords = tf.tile(coords[None, ...], (B, 1, 1))
+            het_tiled = tf.tile(het[:, None, :], (1, tf.shape(coords)[1], 1))
+            field = self.field_decoder(tf.concat([tf.cast(coords, het.dtype), het_tiled], axis=-1))
         if self.compute_delta:
             return field[..., :3], field[..., 3]
         else:
@@ -232,12 +353,15 @@ class FieldDecoder(tf.keras.Model):
 
 class PhysDecoder:
     # @tf.function(jit_compile=True)
-    def __init__(self, generator, CTF="apply", jit_compile=True, precision=tf.float32):
+    def __init__(self, generator, CTF="apply", jit_compile=True, precision=tf.float32, remat=False):
         super(PhysDecoder, self).__init__()
         self.generator = generator
         self.CTF = CTF
         self.precision = precision
 
+        # Projection buffers recomputed in the backward pass
+        self.compute_theo_proj = rematerialize(self.compute_theo_proj, remat)
+
         # XLA compilation of methods
         if jit_compile:
             self.prepare_batch = tf.function(jit_compile=jit_compile)(self.prepare_batch)
@@ -344,16 +468,16 @@ class PhysDecoder:
             # Gaussian filter image
             decoded = self.generator.gaussianFilterImage(decoded)
 
-            if self.CTF == "apply":
-                # CTF filter image
+            if self.CTF == "apply" and not self.generator.fourier_loss:
+                # CTF filter image (applied by the loss in Fourier space otherwise)
                 decoded_ctf = tf.cast(
                     self.generator.ctfFilterImage(tf.cast(decoded, tf.float32), tf.cast(ctf, tf.float32)),
                     self.precision)
             else:
                 decoded_ctf = decoded
         else:
-            if self.CTF == "apply":
-                # CTF filter image
+            if self.CTF == "apply" and not self.generator.fourier_loss:
+                # CTF filter image (applied by the loss in Fourier space otherwise)
                 decoded_ctf = tf.cast(
                     self.generator.ctfFilterImage(tf.cast(decoded, tf.float32), tf.cast(ctf, tf.float32)),
                     self.precision)
@@ -397,7 +521,9 @@ class PhysDecoder:
 class AutoEncoder(tf.keras.Model):
     def __init__(self, generator, architecture="convnn", CTF="apply", mode=None, l_bond=0.01, l_angle=0.01,
                  l_clashes=None, jit_compile=True, latDim=8, precision=tf.float32, precision_scaled=tf.float32,
-                 compute_delta=True, l_dfm=0.0, poseReg=0.0, ctfReg=0.0, **kwargs):
+                 compute_delta=True, l_dfm=0.0, poseReg=0.0, ctfReg=0.0, jacobian_mode="autograd",
+                 hierarchical_block=0, hierarchical_budget=0.25, hierarchical_tol=1e-3, accum_steps=1, remat=None,
+                 **kwargs):
         super(AutoEncoder, self).__init__(**kwargs)
         generator.mode = "spa"
         self.generator = generator
@@ -410,6 +536,13 @@ class AutoEncoder(tf.keras.Model):
         self.l_dfm = l_dfm
         self.poseReg = poseReg
         self.ctfReg = ctfReg
+        self.jacobian_mode = jacobian_mode
+        self.hierarchical = hierarchical_block > 1
+        self.hierarchical_tol = hierarchical_tol
+        self.hierarchical_budget = hierarchical_budget
+        self.accum_steps = accum_steps
+        remat = parse_remat_blocks(remat, ["field", "projection"])
+        self.remat_field = "field" in remat
         self.filters = create_blur_filters(5, 10, 30)
         # self.architecture = architecture
         self.precision = precision
@@ -429,10 +562,12 @@ class AutoEncoder(tf.keras.Model):
             self.inverse_field_delta_decoder = FieldDecoder(generator, latDim=latDim, jit_compile=jit_compile,
                                                             precision=precision,
                                                             compute_delta=compute_delta)
-        self.phys_decoder = PhysDecoder(generator, CTF=self.CTF, jit_compile=jit_compile, precision=precision)
-        self.z_space = layers.Dense(latDim, name="z_space", kernel_initializer= tf.keras.initializers.RandomUniform(minval=-0.001, maxval=0.001))
-        self.delta_euler = layers.Dense(3, name="delta_euler", trainable=generator.refinePose)
-        self.delta_shifts = layers.Dense(2, name="delta_shifts", trainable=generator.refinePose)
+        self.phys_decoder = PhysDecoder(generator, CTF=self.CTF, jit_compile=jit_compile, precision=precision,
+                                        remat="projection" in remat)
+        # Output heads in float32 (encoders may compute in a reduced precision, the physical decoder does not)
+        self.z_space = layers.Dense(latDim, name="z_space", kernel_initializer= tf.keras.initializers.RandomUniform(minval=-0.001, maxval=0.001), dtype=tf.float32)
+        self.delta_euler = layers.Dense(3, name="delta_euler", trainable=generator.refinePose, dtype=tf.float32)
+        self.delta_shifts = layers.Dense(2, name="delta_shifts", trainable=generator.refinePose, dtype=tf.float32)
         self.activation = layers.Activation('linear', dtype=precision)
         self.disantangle_pose = poseReg > 0.0
         self.disantangle_ctf = ctfReg > 0.0
@@ -443,12 +578,33 @@ class AutoEncoder(tf.keras.Model):
         self.clash_loss_tracker = tf.keras.metrics.Mean(name="clash_loss")
         self.loss_disantangle_tracker = tf.keras.metrics.Mean(name="loss_disentangled")
 
+        # Jacobian engine for the physical regularizers
+        if jacobian_mode not in ["autograd", "finite_diff", "hutchinson"]:
+            raise ValueError("Jacobian mode must be one of: autograd, finite_diff, hutchinson")
+        if jacobian_mode == "finite_diff":
+            fd_neighbours, fd_spacing = finite_difference_stencil(generator.coords, max_dist=generator.step)
+            self.fd_neighbours = tf.constant(fd_neighbours, dtype=tf.int32)
+            self.fd_spacing = tf.constant(fd_spacing / generator.half_xsize, dtype=tf.float32)
+
+        # Coarse grid for hierarchical field evaluation
+        if self.hierarchical:
+            blocks = hierarchical_blocks(generator.coords, block_size=hierarchical_block)
+            self.coarse_coords = tf.constant(blocks["nodes"] / generator.half_xsize, dtype=generator.precision)
+            self.corner_idx = tf.constant(blocks["corner_idx"], dtype=tf.int32)
+            self.corner_weights = tf.constant(blocks["corner_weights"], dtype=tf.float32)
+            self.block_corners = tf.constant(blocks["block_corners"], dtype=tf.int32)
+            self.block_members = tf.constant(blocks["block_members"], dtype=tf.int32)
+            self.num_active_blocks = max(int(np.ceil(hierarchical_budget * blocks["block_members"].shape[0])), 1)
+
         # XLA compilation of cost function
         if jit_compile:
             self.cost_function = tf.function(jit_compile=jit_compile)(self.generator.cost_function)
+            self.fourier_cost_function = tf.function(jit_compile=jit_compile)(self.generator.fourier_cost_function) \
+                if self.generator.fourier_loss else None
             self.gradient = tf.function(jit_compile=jit_compile)(self.gradient)
             self.compute_jacobian_autograd = tf.function(jit_compile=jit_compile)(self.compute_jacobian_autograd)
-            # self.compute_jacobian_finite_diff = tf.function(jit_compile=jit_compile)(self.compute_jacobian_finite_diff)
+            self.compute_jacobian_finite_diff = tf.function(jit_compile=jit_compile)(self.compute_jacobian_finite_diff)
+            self.compute_jacobian_hutchinson = tf.function(jit_compile=jit_compile)(self.compute_jacobian_hutchinson)
             self.compute_jacobian_regularization = tf.function(jit_compile=jit_compile)(
                 self.compute_jacobian_regularization)
             self.compute_bending_energy_regularization = tf.function(jit_compile=jit_compile)(
@@ -462,6 +618,7 @@ class AutoEncoder(tf.keras.Model):
             self.compute_field_norm = tf.function(jit_compile=jit_compile)(self.compute_field_norm)
         else:
             self.cost_function = self.generator.cost_function
+            self.fourier_cost_function = self.generator.fourier_cost_function
 
         if allow_open3d and self.generator.ref_is_struct:
             # Continuous convolution
@@ -492,7 +649,14 @@ class AutoEncoder(tf.keras.Model):
             self.loss_disantangle_tracker,
         ]
 
-    def train_step(self, data):
+    def decoder_weights(self):
+        if self.l_dfm > 0.0:
+            return (self.field_delta_decoder.trainable_weights
+                    + self.inverse_field_delta_decoder.trainable_weights)
+        else:
+            return self.field_delta_decoder.trainable_weights
+
+    def compute_gradients(self, data):
         inputs = tf.cast(data[0], self.precision)
 
         if self.mode == "spa":
@@ -510,7 +674,7 @@ class AutoEncoder(tf.keras.Model):
             points_row_splits = tf.range(B + 1, dtype=tf.int64) * num_points
             queries_row_splits = tf.range(B + 1, dtype=tf.int64) * num_points
 
-        if self.CTF == "wiener":
+        if self.CTF == "wiener" and not self.generator.wiener_pipeline:
             # Precompute batch CTFs
             batch_size_scope = tf.shape(indexes)[0]
             defocusU_batch = tf.gather(self.generator.defocusU, indexes, axis=0)
@@ -539,28 +703,22 @@ class AutoEncoder(tf.keras.Model):
                 x, euler, shifts = self.encoder_exp(inputs)
                 het = self.activation(self.z_space(x))
 
-                het_tiled = tf.tile(het[:, None, :], (1, C, 1))
-                coords_tiled = tf.tile(coords[None, :, :], (B, 1, 1))
-                coords_het = tf.concat([coords_tiled, het_tiled], axis=-1)
-
-                field, delta_volume = self.field_delta_decoder(coords_het)
+                field, delta_volume = self.decode_field(het)
                 encoded = [tf.transpose(field, (1, 0, 2)), delta_volume,
                            self.activation(self.delta_euler(euler)), self.activation(self.delta_shifts(shifts))]
             elif self.mode == "tomo":
                 x, latent = self.encoder_exp(inputs)
                 het = self.activation(self.z_space(latent))
 
-                het_tiled = tf.tile(het[:, None, :], (1, C, 1))
-                coords_tiled = tf.tile(coords[None, :, :], (B, 1, 1))
-                coords_het = tf.concat([coords_tiled, het_tiled], axis=-1)
-
-                field = self.field_delta_decoder(coords_het)
+                field = self.field_delta_decoder([coords, het])
                 encoded = [tf.transpose(field, (1, 0, 2)),
                            self.activation(self.delta_euler(x)), self.activation(self.delta_shifts(x))]
 
             # Field losses
 
-            loss = tf.cast(self.compute_field_loss(tf.cast(coords_het, self.precision_scaled)), self.precision)
+            loss = tf.cast(self.compute_field_loss(tf.cast(coords, self.precision_scaled),
+                                                   tf.cast(het, self.precision_scaled),
+                                                   tf.cast(field, self.precision_scaled)), self.precision)
 
             ##########################
 
@@ -572,12 +730,10 @@ class AutoEncoder(tf.keras.Model):
                 indices = tf.random.shuffle(indices)
                 indices = indices[:1000]
                 field_rnd = tf.gather(field, indices, axis=1)
-                coords_tiled_rnd = tf.gather(coords_tiled, indices, axis=1)
-
+                coords_rnd = tf.gather(coords, indices, axis=0)
 
-                convected_coords_rnd = field_rnd + coords_tiled_rnd
-                het_tiled = tf.tile(het[:, None, :], (1, tf.shape(field_rnd)[1], 1))
-                inv_field_rnd, _ = self.inverse_field_delta_decoder(convected_coords_rnd, het_tiled)
+                convected_coords_rnd = field_rnd + tf.cast(coords_rnd[None, ...], field_rnd.dtype)
+                inv_field_rnd, _ = self.inverse_field_delta_decoder([convected_coords_rnd, het])
 
                 loss_dfm = tf.cast(tf.reduce_mean(tf.abs(tf.cast(field_rnd, self.precision_scaled) + tf.cast(inv_field_rnd, self.precision_scaled)), axis=(1, 2)), self.precision)
             else:
@@ -597,6 +753,8 @@ class AutoEncoder(tf.keras.Model):
 
                 # Forward pass (third encoder - permuted CTF)
                 if self.disantangle_ctf and self.CTF is not None:
+                    if self.generator.fourier_loss and self.CTF == "apply":
+                        decoded_ctf = tf.cast(self.generator.ctfFilterImage(tf.cast(decoded, tf.float32), tf.cast(ctf, tf.float32)), self.precision)
                     x, _, _ = self.encoder_ctf(decoded_ctf)
                     het_ctf = self.activation(self.z_space(x))
                     ctf_perm = tf.random.shuffle(ctf)
@@ -625,8 +783,7 @@ class AutoEncoder(tf.keras.Model):
             else:
                 clashes = tf.constant(0.0, self.precision)
 
-            img_loss = tf.cast(self.cost_function(tf.cast(images, self.precision_scaled),
-                                                  tf.cast(decoded_ctf, self.precision_scaled)), self.precision)
+            img_loss = self.image_loss(images, decoded, decoded_ctf, ctf)
 
             # Bond and angle losses
             if self.generator.ref_is_struct:
@@ -659,21 +816,23 @@ class AutoEncoder(tf.keras.Model):
                           self.ctfReg * loss_disantagled_ctf)  # 0.001 works on HetSIREN
             decoder_losses = 0.00001 * loss + self.l_dfm * loss_dfm
 
-        if self.l_dfm > 0.0:
-            decoder_weights = (self.field_delta_decoder.trainable_weights
-                               + self.inverse_field_delta_decoder.trainable_weights)
-        else:
-            decoder_weights = self.field_delta_decoder.trainable_weights
-        grads, grads_d = tape.gradient([total_loss, decoder_losses], [self.trainable_weights, decoder_weights])
-        self.optimizer.apply_gradients(zip(grads, self.trainable_weights))
-        self.optimizer.apply_gradients(zip(grads_d, decoder_weights))
+        grads = tape.gradient([total_loss, decoder_losses], [self.trainable_weights, self.decoder_weights()])
+        losses = {"loss": total_loss, "img_loss": img_loss, "angle": angle_loss, "bond": bond_loss,
+                  "clashes": clashes, "loss_disentangled": loss_disantagled_pose + loss_disantagled_ctf}
+        return grads, losses, batch_summed(total_loss, decoder_losses)
 
-        self.total_loss_tracker.update_state(total_loss)
-        self.img_loss_tracker.update_state(img_loss)
-        self.angle_loss_tracker.update_state(angle_loss)
-        self.bond_loss_tracker.update_state(bond_loss)
-        self.clash_loss_tracker.update_state(clashes)
-        self.loss_disantangle_tracker.update_state(loss_disantagled_pose + loss_disantagled_ctf)
+    def train_step(self, data):
+        # Gradients of the whole batch (accumulated over micro batches if accum_steps > 1)
+        (grads, grads_d), losses = accumulate_gradients(self.compute_gradients, data, self.accum_steps)
+        self.optimizer.apply_gradients(zip(grads, self.trainable_weights))
+        self.optimizer.apply_gradients(zip(grads_d, self.decoder_weights()))
+
+        self.total_loss_tracker.update_state(losses["loss"])
+        self.img_loss_tracker.update_state(losses["img_loss"])
+        self.angle_loss_tracker.update_state(losses["angle"])
+        self.bond_loss_tracker.update_state(losses["bond"])
+        self.clash_loss_tracker.update_state(losses["clashes"])
+        self.loss_disantangle_tracker.update_state(losses["loss_disentangled"])
         return {
             "loss": self.total_loss_tracker.result(),
             "img_loss": self.img_loss_tracker.result(),
@@ -707,7 +866,7 @@ class AutoEncoder(tf.keras.Model):
         # Prepare batch
         # images = self.decoder.prepare_batch([images, indexes])
 
-        if self.CTF == "wiener":
+        if self.CTF == "wiener" and not self.generator.wiener_pipeline:
             # Precompute batch CTFs
             batch_size_scope = tf.shape(indexes)[0]
             defocusU_batch = tf.gather(self.generator.defocusU, indexes, axis=0)
@@ -826,69 +985,212 @@ class AutoEncoder(tf.keras.Model):
         encoded[2] *= self.refPose
 
         # Zernike3D coefficients
-        B, C = tf.shape(inputs)[0], tf.shape(self.generator.scaled_coords)[0]
+        B = tf.shape(inputs)[0]
         het = encoded[0]
         Z_solver = tf.tile(tf.constant(self.generator.Z_solver, dtype=tf.float32)[None, ...], (B, 1, 1))
 
-        het_tiled = tf.tile(het[:, None, :], (1, C, 1))
-        coords_tiled = tf.tile(self.generator.scaled_coords[None, :, :], (B, 1, 1))
-        coords_het = tf.concat([coords_tiled, het_tiled], axis=-1)
-
-        field, _ = self.field_delta_decoder(coords_het)
+        field, _ = self.decode_field(het)
         c_lnm = tf.matmul(Z_solver, field)
         c_lnm = tf.concat([c_lnm[..., 0], c_lnm[..., 1], c_lnm[..., 2]], axis=-1)
 
         return encoded, c_lnm
 
-    def convect_maps(self, z):
-        B, C = tf.shape(z)[0], tf.shape(self.generator.scaled_coords)[0]
-
-        # Decoded motion fields
-        z = tf.cast(z, tf.float32)
-        z_tiled = tf.tile(z[:, None, :], (1, C, 1))
-        coords_tiled = tf.tile(self.generator.scaled_coords[None, :, :], (B, 1, 1))
-        coords_z = tf.concat([coords_tiled, z_tiled], axis=-1)
-
-        d, delta_v = self.field_delta_decoder(coords_z)
-        d = self.generator.half_xsize * d
-        d = d.numpy()
-        d = np.stack([d[..., 2], d[..., 1], d[..., 0]], axis=-1)
-
-        v = (tf.tile(self.generator.values[None, ...], (B, 1)) + delta_v).numpy()
-
-        # Convect indices
-        convected_indices = np.round(self.generator.indices.numpy()[None, ...] + d).astype(int)
-
-        # Scatter in volume
-        convected_vols = np.zeros((d.shape[0], self.generator.xsize, self.generator.xsize, self.generator.xsize))
-        for idx in range(convected_indices.shape[0]):
-            if np.all(np.abs(convected_indices[idx]) < self.generator.xsize):
-                convected_vol = np.zeros((self.generator.xsize, self.generator.xsize, self.generator.xsize))
-                convected_vol[
-                    convected_indices[idx, :, 0], convected_indices[idx, :, 1], convected_indices[idx, :, 2]] += v[idx]
-
-                # Gaussian filter map
-                convected_vol = gaussian_filter(convected_vol, sigma=1.0)
-
-                convected_vols[idx] = convected_vol
-
-        return convected_vols
-
-    def gradient(self, inputs, axis, precision=tf.float32):
+    def convect_maps(self, z, batch_size=8, chunk_size=65536, out_size=None, sigma=1.0):
+        """
+        Convect the reference map with the fields decoded from a set of latent vectors.
+
+        The field is evaluated in fixed size coordinate chunks and the density is splatted with
+        trilinear weights, so memory does not depend on the mask size. Maps are yielded as soon as
+        each batch of latent vectors is ready, so they can be written to disk in a streaming fashion.
+
+        :param z: Latent vectors with shape (N, latDim)
+        :param batch_size: Number of maps computed at the same time
+        :param chunk_size: Number of coordinates decoded at the same time
+        :param out_size: Box size of the output maps (defaults to the training box size)
+        :param sigma: Standard deviation of the Gaussian filter applied to the maps (0 disables it)
+        :return: Generator yielding (index, map) pairs
+        """
+        out_size = self.generator.xsize if out_size is None else int(out_size)
+        out_origin = tf.constant(getXmippOrigin(out_size), dtype=tf.float32)
+        coords = tf.constant(self.generator.coords, dtype=tf.float32)
+        scaled_coords = self.generator.scaled_coords
+        values = tf.constant(self.generator.values, dtype=tf.float32)
+        C = coords.shape[0]
+
+        z = np.asarray(z, dtype=np.float32)
+        for start_z in range(0, z.shape[0], batch_size):
+            z_batch = tf.constant(z[start_z:start_z + batch_size])
+            convected_vols = tf.zeros((z_batch.shape[0], out_size, out_size, out_size), dtype=tf.float32)
+
+            if self.hierarchical:
+                # Field refined only where the coarse field changes (tolerance based)
+                coarse, active = self.coarse_field(z_batch, tol=self.hierarchical_tol)
+                members = tf.reshape(tf.gather(self.block_members, active, axis=0), [-1])
+                refine = tf.scatter_nd(members[:, None], tf.ones_like(members), [C + 1])[:C] > 0
+
+                # Refined coordinates are decoded in slices of a fixed size, so the field decoder is not
+                # retraced (and recompiled) for every chunk and batch
+                refine_size = max(int(np.ceil(self.hierarchical_budget * chunk_size)), 1)
+                for start_c in range(0, C, chunk_size):
+                    end_c = min(start_c + chunk_size, C)
+                    d, delta_v = self.decode_field_chunk(z_batch, coarse, start_c, end_c,
+                                                         tf.where(refine[start_c:end_c])[:, 0],
+                                                         refine_size=refine_size)
+                    convected_vols = self.splat_chunk(convected_vols, d, delta_v, coords[start_c:end_c],
+                                                      values[start_c:end_c], out_origin)
+            else:
+                for start_c in range(0, C, chunk_size):
+                    convected_vols = self.convect_chunk(convected_vols, z_batch,
+                                                        scaled_coords[start_c:start_c + chunk_size],
+                                                        coords[start_c:start_c + chunk_size],
+                                                        values[start_c:start_c + chunk_size], out_origin)
+
+            # Gaussian filter maps (batched in Fourier space)
+            if sigma > 0.0:
+                convected_vols = gaussian_filter_fourier(convected_vols, sigma=sigma)
+
+            for idx, convected_vol in enumerate(convected_vols.numpy()):
+                yield start_z + idx, convected_vol
+
+    @tf.function
+    def convect_chunk(self, convected_vols, z, scaled_coords, coords, values, out_origin):
+        # Decoded motion fields for the chunk
+        d, delta_v = self.field_delta_decoder([scaled_coords, z])
+        return self.splat_chunk(convected_vols, d, delta_v, coords, values, out_origin)
+
+    @tf.function
+    def splat_chunk(self, convected_vols, d, delta_v, coords, values, out_origin):
+        d = tf.cast(self.generator.half_xsize * d, tf.float32)
+        v = tf.broadcast_to(values[None, :] + tf.cast(delta_v, tf.float32), tf.shape(d)[:2])
+
+        # Convected positions (X, Y, Z) --> volume indices (Z, Y, X)
+        positions = coords[None, ...] + d + out_origin[None, None, :]
+        positions = tf.reverse(positions, axis=[-1])
+
+        return trilinear_splat(convected_vols, positions, v)
+
+    def evaluate_field(self, coords, het):
+        # Field decoder activations (B x C x hidden) recomputed in the backward pass if rematerialized
+        return rematerialize(lambda x, z: self.field_delta_decoder([x, z]), self.remat_field)(coords, het)
+
+    def decode_field(self, het, tol=None):
+        """
+        Decode the deformation field (and volume update) at every mask coordinate.
+
+        In hierarchical mode, the field is decoded on a coarse grid of block corners and trilinearly
+        interpolated inside each block. Only the blocks whose coarse field changes the most are decoded
+        voxel-wise: a fixed number of blocks (static shapes, used during training) or, if a tolerance is
+        given, every block whose variation exceeds it.
+
+        :param het: Latent vectors with shape (B, latDim)
+        :param tol: Variation tolerance of the coarse field (None uses the fixed block budget)
+        :return: Field with shape (B, C, 3) and volume update with shape (B, C)
+        """
+        if not self.hierarchical:
+            return self.evaluate_field(self.generator.scaled_coords, het)
+
+        B, C = tf.shape(het)[0], tf.shape(self.generator.scaled_coords)[0]
+
+        # Coarse field and blocks to refine
+        coarse, active = self.coarse_field(het, tol=tol)
+
+        # Interpolated field
+        corner_values = tf.gather(coarse, self.corner_idx, axis=1)  # (B, C, 8, 4)
+        weights = tf.cast(self.corner_weights, corner_values.dtype)
+        decoded = tf.reduce_sum(corner_values * weights[None, ..., None], axis=2)
+        members = tf.reshape(tf.gather(self.block_members, active, axis=0), [-1])
+
+        # Refine (padding entries point to an extra coordinate that is discarded)
+        scaled_coords = tf.concat([self.generator.scaled_coords,
+                                   tf.zeros((1, 3), self.generator.scaled_coords.dtype)], axis=0)
+        field, delta = self.evaluate_field(tf.gather(scaled_coords, members, axis=0), het)
+        refined = tf.concat([field, tf.broadcast_to(tf.cast(delta, field.dtype), tf.shape(field)[:2])[..., None]],
+                            axis=-1)
+        decoded = tf.concat([decoded, tf.zeros_like(decoded[:, :1])], axis=1)
+        decoded = tf.transpose(tf.tensor_scatter_nd_update(tf.transpose(decoded, (1, 0, 2)), members[:, None],
+                                                           tf.transpose(tf.cast(refined, decoded.dtype), (1, 0, 2))),
+                               (1, 0, 2))[:, :C]
+
+        return decoded[..., :3], decoded[..., 3]
+
+    def coarse_field(self, het, tol=None):
+        """
+        Decode the field on the coarse grid of block corners and select the blocks to refine (see decode_field).
+
+        :param het: Latent vectors with shape (B, latDim)
+        :param tol: Variation tolerance of the coarse field (None uses the fixed block budget)
+        :return: Coarse field and volume update packed with shape (B, K, 4) and indices of the blocks to refine
+        """
+        # Coarse field (deformation and volume update packed together)
+        field, delta = self.evaluate_field(self.coarse_coords, het)
+        coarse = tf.concat([field, tf.broadcast_to(tf.cast(delta, field.dtype), tf.shape(field)[:2])[..., None]],
+                           axis=-1)
+
+        # Blocks to refine (largest variation of the coarse field)
+        block_values = tf.gather(coarse, self.block_corners, axis=1)  # (B, NB, 8, 4)
+        variation = tf.reduce_max(tf.reduce_max(block_values, axis=2) - tf.reduce_min(block_values, axis=2),
+                                  axis=(0, 2))
+        if tol is None:
+            _, active = tf.math.top_k(tf.cast(variation, tf.float32), k=self.num_active_blocks)
+        else:
+            active = tf.where(tf.cast(variation, tf.float32) > tol)[:, 0]
+
+        return coarse, active
+
+    def decode_field_chunk(self, het, coarse, start, end, refine, refine_size=1024):
+        """
+        Hierarchical field of a chunk of mask coordinates, so memory does not depend on the mask size.
+
+        :param het: Latent vectors with shape (B, latDim)
+        :param coarse: Coarse field returned by coarse_field
+        :param start: First coordinate of the chunk
+        :param end: Last coordinate (excluded) of the chunk
+        :param refine: Coordinates of the chunk (relative to start) decoded voxel-wise
+        :param refine_size: Number of refined coordinates decoded at the same time. Refined coordinates are
+                            padded to a multiple of it, so every call to the field decoder has the same shape
+        :return: Field with shape (B, end - start, 3) and volume update with shape (B, end - start)
+        """
+        size = end - start
+
+        # Interpolated field
+        corner_values = tf.gather(coarse, self.corner_idx[start:end], axis=1)  # (B, c, 8, 4)
+        weights = tf.cast(self.corner_weights[start:end], corner_values.dtype)
+        decoded = tf.reduce_sum(corner_values * weights[None, ..., None], axis=2)
+
+        # Refine (padding entries point to an extra coordinate that is discarded)
+        num_refine = int(refine.shape[0])
+        if num_refine > 0:
+            num_pad = -num_refine % refine_size
+            refine = tf.concat([tf.cast(refine, tf.int32), tf.fill([num_pad], size)], axis=0)
+            scaled_coords = tf.concat([self.generator.scaled_coords[start:end],
+                                       tf.zeros((1, 3), self.generator.scaled_coords.dtype)], axis=0)
+            decoded = tf.transpose(tf.concat([decoded, tf.zeros_like(decoded[:, :1])], axis=1), (1, 0, 2))
+            for start_r in range(0, num_refine + num_pad, refine_size):
+                refine_slice = refine[start_r:start_r + refine_size]
+                field, delta = self.evaluate_field(tf.gather(scaled_coords, refine_slice, axis=0), het)
+                refined = tf.concat([field, tf.broadcast_to(tf.cast(delta, field.dtype),
+                                                            tf.shape(field)[:2])[..., None]], axis=-1)
+                decoded = tf.tensor_scatter_nd_update(decoded, refine_slice[:, None],
+                                                      tf.transpose(tf.cast(refined, decoded.dtype), (1, 0, 2)))
+            decoded = tf.transpose(decoded, (1, 0, 2))[:, :size]
+
+        return decoded[..., :3], decoded[..., 3]
+
+    def gradient(self, inputs, het, axis, precision=tf.float32):
         # Axis 0 --> X | Axis 1 --> Y | Axis 2 --> X
         with tf.GradientTape() as tape_1:
             tape_1.watch(inputs)
-            decoded, _ = self.field_delta_decoder(inputs)
+            decoded, _ = self.field_delta_decoder([inputs, het])
             decoded = decoded[..., axis]
-        return tape_1.gradient(decoded, inputs)[..., :3]
+        return tape_1.gradient(decoded, inputs)
 
-    def gradient_gradient(self, inputs, axis, precision=tf.float32):
+    def gradient_gradient(self, inputs, het, axis, precision=tf.float32):
         # Axis 0 --> X | Axis 1 --> Y | Axis 2 --> X
         with tf.GradientTape(persistent=True) as tape_2:
             tape_2.watch(inputs)
             with tf.GradientTape() as tape_1:
                 tape_1.watch(inputs)
-                decoded, _ = self.field_delta_decoder(inputs)
+                decoded, _ = self.field_delta_decoder([inputs, het])
                 decoded = decoded[..., axis]
             gradient = tape_1.gradient(decoded, inputs)
             gradient_x, gradient_y, gradient_z = gradient[..., 0], gradient[..., 1], gradient[..., 2]
@@ -896,77 +1198,98 @@ class AutoEncoder(tf.keras.Model):
         gradient_2_y = tape_2.gradient(gradient_y, inputs)
         gradient_2_z = tape_2.gradient(gradient_z, inputs)
         gradient_2 = tf.stack([gradient_2_x, gradient_2_y, gradient_2_z], axis=2)
-        return gradient[..., :3], gradient_2[..., :3]
+        return gradient, gradient_2
 
-    def compute_jacobian_autograd(self, inputs, second_derivative=False, precision=tf.float32):
-        """Compute the Jacobian matrix of the output wrt the input."""
+    def compute_jacobian_autograd(self, inputs, het, second_derivative=False, precision=tf.float32):
+        """Compute the Jacobian matrix of the output wrt the input coordinates (B, M, 3)."""
         if second_derivative:
-            jacobian_matrix_x, jacobian_matrix_2_x = self.gradient_gradient(inputs, 0, precision=precision)
-            jacobian_matrix_y, jacobian_matrix_2_y = self.gradient_gradient(inputs, 1, precision=precision)
-            jacobian_matrix_z, jacobian_matrix_2_z = self.gradient_gradient(inputs, 2, precision=precision)
+            jacobian_matrix_x, jacobian_matrix_2_x = self.gradient_gradient(inputs, het, 0, precision=precision)
+            jacobian_matrix_y, jacobian_matrix_2_y = self.gradient_gradient(inputs, het, 1, precision=precision)
+            jacobian_matrix_z, jacobian_matrix_2_z = self.gradient_gradient(inputs, het, 2, precision=precision)
             jacobian_matrix = tf.stack([jacobian_matrix_x, jacobian_matrix_y, jacobian_matrix_z], axis=2)
             jacobian_matrix_2 = tf.stack([jacobian_matrix_2_x, jacobian_matrix_2_y, jacobian_matrix_2_z], axis=2)
             return jacobian_matrix, jacobian_matrix_2
         else:
-            jacobian_matrix_x = self.gradient(inputs, 0, precision=precision)[:, :, None, :]
-            jacobian_matrix_y = self.gradient(inputs, 1, precision=precision)[:, :, None, :]
-            jacobian_matrix_z = self.gradient(inputs, 2, precision=precision)[:, :, None, :]
+            jacobian_matrix_x = self.gradient(inputs, het, 0, precision=precision)[:, :, None, :]
+            jacobian_matrix_y = self.gradient(inputs, het, 1, precision=precision)[:, :, None, :]
+            jacobian_matrix_z = self.gradient(inputs, het, 2, precision=precision)[:, :, None, :]
             jacobian_matrix = tf.concat([jacobian_matrix_x, jacobian_matrix_y, jacobian_matrix_z], axis=2)
             return jacobian_matrix, None
 
-    # def compute_jacobian_finite_diff(self, deformation_field, mask_indices, grid_shape):
-    #     """
-    #     Compute the smoothness loss for a deformation field given the mask indices.
-    #
-    #     :param deformation_field: Tensor of shape (B, M, 3)
-    #     :param mask_indices: Tensor of shape (B, M, 3), contains the indices within the grid
-    #     :param grid_shape: Tuple representing the shape of the grid (H, W, D)
-    #     :return: Smoothness loss
-    #     """
-    #     B = tf.shape(deformation_field)[0]
-    #     M = tf.shape(deformation_field)[1]
-    #
-    #     # Compute central differences in the x, y, z directions
-    #     shifts = tf.constant([
-    #         [1, 0, 0], [-1, 0, 0],
-    #         [0, 1, 0], [0, -1, 0],
-    #         [0, 0, 1], [0, 0, -1]
-    #     ], dtype=tf.int32)
-    #
-    #     # Create neighbors by shifting mask_indices
-    #     mask_indices_expanded = tf.expand_dims(mask_indices, axis=2)  # Shape (B, M, 1, 3)
-    #     neighbors = mask_indices_expanded + shifts  # Shape (B, M, 6, 3)
-    #     neighbors = tf.clip_by_value(neighbors, 0, tf.constant(grid_shape) - 1)  # Ensure neighbors are within bounds
-    #
-    #     # Flatten the batch and point dimensions
-    #     batch_indices = tf.range(B, dtype=tf.int32)[:, tf.newaxis, tf.newaxis, tf.newaxis]
-    #     batch_indices = tf.tile(batch_indices, [1, M, 6, 1])  # Shape (B, M, 6, 1)
-    #
-    #     flat_neighbors = tf.reshape(neighbors, [-1, 3])  # Shape (B*M*6, 3)
-    #     flat_batch_indices = tf.reshape(batch_indices, [-1, 1])  # Shape (B*M*6, 1)
-    #
-    #     # Combine batch indices with neighbor indices
-    #     flat_neighbors_with_batch = tf.concat([flat_batch_indices, flat_neighbors], axis=1)
-    #
-    #     # Create a flat version of the deformation field
-    #     flat_deformation_field = tf.reshape(deformation_field, [B * M, 3])  # Shape (B*M, 3)
-    #
-    #     # Repeat the deformation field for each neighbor direction
-    #     deformation_field_repeated = tf.tile(flat_deformation_field, [6, 1])  # Shape (B*M*6, 3)
-    #
-    #     # Compute linear indices for gathering neighbors
-    #     neighbor_indices = flat_neighbors_with_batch[:, 1] * grid_shape[1] * grid_shape[2] + \
-    #                        flat_neighbors_with_batch[:, 2] * grid_shape[2] + \
-    #                        flat_neighbors_with_batch[:, 3]
-    #
-    #     # Gather neighbor values
-    #     neighbor_vals = tf.gather(deformation_field_repeated, neighbor_indices)
-    #     neighbor_vals = tf.reshape(neighbor_vals, [B, M, 6, 3])
-    #
-    #     # Calculate central differences
-    #     central_diffs = (neighbor_vals[:, :, ::2, :] - neighbor_vals[:, :, 1::2, :]) / 2.0  # Shape (B, M, 3, 3)
-    #
-    #     return central_diffs
+    def compute_jacobian_finite_diff(self, field, indices, second_derivative=False, precision=tf.float32):
+        """
+        Compute the Jacobian matrix of the field with central differences over the mask voxel neighbours.
+
+        :param field: Deformation field evaluated at every mask voxel with shape (B, C, 3)
+        :param indices: Indices of the voxels where the Jacobian is needed with shape (M,)
+        :return: Jacobian with shape (B, M, 3, 3) and (optionally) second derivatives with shape (B, M, 3, 3, 3)
+        """
+        def central_diffs(values, idx):
+            # values: (B, C, ...) --> derivatives (B, M, ..., 3)
+            neighbours = tf.gather(self.fd_neighbours, idx, axis=0)  # (M, 3, 2)
+            spacing = tf.cast(tf.gather(self.fd_spacing, idx, axis=0), precision)  # (M, 3)
+            values_pos = tf.gather(values, neighbours[..., 0], axis=1)  # (B, M, 3, ...)
+            values_neg = tf.gather(values, neighbours[..., 1], axis=1)
+            inv_spacing = tf.math.divide_no_nan(tf.ones_like(spacing), spacing)
+            inv_spacing = tf.reshape(inv_spacing, [1, -1, 3] + [1] * (values.shape.rank - 2))
+            diffs = (values_pos - values_neg) * inv_spacing
+            return tf.experimental.numpy.moveaxis(diffs, 2, -1)
+
+        field = tf.cast(field, precision)
+        jacobian_matrix = central_diffs(field, indices)
+
+        if second_derivative:
+            # Jacobians at the neighbours of the sampled voxels and their central differences
+            neighbours = tf.gather(self.fd_neighbours, indices, axis=0)
+            spacing = tf.cast(tf.gather(self.fd_spacing, indices, axis=0), precision)
+            jacobian_pos = central_diffs(field, tf.reshape(neighbours[..., 0], [-1]))
+            jacobian_neg = central_diffs(field, tf.reshape(neighbours[..., 1], [-1]))
+            B, M = tf.shape(field)[0], tf.shape(indices)[0]
+            jacobian_pos = tf.reshape(jacobian_pos, (B, M, 3, 3, 3))
+            jacobian_neg = tf.reshape(jacobian_neg, (B, M, 3, 3, 3))
+            inv_spacing = tf.math.divide_no_nan(tf.ones_like(spacing), spacing)
+            jacobian_matrix_2 = (jacobian_pos - jacobian_neg) * inv_spacing[None, :, :, None, None]
+            jacobian_matrix_2 = tf.transpose(jacobian_matrix_2, (0, 1, 3, 4, 2))
+            return jacobian_matrix, jacobian_matrix_2
+        else:
+            return jacobian_matrix, None
+
+    def compute_jacobian_hutchinson(self, inputs, het, second_derivative=False, precision=tf.float32):
+        """
+        Randomized (Hutchinson) estimate of the Jacobian trace and directional curvature of the field.
+
+        Forward mode products J v (and v^T H v) with a Rademacher probe v avoid building the full Jacobian.
+
+        :return: Trace estimate v^T J v with shape (B, M) and (optionally) v^T H v with shape (B, M, 3)
+        """
+        probe = tf.cast(2 * tf.random.uniform(tf.shape(inputs), 0, 2, dtype=tf.int32) - 1, inputs.dtype)
+        with tf.autodiff.ForwardAccumulator(inputs, probe) as acc_2:
+            with tf.autodiff.ForwardAccumulator(inputs, probe) as acc_1:
+                decoded, _ = self.field_delta_decoder([inputs, het])
+            jvp = tf.cast(acc_1.jvp(decoded), precision)
+        trace = tf.reduce_sum(tf.cast(probe, precision) * jvp, axis=-1)
+
+        if second_derivative:
+            return trace, tf.cast(acc_2.jvp(jvp), precision)
+        else:
+            return trace, None
+
+    def compute_jacobian(self, coords, het, field, indices, second_derivative=False, precision=tf.float32):
+        """Single Jacobian evaluation shared by all the physical regularizers (depends on jacobian_mode)."""
+        if self.jacobian_mode == "finite_diff":
+            return self.compute_jacobian_finite_diff(field, indices, second_derivative=second_derivative,
+                                                     precision=precision)
+
+        # Derivatives are needed per sample, so only the subset of coordinates is tiled
+        coords = tf.gather(coords, indices, axis=0)
+        inputs = tf.tile(coords[None, ...], (tf.shape(het)[0], 1, 1))
+
+        if self.jacobian_mode == "hutchinson":
+            return self.compute_jacobian_hutchinson(inputs, het, second_derivative=second_derivative,
+                                                    precision=precision)
+        else:
+            return self.compute_jacobian_autograd(inputs, het, second_derivative=second_derivative,
+                                                  precision=precision)
 
     def compute_jacobian_regularization(self, jacobians, precision=tf.float32):
         B, M = tf.shape(jacobians)[0], tf.shape(jacobians)[1]
@@ -1077,17 +1400,22 @@ class AutoEncoder(tf.keras.Model):
         E_rot = tf.reduce_mean(curl_x ** 2 + curl_y ** 2 + curl_z ** 2)
         return E_rot
 
-    def compute_field_loss(self, inputs, second_derivative=True, precision=tf.float32):
+    def compute_field_loss(self, coords, het, field, second_derivative=True, precision=tf.float32):
 
         # Better performance and memory saved
-        indices = tf.range(tf.shape(inputs)[1], dtype=tf.int32)
+        indices = tf.range(tf.shape(coords)[0], dtype=tf.int32)
         indices = tf.random.shuffle(indices)
         indices = indices[:1000]
-        inputs = tf.gather(inputs, indices, axis=1)
 
-        # Compute Jacobians
-        jacobians, jacobians_2 = self.compute_jacobian_autograd(inputs, second_derivative=second_derivative,
-                                                                precision=precision)
+        # Compute Jacobians (once for all the regularizers)
+        jacobians, jacobians_2 = self.compute_jacobian(coords, het, field, indices,
+                                                       second_derivative=second_derivative, precision=precision)
+
+        if self.jacobian_mode == "hutchinson":
+            # Linearized volume change (det(I + J) - 1 ~ tr(J)) and directional bending energy
+            jacobian_reg = tf.reduce_mean(tf.abs(jacobians))
+            bending_energy_reg = tf.reduce_mean(tf.square(jacobians_2)) if second_derivative else 0.0
+            return jacobian_reg + bending_energy_reg
 
         # Jacobian regularization
         jacobian_reg = self.compute_jacobian_regularization(jacobians, precision=precision)
@@ -1106,6 +1434,19 @@ class AutoEncoder(tf.keras.Model):
                                                                             self.generator.xsize *
                                                                             self.generator.xsize)
 
+    def image_loss(self, images, decoded, decoded_ctf, ctf):
+        if self.generator.fourier_loss:
+            # Opt-in loss on the padded Fourier transforms (one transform per image, CTF applied on the
+            # transform, no crop to the box)
+            ft_images = self.generator.fourierImages(images)
+            ft_decoded = self.generator.fourierImages(decoded)
+            if self.CTF == "apply":
+                ft_decoded = self.generator.ctfFilterFourier(ft_decoded, ctf)
+            return tf.cast(self.fourier_cost_function(ft_images, ft_decoded), self.precision)
+        else:
+            return tf.cast(self.cost_function(tf.cast(images, self.precision_scaled),
+                                              tf.cast(decoded_ctf, self.precision_scaled)), self.precision)
+
     def call(self, input_features):
         if allow_open3d and self.generator.ref_is_struct:
             # To know this weights exist
@@ -1122,11 +1463,7 @@ class AutoEncoder(tf.keras.Model):
             # _ = self.encoder_ctf(input_features)
 
             het = self.z_space(x)
-            het_tiled = tf.tile(het[:, None, :], (1, C, 1))
-            coords_tiled = tf.tile(self.generator.scaled_coords[None, :, :], (B, 1, 1))
-            coords_het = tf.concat([coords_tiled, het_tiled], axis=-1)
-
-            field, delta_volume = self.field_delta_decoder(coords_het)
+            field, delta_volume = self.field_delta_decoder([self.generator.scaled_coords, het])
             encoded = [tf.transpose(field, (1, 0, 2)), delta_volume,
                        self.delta_euler(euler), self.delta_shifts(shifts)]
         elif self.mode == "tomo":
@@ -1138,11 +1475,7 @@ class AutoEncoder(tf.keras.Model):
             # _ = self.encoder_ctf(input_features)
 
             het = self.z_space(latent)
-            het_tiled = tf.tile(het[:, None, :], (1, C, 1))
-            coords_tiled = tf.tile(self.generator.scaled_coords[None, :, :], (B, 1, 1))
-            coords_het = tf.concat([coords_tiled, het_tiled], axis=-1)
-
-            field = self.field_delta_decoder(coords_het)
+            field = self.field_delta_decoder([self.generator.scaled_coords, het])
             encoded = [tf.transpose(field, (1, 0, 2)), self.delta_euler(x), self.delta_shifts(x)]
 
         return self.phys_decoder([encoded, indexes])
@@ -35,8 +35,9 @@ from scipy import signal
 from xmipp_metadata.image_handler import ImageHandler
 from xmipp_metadata.metadata import XmippMetaData
 
-from tensorflow_toolkit.utils import computeCTF, full_fft_pad, full_ifft_pad, create_blur_filters, \
-    apply_blur_filters_to_batch
+from tensorflow_toolkit.utils import full_fft_pad, full_ifft_pad, create_blur_filters, \
+    apply_blur_filters_to_batch, create_blur_masks, apply_blur_masks_to_batch, accumulate_gradients, batch_summed, \
+    parse_remat_blocks, rematerialize, BatchContext
 from tensorflow_toolkit.layers.siren import SIRENFirstLayerInitializer, SIRENInitializer, MetaDenseWrapper, Sine
 
 
@@ -592,28 +593,40 @@ class Encoder(Model):
 
 
 class Decoder(Model):
-    def __init__(self, latent_dim, generator, CTF="apply", use_hyper_network=True):
+    def __init__(self, latent_dim, generator, CTF="apply", use_hyper_network=True, remat=()):
         super(Decoder, self).__init__()
         self.generator = generator
         self.CTF = CTF
+        self.remat_decoder = "decoder" in remat
+        remat_hypernet = "hypernet" in remat
+        remat_projection = "projection" in remat
         w0_first = 30.0 if generator.step == 1 else 30.0
 
+        # Projection and filters run in the generator precision (float32 for the bfloat16 policy)
+        precision = self.generator.precision
+
         rows = Input(shape=(3,))
         shifts = Input(shape=(2,))
         latent = Input(shape=(latent_dim,))
 
-        coords = layers.Lambda(self.generator.getRotatedGrid)(rows)
+        # Alignment and CTFs of the batch (BatchContext inputs, no weights)
+        pad_size = self.generator.pad_factor * self.generator.xsize
+        euler_batch = Input(shape=(3,))
+        shifts_batch = Input(shape=(2,))
+        ctf = Input(shape=(pad_size, int(0.5 * pad_size + 1)))
+
+        coords = layers.Lambda(self.generator.getRotatedGrid, dtype=precision)([rows, euler_batch])
 
         # Volume decoder
         count = 0
         if use_hyper_network:
             delta_het = MetaDenseWrapper(latent_dim, latent_dim, latent_dim, w0=w0_first,
                                          meta_kernel_initializer=SIRENFirstLayerInitializer(scale=6.0),
-                                         name=f"het_{count}")(latent)  # activation=Sine(w0=1.0)
+                                         remat=remat_hypernet, name=f"het_{count}")(latent)  # activation=Sine(w0=1.0)
             for _ in range(3):
                 count += 1
                 aux = MetaDenseWrapper(latent_dim, latent_dim, latent_dim, w0=1.0,
-                                       meta_kernel_initializer=SIRENInitializer(),
+                                       meta_kernel_initializer=SIRENInitializer(), remat=remat_hypernet,
                                        name=f"het_{count}")(delta_het)
                 delta_het = layers.Add()([delta_het, aux])
             count += 1
@@ -633,23 +646,29 @@ class Decoder(Model):
             delta_het = layers.Dense(self.generator.total_voxels, activation='linear',
                                      name=f"het_{count}", kernel_initializer=self.generator.weight_initializer)(delta_het)
 
+        # Volume update in the generator precision (the volume decoder layers may compute in bfloat16)
+        delta_het = layers.Activation('linear', dtype=precision)(delta_het)
+
         # Scatter image and bypass gradient
-        decoded_het = layers.Lambda(self.generator.scatterImgByPass)([coords, shifts, delta_het])
+        decoded_het, mask_imgs = layers.Lambda(rematerialize(self.generator.scatterImgByPass, remat_projection),
+                                               dtype=precision)([coords, shifts, delta_het, shifts_batch])
 
         # Gaussian filter image
-        decoded_het = layers.Lambda(self.generator.gaussianFilterImage)(decoded_het)
+        decoded_het = layers.Lambda(self.generator.gaussianFilterImage, dtype=precision)(decoded_het)
 
         # Soft threshold image
-        decoded_het = layers.Lambda(self.generator.softThresholdImage)(decoded_het)
+        decoded_het = layers.Lambda(self.generator.softThresholdImage, dtype=precision)(decoded_het)
 
         if self.CTF == "apply":
             # CTF filter image
-            decoded_het_ctf = layers.Lambda(self.generator.ctfFilterImage)(decoded_het)
+            decoded_het_ctf = layers.Lambda(lambda x: self.generator.ctfFilterImage(x[0], ctf=x[1]),
+                                            dtype=precision)([decoded_het, ctf])
         else:
             decoded_het_ctf = decoded_het
 
         self.decode_het = Model(latent, delta_het, name="decoder_het")
-        self.decoder = Model([rows, shifts, latent], [decoded_het, decoded_het_ctf, delta_het], name="decoder")
+        self.decoder = Model([rows, shifts, latent, euler_batch, shifts_batch, ctf],
+                             [decoded_het, decoded_het_ctf, delta_het, mask_imgs], name="decoder")
 
     def eval_volume_het(self, x_het, filter=True, only_pos=False):
         batch_size = x_het.shape[0]
@@ -658,10 +677,7 @@ class Decoder(Model):
 
         # Update values within mask
         if self.generator.isFocused:
-            flat_indices = tf.constant(self.generator.flat_indices, dtype=tf.int32)[:, None]
-            fn = lambda inp: tf.scatter_nd(flat_indices, inp, [self.generator.cube])
-            updates = tf.map_fn(fn, delta_het, fn_output_signature=tf.float32)
-            updates = tf.gather(updates, self.generator.mask, axis=1)
+            updates = self.generator.focusedUpdates(delta_het)
         else:
             updates = delta_het
 
@@ -697,8 +713,19 @@ class Decoder(Model):
 
         return volume_grids.astype(np.float32)
 
-    def call(self, x):
-        decoded = self.decoder(x)
+    def neutral_context(self, batch_size):
+        # No alignment, shifts nor CTF (only used to build the network)
+        pad_size = self.generator.pad_factor * self.generator.xsize
+        return BatchContext(tf.zeros([batch_size, 3]), tf.zeros([batch_size, 2]),
+                            tf.ones([batch_size, pad_size, int(0.5 * pad_size + 1)]))
+
+    def call(self, x, context=None):
+        # Outputs: projections, projections with CTF, volume updates and projection masks
+        if context is None:
+            context = self.neutral_context(tf.shape(x[2])[0])
+
+        # Whole decoder recomputed in the backward pass if rematerialized (only its inputs are stored)
+        decoded = rematerialize(self.decoder, self.remat_decoder)(list(x) + list(context))
         return decoded
 
 
@@ -706,10 +733,11 @@ class AutoEncoder(Model):
     def __init__(self, generator, het_dim=10, architecture="convnn", CTF="wiener", refPose=True,
                  l1_lambda=0.5, tv_lambda=0.5, mse_lambda=0.5, mode=None, train_size=None, only_pos=True,
                  multires_levels=None, poseReg=0.0, ctfReg=0.0, precision=tf.float32, precision_scaled=tf.float32,
-                 use_hyper_network=True, **kwargs):
+                 use_hyper_network=True, accum_steps=1, remat=None, **kwargs):
         super(AutoEncoder, self).__init__(**kwargs)
         self.precision = precision
         self.precision_scaled = precision_scaled
+        self.accum_steps = accum_steps
         self.CTF = CTF if generator.applyCTF == 1 else None
         self.mode = generator.mode if mode is None else mode
         metadata = XmippMetaData(str(generator.filename))
@@ -722,10 +750,12 @@ class AutoEncoder(Model):
         if ctfReg > 0.0:
             self.encoder_ctf = Encoder(het_dim, self.xsize, architecture=architecture,
                                        refPose=refPose, mode=self.mode)
-        self.latent = layers.Dense(het_dim, activation="linear")
-        self.rows = layers.Dense(3, activation="linear", trainable=refPose)
-        self.shifts = layers.Dense(2, activation="linear", trainable=refPose)
-        self.decoder = Decoder(het_dim, generator, CTF=CTF, use_hyper_network=use_hyper_network)
+        # Output heads in float32 (encoders may compute in a reduced precision, the decoder inputs do not)
+        self.latent = layers.Dense(het_dim, activation="linear", dtype=tf.float32)
+        self.rows = layers.Dense(3, activation="linear", trainable=refPose, dtype=tf.float32)
+        self.shifts = layers.Dense(2, activation="linear", trainable=refPose, dtype=tf.float32)
+        self.decoder = Decoder(het_dim, generator, CTF=CTF, use_hyper_network=use_hyper_network,
+                               remat=parse_remat_blocks(remat, ["decoder", "hypernet", "projection"]))
         self.refPose = 1.0 if refPose else 0.0
         self.l1_lambda = l1_lambda
         self.tv_lambda = tv_lambda
@@ -743,7 +773,8 @@ class AutoEncoder(Model):
         if multires_levels is None:
             self.filters = None
         else:
-            self.filters = tf.cast(create_blur_filters(multires_levels, 10, 30), self.precision)
+            # Blur filters as Fourier masks (all the levels from a single FFT per image)
+            self.filters = create_blur_masks(multires_levels, 10, 30, self.xsize)
         self.disantangle_pose = poseReg > 0.0
         self.disantangle_ctf = ctfReg > 0.0
         self.isFocused = generator.isFocused
@@ -753,6 +784,10 @@ class AutoEncoder(Model):
         self.loss_disantangle_tracker = tf.keras.metrics.Mean(name="loss_disentangled")
         self.loss_hist_tracker = tf.keras.metrics.Mean(name="loss_hist")
 
+        # Compiled predict functions (one per predict configuration)
+        self.predict_mode = "het"
+        self.predict_functions = {}
+
     @property
     def metrics(self):
         return [
@@ -763,7 +798,7 @@ class AutoEncoder(Model):
             self.loss_hist_tracker,
         ]
 
-    def train_step(self, data):
+    def compute_gradients(self, data):
         inputs = data[0]
 
         if self.mode == "spa":
@@ -775,47 +810,19 @@ class AutoEncoder(Model):
 
         images = tf.cast(images, self.precision)
 
-        self.decoder.generator.indexes = indexes
-        self.decoder.generator.current_images = images
-
         # Update batch_size (in case it is incomplete)
         batch_size_scope = tf.shape(images)[0]
 
-        # Precompute batch aligments
-        self.decoder.generator.rot_batch = tf.cast(tf.gather(self.decoder.generator.angle_rot, indexes, axis=0), self.precision)
-        self.decoder.generator.tilt_batch = tf.cast(tf.gather(self.decoder.generator.angle_tilt, indexes, axis=0), self.precision)
-        self.decoder.generator.psi_batch = tf.cast(tf.gather(self.decoder.generator.angle_psi, indexes, axis=0), self.precision)
-
-        # Precompute batch shifts
-        self.decoder.generator.shifts_batch = [tf.cast(tf.gather(self.decoder.generator.shift_x, indexes, axis=0), self.precision),
-                                               tf.cast(tf.gather(self.decoder.generator.shift_y, indexes, axis=0), self.precision)]
-
-        # Random permutations of angles and shifts
-        euler_batch = tf.stack([self.decoder.generator.rot_batch,
-                                self.decoder.generator.tilt_batch,
-                                self.decoder.generator.psi_batch], axis=1)
-        shifts_batch = tf.stack(self.decoder.generator.shifts_batch, axis=1)
-        euler_batch_perm = tf.random.shuffle(euler_batch)
-        shifts_batch_perm = tf.random.shuffle(shifts_batch)
-
-        # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.decoder.generator.defocusU, indexes, axis=0)
-        defocusV_batch = tf.gather(self.decoder.generator.defocusV, indexes, axis=0)
-        defocusAngle_batch = tf.gather(self.decoder.generator.defocusAngle, indexes, axis=0)
-        cs_batch = tf.gather(self.decoder.generator.cs, indexes, axis=0)
-        kv_batch = self.decoder.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.decoder.generator.sr, self.decoder.generator.pad_factor,
-                         [self.decoder.generator.xsize, int(0.5 * self.decoder.generator.xsize + 1)],
-                         batch_size_scope, self.decoder.generator.applyCTF)
-        self.decoder.generator.ctf = ctf
-
-        # Random permutations of CTF
-        ctf_perm = tf.random.shuffle(ctf)
+        # Alignment and CTFs of the batch
+        context = self.decoder.generator.batchContext(indexes)
+
+        # Random permutations of angles, shifts and CTF
+        context_perm = BatchContext(tf.random.shuffle(context.euler), tf.random.shuffle(context.shifts),
+                                    tf.random.shuffle(context.ctf))
 
         # Wiener filter
-        if self.CTF == "wiener":
-            images = self.decoder.generator.wiener2DFilter(images)
+        if self.CTF == "wiener" and not self.decoder.generator.wiener_pipeline:
+            images = self.decoder.generator.wiener2DFilter(images, ctf=context.ctf)
             if self.mode == "spa":
                 inputs = images
             elif self.mode == "tomo":
@@ -827,8 +834,8 @@ class AutoEncoder(Model):
             het, rows, shifts = self.latent(l_het), self.rows(l_rows), self.shifts(l_shifts)
 
             if self.mode == "spa":
-                decoded_het, decoded_het_ctf, delta_het = self.decoder(
-                    [self.refPose * rows, self.refPose * shifts, het])
+                decoded_het, decoded_het_ctf, delta_het, projection_mask = self.decoder(
+                    [self.refPose * rows, self.refPose * shifts, het], context)
 
                 if self.disantangle_pose:
                     # Forward pass (second encoder - no permutation)
@@ -839,34 +846,27 @@ class AutoEncoder(Model):
                     if self.disantangle_ctf and self.CTF is not None:
                         _, _, l_het_ctf, _ = self.encoder_ctf(decoded_het_ctf)
                         het_ctf = self.latent(l_het_ctf)
-                        self.decoder.generator.ctf = ctf_perm
-                        decoded_het_ctf_perm = self.decoder.generator.ctfFilterImage(decoded_het)
+                        decoded_het_ctf_perm = self.decoder.generator.ctfFilterImage(decoded_het, ctf=context_perm.ctf)
                         _, _, l_het_ctf_perm, _ = self.encoder_ctf(decoded_het_ctf_perm)
                         het_ctf_perm = self.latent(l_het_ctf_perm)
                     else:
                         het_ctf_perm = het
 
                     # Forward pass (second encoder - permutation)
-                    self.decoder.generator.rot_batch = euler_batch_perm[..., 0]
-                    self.decoder.generator.tilt_batch = euler_batch_perm[..., 1]
-                    self.decoder.generator.psi_batch = euler_batch_perm[..., 2]
-                    self.decoder.generator.shifts_batch = [shifts_batch_perm[..., 0], shifts_batch_perm[..., 1]]
-                    decoded_het, _, _ = self.decoder([self.refPose * rows, self.refPose * shifts, het])
+                    decoded_het, _, _, _ = self.decoder([self.refPose * rows, self.refPose * shifts, het], context_perm)
                     _, _, l_het_clean_perm, _ = self.encoder_clean(decoded_het)
                     het_clean_perm = self.latent(l_het_clean_perm)
 
             elif self.mode == "tomo":
                 het_label = self.latent(l_het_label)
-                decoded_het, decoded_het_ctf, delta_het = self.decoder([self.refPose * rows, self.refPose * shifts, het_label])
+                decoded_het, decoded_het_ctf, delta_het, projection_mask = self.decoder(
+                    [self.refPose * rows, self.refPose * shifts, het_label], context)
 
             # delta_het = self.decoder.decode_het(het)
 
             # Update values within mask
             if self.isFocused:
-                flat_indices = tf.constant(self.decoder.generator.flat_indices, dtype=tf.int32)[:, None]
-                fn = lambda inp: tf.scatter_nd(flat_indices, inp, [self.decoder.generator.cube])
-                updates = tf.map_fn(fn, delta_het, fn_output_signature=self.precision)
-                updates = tf.gather(updates, self.decoder.generator.mask, axis=1)
+                updates = self.decoder.generator.focusedUpdates(delta_het)
             else:
                 updates = delta_het
 
@@ -911,7 +911,7 @@ class AutoEncoder(Model):
             # pos_loss_het = self.l1_lambda * delta_pos / delta_pos_size
 
             # Reconstruction mask for projections (Decoder size)
-            mask_imgs = self.decoder.generator.resizeImageFourier(self.decoder.generator.mask_imgs,
+            mask_imgs = self.decoder.generator.resizeImageFourier(projection_mask,
                                                                   self.decoder.generator.xsize)
             mask_imgs = tf.abs(mask_imgs)
             mask_imgs = tf.math.divide_no_nan(mask_imgs, mask_imgs)
@@ -922,7 +922,7 @@ class AutoEncoder(Model):
                                                                         tf.cast(decoded_het_ctf, self.precision_scaled)), self.precision)
 
             # Reconstruction mask for projections (Train size)
-            mask_imgs = self.decoder.generator.resizeImageFourier(self.decoder.generator.mask_imgs, self.train_size)
+            mask_imgs = self.decoder.generator.resizeImageFourier(projection_mask, self.train_size)
             mask_imgs = tf.abs(mask_imgs)
             mask_imgs = tf.math.divide_no_nan(mask_imgs, mask_imgs)
 
@@ -934,8 +934,8 @@ class AutoEncoder(Model):
 
             # MR loss
             if self.filters is not None:
-                filt_images = apply_blur_filters_to_batch(images, self.filters)
-                filt_decoded = apply_blur_filters_to_batch(decoded_het_ctf, self.filters)
+                filt_images = apply_blur_masks_to_batch(images, self.filters)
+                filt_decoded = apply_blur_masks_to_batch(decoded_het_ctf, self.filters)
                 for idx in range(self.multires_levels):
                     loss_het_ori += tf.cast(self.decoder.generator.cost_function(tf.cast(filt_images, self.precision_scaled)[..., idx][..., None],
                                                                                  tf.cast(filt_decoded, self.precision_scaled)[..., idx][..., None]), self.precision)
@@ -975,12 +975,19 @@ class AutoEncoder(Model):
         # gradients = self.optimizer.get_unscaled_gradients(scaled_gradients)
         # self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
         grads = tape.gradient(total_loss, self.trainable_weights)
+        losses = {"loss": total_loss, "rec_loss": rec_loss,
+                  "loss_disentangled": loss_disantagled_pose + loss_disantagled_ctf, "loss_hist": hist_loss}
+        return [grads], losses, batch_summed(total_loss)
+
+    def train_step(self, data):
+        # Gradients of the whole batch (accumulated over micro batches if accum_steps > 1)
+        (grads,), losses = accumulate_gradients(self.compute_gradients, data, self.accum_steps)
         self.optimizer.apply_gradients(zip(grads, self.trainable_weights))
 
-        self.total_loss_tracker.update_state(total_loss)
-        self.loss_het_tracker.update_state(rec_loss)
-        self.loss_disantangle_tracker.update_state(loss_disantagled_pose + loss_disantagled_ctf)
-        self.loss_hist_tracker.update_state(hist_loss)
+        self.total_loss_tracker.update_state(losses["loss"])
+        self.loss_het_tracker.update_state(losses["rec_loss"])
+        self.loss_disantangle_tracker.update_state(losses["loss_disentangled"])
+        self.loss_hist_tracker.update_state(losses["loss_hist"])
         return {
             "loss": self.total_loss_tracker.result(),
             "rec_loss": self.loss_het_tracker.result(),
@@ -1000,51 +1007,19 @@ class AutoEncoder(Model):
 
         images = tf.cast(images, self.precision)
 
-        self.decoder.generator.indexes = indexes
-        self.decoder.generator.current_images = images
-
         # Update batch_size (in case it is incomplete)
         batch_size_scope = tf.shape(images)[0]
 
-        # Precompute batch aligments
-        self.decoder.generator.rot_batch = tf.cast(tf.gather(self.decoder.generator.angle_rot, indexes, axis=0),
-                                                   self.precision)
-        self.decoder.generator.tilt_batch = tf.cast(tf.gather(self.decoder.generator.angle_tilt, indexes, axis=0),
-                                                    self.precision)
-        self.decoder.generator.psi_batch = tf.cast(tf.gather(self.decoder.generator.angle_psi, indexes, axis=0),
-                                                   self.precision)
-
-        # Precompute batch shifts
-        self.decoder.generator.shifts_batch = [
-            tf.cast(tf.gather(self.decoder.generator.shift_x, indexes, axis=0), self.precision),
-            tf.cast(tf.gather(self.decoder.generator.shift_y, indexes, axis=0), self.precision)]
-
-        # Random permutations of angles and shifts
-        euler_batch = tf.stack([self.decoder.generator.rot_batch,
-                                self.decoder.generator.tilt_batch,
-                                self.decoder.generator.psi_batch], axis=1)
-        shifts_batch = tf.stack(self.decoder.generator.shifts_batch, axis=1)
-        euler_batch_perm = tf.random.shuffle(euler_batch)
-        shifts_batch_perm = tf.random.shuffle(shifts_batch)
-
-        # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.decoder.generator.defocusU, indexes, axis=0)
-        defocusV_batch = tf.gather(self.decoder.generator.defocusV, indexes, axis=0)
-        defocusAngle_batch = tf.gather(self.decoder.generator.defocusAngle, indexes, axis=0)
-        cs_batch = tf.gather(self.decoder.generator.cs, indexes, axis=0)
-        kv_batch = self.decoder.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.decoder.generator.sr, self.decoder.generator.pad_factor,
-                         [self.decoder.generator.xsize, int(0.5 * self.decoder.generator.xsize + 1)],
-                         batch_size_scope, self.decoder.generator.applyCTF)
-        self.decoder.generator.ctf = ctf
-
-        # Random permutations of CTF
-        ctf_perm = tf.random.shuffle(ctf)
+        # Alignment and CTFs of the batch
+        context = self.decoder.generator.batchContext(indexes)
+
+        # Random permutations of angles, shifts and CTF
+        context_perm = BatchContext(tf.random.shuffle(context.euler), tf.random.shuffle(context.shifts),
+                                    tf.random.shuffle(context.ctf))
 
         # Wiener filter
-        if self.CTF == "wiener":
-            images = self.decoder.generator.wiener2DFilter(images)
+        if self.CTF == "wiener" and not self.decoder.generator.wiener_pipeline:
+            images = self.decoder.generator.wiener2DFilter(images, ctf=context.ctf)
             if self.mode == "spa":
                 inputs = images
             elif self.mode == "tomo":
@@ -1055,8 +1030,8 @@ class AutoEncoder(Model):
         het, rows, shifts = self.latent(l_het), self.rows(l_rows), self.shifts(l_shifts)
 
         if self.mode == "spa":
-            decoded_het, decoded_het_ctf, delta_het = self.decoder(
-                [self.refPose * rows, self.refPose * shifts, het])
+            decoded_het, decoded_het_ctf, delta_het, projection_mask = self.decoder(
+                [self.refPose * rows, self.refPose * shifts, het], context)
 
             if self.disantangle_pose:
                 # Forward pass (second encoder - no permutation)
@@ -1067,35 +1042,27 @@ class AutoEncoder(Model):
                 if self.disantangle_ctf and self.CTF is not None:
                     _, _, l_het_ctf, _ = self.encoder_ctf(decoded_het_ctf)
                     het_ctf = self.latent(l_het_ctf)
-                    self.decoder.generator.ctf = ctf_perm
-                    decoded_het_ctf_perm = self.decoder.generator.ctfFilterImage(decoded_het)
+                    decoded_het_ctf_perm = self.decoder.generator.ctfFilterImage(decoded_het, ctf=context_perm.ctf)
                     _, _, l_het_ctf_perm, _ = self.encoder_ctf(decoded_het_ctf_perm)
                     het_ctf_perm = self.latent(l_het_ctf_perm)
                 else:
                     het_ctf_perm = het
 
                 # Forward pass (second encoder - permutation)
-                self.decoder.generator.rot_batch = euler_batch_perm[..., 0]
-                self.decoder.generator.tilt_batch = euler_batch_perm[..., 1]
-                self.decoder.generator.psi_batch = euler_batch_perm[..., 2]
-                self.decoder.generator.shifts_batch = [shifts_batch_perm[..., 0], shifts_batch_perm[..., 1]]
-                decoded_het, _, _ = self.decoder([self.refPose * rows, self.refPose * shifts, het])
+                decoded_het, _, _, _ = self.decoder([self.refPose * rows, self.refPose * shifts, het], context_perm)
                 _, _, l_het_clean_perm, _ = self.encoder_clean(decoded_het)
                 het_clean_perm = self.latent(l_het_clean_perm)
 
         elif self.mode == "tomo":
             het_label = self.latent(l_het_label)
-            decoded_het, decoded_het_ctf, delta_het = self.decoder(
-                [self.refPose * rows, self.refPose * shifts, het_label])
+            decoded_het, decoded_het_ctf, delta_het, projection_mask = self.decoder(
+                [self.refPose * rows, self.refPose * shifts, het_label], context)
 
         # delta_het = self.decoder.decode_het(het)
 
         # Update values within mask
         if self.isFocused:
-            flat_indices = tf.constant(self.decoder.generator.flat_indices, dtype=tf.int32)[:, None]
-            fn = lambda inp: tf.scatter_nd(flat_indices, inp, [self.decoder.generator.cube])
-            updates = tf.map_fn(fn, delta_het, fn_output_signature=self.precision)
-            updates = tf.gather(updates, self.decoder.generator.mask, axis=1)
+            updates = self.decoder.generator.focusedUpdates(delta_het)
         else:
             updates = delta_het
 
@@ -1145,7 +1112,7 @@ class AutoEncoder(Model):
         # pos_loss_het = self.l1_lambda * delta_pos / delta_pos_size
 
         # Reconstruction mask for projections (Decoder size)
-        mask_imgs = self.decoder.generator.resizeImageFourier(self.decoder.generator.mask_imgs,
+        mask_imgs = self.decoder.generator.resizeImageFourier(projection_mask,
                                                               self.decoder.generator.xsize)
         mask_imgs = tf.abs(mask_imgs)
         mask_imgs = tf.math.divide_no_nan(mask_imgs, mask_imgs)
@@ -1157,7 +1124,7 @@ class AutoEncoder(Model):
                                self.precision)
 
         # Reconstruction mask for projections (Train size)
-        mask_imgs = self.decoder.generator.resizeImageFourier(self.decoder.generator.mask_imgs, self.train_size)
+        mask_imgs = self.decoder.generator.resizeImageFourier(projection_mask, self.train_size)
         mask_imgs = tf.abs(mask_imgs)
         mask_imgs = tf.math.divide_no_nan(mask_imgs, mask_imgs)
 
@@ -1170,8 +1137,8 @@ class AutoEncoder(Model):
 
         # MR loss
         if self.filters is not None:
-            filt_images = apply_blur_filters_to_batch(images, self.filters)
-            filt_decoded = apply_blur_filters_to_batch(decoded_het_ctf, self.filters)
+            filt_images = apply_blur_masks_to_batch(images, self.filters)
+            filt_decoded = apply_blur_masks_to_batch(decoded_het_ctf, self.filters)
             for idx in range(self.multires_levels):
                 loss_het_ori += tf.cast(
                     self.decoder.generator.cost_function(tf.cast(filt_images, self.precision_scaled)[..., idx][..., None],
@@ -1224,20 +1191,9 @@ class AutoEncoder(Model):
         }
 
     def eval_encoder(self, x):
-        # Precompute batch aligments
-        self.decoder.generator.rot_batch = x[1]
-        self.decoder.generator.tilt_batch = x[1]
-        self.decoder.generator.psi_batch = x[1]
-
-        # Precompute batch shifts
-        self.decoder.generator.shifts_batch = [x[2][:, 0], x[2][:, 1]]
-
-        # Precompute batch CTFs
-        self.decoder.generator.ctf = x[3]
-
-        # Wiener filter
+        # Wiener filter (x[3] are the CTFs of the batch)
         if self.CTF == "wiener":
-            x[0] = self.decoder.generator.wiener2DFilter(x[0])
+            x[0] = self.decoder.generator.wiener2DFilter(x[0], ctf=x[3])
 
         l_rot, l_shifts, l_het = self.encoder_exp(x[0])
         het, rot, shifts = self.latent(l_het), self.rows(l_rot), self.shifts(l_shifts)
@@ -1279,10 +1235,23 @@ class AutoEncoder(Model):
 
         return volume
 
+    def compile(self, *args, **kwargs):
+        super().compile(*args, **kwargs)
+
+        # Compile options (e.g. jit_compile) change the predict functions
+        self.predict_functions = {}
+
+    def predict_key(self):
+        # Configuration read by predict_step while tracing (applyCTF is not, the CTF is fixed by the decoder)
+        return self.predict_mode
+
     def predict(self, data, predict_mode="het", applyCTF=False):
         self.predict_mode, self.applyCTF = predict_mode, applyCTF
-        self.predict_function = None
+
+        # Reuse the predict function of this configuration (only traced again for new input signatures)
+        self.predict_function = self.predict_functions.get(self.predict_key())
         decoded = super().predict(data)
+        self.predict_functions[self.predict_key()] = self.predict_function
         return decoded
 
     def predict_step(self, data):
@@ -1295,47 +1264,17 @@ class AutoEncoder(Model):
             indexes = data[1][0]
             images = inputs[0]
 
-        self.decoder.generator.indexes = indexes
-        self.decoder.generator.current_images = images
-
-        # Update batch_size (in case it is incomplete)
-        batch_size_scope = tf.shape(images)[0]
-
-        # Precompute batch aligments
-        self.decoder.generator.rot_batch = tf.gather(self.decoder.generator.angle_rot, indexes, axis=0)
-        self.decoder.generator.tilt_batch = tf.gather(self.decoder.generator.angle_tilt, indexes, axis=0)
-        self.decoder.generator.psi_batch = tf.gather(self.decoder.generator.angle_psi, indexes, axis=0)
-
-        # Precompute batch shifts
-        self.decoder.generator.shifts_batch = [tf.gather(self.decoder.generator.shift_x, indexes, axis=0),
-                                               tf.gather(self.decoder.generator.shift_y, indexes, axis=0)]
-
-        # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.decoder.generator.defocusU, indexes, axis=0)
-        defocusV_batch = tf.gather(self.decoder.generator.defocusV, indexes, axis=0)
-        defocusAngle_batch = tf.gather(self.decoder.generator.defocusAngle, indexes, axis=0)
-        cs_batch = tf.gather(self.decoder.generator.cs, indexes, axis=0)
-        kv_batch = self.decoder.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.decoder.generator.sr, self.decoder.generator.pad_factor,
-                         [self.decoder.generator.xsize, int(0.5 * self.decoder.generator.xsize + 1)],
-                         batch_size_scope, self.decoder.generator.applyCTF)
-        self.decoder.generator.ctf = ctf
+        # Alignment and CTFs of the batch
+        context = self.decoder.generator.batchContext(indexes)
 
         # Wiener filter
         if self.CTF == "wiener":
-            images = self.decoder.generator.wiener2DFilter(images)
+            images = self.decoder.generator.wiener2DFilter(images, ctf=context.ctf)
             if self.mode == "spa":
                 inputs = images
             elif self.mode == "tomo":
                 inputs[0] = images
 
-        # Predict images with CTF applied?
-        if self.applyCTF == 1:
-            self.decoder.generator.CTF = "apply"
-        else:
-            self.decoder.generator.CTF = None
-
         if self.predict_mode == "het":
             l_rot, l_shifts, l_het, l_l_het = self.encoder_exp(inputs)
             if self.mode == "spa":
@@ -1348,9 +1287,9 @@ class AutoEncoder(Model):
             l_rot, l_shifts, l_het, _ = self.encoder_exp(inputs)
             het, rot, shifts = self.latent(l_het), self.rows(l_rot), self.shifts(l_shifts)
             if "ctf" in self.predict_mode:
-                return self.decoder([rot, shifts, het])[1]
+                return self.decoder([rot, shifts, het], context)[1]
             else:
-                return self.decoder([rot, shifts, het])[0]
+                return self.decoder([rot, shifts, het], context)[0]
         else:
             raise ValueError("Prediction mode not understood!")
 
@@ -34,8 +34,9 @@ import numpy as np
 from scipy.ndimage import gaussian_filter
 import scipy.stats as st
 
-from tensorflow_toolkit.utils import computeCTF, gramSchmidt, euler_matrix_batch, full_fft_pad, full_ifft_pad, \
-    quaternion_to_rotation_matrix
+from tensorflow_toolkit.utils import gramSchmidt, euler_matrix_batch, full_fft_pad, full_ifft_pad, \
+    quaternion_to_rotation_matrix, FourierSliceProjector, create_blur_masks, apply_blur_masks_to_batch, \
+    accumulate_gradients, batch_summed
 from tensorflow_toolkit.layers.siren import Sine, SIRENFirstLayerInitializer, SIRENInitializer
 
 
@@ -199,48 +200,6 @@ def densitySmoothnessVolume(xsize, indices, values):
             mse_smoothness_loss(grid, pixel_diff1, pixel_diff2, pixel_diff3))
 
 
-def connected_component_penalty(xsize, indices, values):
-    threshold = tf.reduce_max(values)
-
-    grid = tf.zeros((1, xsize, xsize, xsize), dtype=tf.float32)
-    indices = tf.cast(indices[None, ...], dtype=tf.int32)
-
-    # Scatter in volumes
-    fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-    grid = tf.map_fn(fn, [grid, indices, values], fn_output_signature=tf.float32)[0, ..., None]
-
-    # Step 1: Threshold the prediction to get a binary mask
-    binary_mask = tf.cast(grid > threshold, tf.float32)
-
-    # Step 2: Create 3D convolution filters to detect connected components
-    kernel = tf.constant(
-        [[[[[0.0, 1.0, 0.0],
-            [1.0, 1.0, 1.0],
-            [0.0, 1.0, 0.0]],
-
-           [[1.0, 1.0, 1.0],
-            [1.0, 0.0, 1.0],
-            [1.0, 1.0, 1.0]],
-
-           [[0.0, 1.0, 0.0],
-            [1.0, 1.0, 1.0],
-            [0.0, 1.0, 0.0]]]]], dtype=tf.float32)
-
-    # Apply the convolution to count neighbors
-    convolved = tf.nn.conv3d(binary_mask, kernel, strides=[1, 1, 1, 1, 1], padding='SAME')
-
-    # Step 3: Create a mask for isolated components (no neighbors)
-    isolated_components = tf.cast(convolved < 1.5, tf.float32) * binary_mask
-
-    # Sum to find number of isolated components (loosely connected components)
-    num_isolated_components = tf.reduce_sum(isolated_components)
-
-    # Step 4: Penalize more than one component
-    penalty = tf.maximum(0.0, num_isolated_components - 1)
-
-    return penalty
-
-
 def diversity_loss(y_pred, alpha=1.0):
     # Calculate the mean of the predictions
     mean_pred = tf.reduce_mean(y_pred, axis=0)
@@ -253,39 +212,39 @@ def diversity_loss(y_pred, alpha=1.0):
     return alpha * diversity_loss
 
 
-def safe_acos(x):
-    """
-    A safe version of tf.acos to avoid NaN values due to numerical issues.
-    Clips the input to be within the valid range [-1, 1].
+def fibonacci_sphere(n_points):
     """
-    return tf.acos(tf.clip_by_value(x, -1.0 + 1e-7, 1.0 - 1e-7))
+    Approximately uniform set of points on the unit sphere (Fibonacci lattice).
 
+    Args:
+    - n_points: Number of points.
 
-def uniform_distribution_loss(vectors):
-    """
-    Loss to encourage uniform distribution of pairs of vectors on a sphere.
-    `vectors` is assumed to be of shape [batch_size, 3], where each row contains two 3D vectors.
+    Returns:
+    - A numpy array with shape (n_points, 3).
     """
-    batch_size = tf.shape(vectors)[0]
-    batch_size_f = tf.cast(batch_size, tf.float32)
+    idx = np.arange(n_points) + 0.5
+    phi = np.arccos(1.0 - 2.0 * idx / n_points)
+    theta = np.pi * (1.0 + 5.0 ** 0.5) * idx
+    return np.stack([np.cos(theta) * np.sin(phi), np.sin(theta) * np.sin(phi), np.cos(phi)], axis=1)
 
-    # Compute the cosine similarity between each pair of vectors
-    cosine_similarity = tf.matmul(vectors, vectors, transpose_b=True)
 
-    # Angular distance (in radians) between vectors
-    angular_distances = safe_acos(cosine_similarity)
-
-    # Repulsion term: Use an inverse square law-like term for repulsion
-    # Add a small epsilon to the angular distances to avoid division by zero
-    epsilon = 1e-4
-    repulsion = 1 / (angular_distances + epsilon)
+def uniform_distribution_loss(vectors, n_bins=64, kappa=10.0):
+    """
+    Loss to encourage uniform distribution of vectors on a sphere.
+    `vectors` is assumed to be of shape [batch_size, 3]. The vectors are softly binned into a fixed set
+    of directions on the sphere, so the cost grows linearly with the batch size (O(B * n_bins)). The loss is
+    scaled to grow with the concentration of the directions like the pairwise repulsion loss it replaces,
+    so previous ud_lambda values remain valid.
+    """
+    bins = tf.constant(fibonacci_sphere(n_bins), dtype=tf.float32)
+    vectors = tf.linalg.l2_normalize(vectors, axis=-1)
 
-    # Mask the diagonal (self-repulsion) because it's always zero and not meaningful
-    mask = 1.0 - tf.eye(batch_size)
-    repulsion *= mask
+    # Soft assignment of each vector to the bins
+    assignment = tf.nn.softmax(kappa * tf.matmul(vectors, bins, transpose_b=True), axis=-1)
 
-    # Summing up the repulsion terms and normalizing
-    loss = tf.reduce_sum(repulsion) / (batch_size_f * (batch_size_f - 1.0))
+    # Occupancy histogram and deviation from the uniform one
+    histogram = tf.reduce_mean(assignment, axis=0)
+    loss = 0.5 * float(n_bins) * tf.reduce_sum(tf.square(histogram - 1.0 / n_bins))
 
     return loss
 
@@ -413,25 +372,27 @@ class HeadEncoder(Model):
         rows = layers.Dense(1024, activation="relu")(x)
         for _ in range(3):
             rows = layers.Dense(1024, activation="relu")(rows)
+        # Output heads in float32 (hidden layers may compute in a reduced precision, the projector does not)
         if refinement:
             if useQuaternions:
                 rows = layers.Dense(4, activation="linear", kernel_initializer=Zeros(),
-                                    bias_initializer=Constant(bias_values))(rows)
-                rows = QuaternionLayer()(rows)
+                                    bias_initializer=Constant(bias_values), dtype=tf.float32)(rows)
+                rows = QuaternionLayer(dtype=tf.float32)(rows)
             else:
                 rows = layers.Dense(6, activation="linear", kernel_initializer=Zeros(),
-                                    bias_initializer=Constant(bias_values))(rows)
+                                    bias_initializer=Constant(bias_values), dtype=tf.float32)(rows)
         else:
             if useQuaternions:
-                rows = layers.Dense(4, activation="linear")(rows)
-                rows = QuaternionLayer()(rows)
+                rows = layers.Dense(4, activation="linear", dtype=tf.float32)(rows)
+                rows = QuaternionLayer(dtype=tf.float32)(rows)
             else:
-                rows = layers.Dense(6, activation="linear")(rows)
+                rows = layers.Dense(6, activation="linear", dtype=tf.float32)(rows)
 
         shifts = layers.Dense(1024, activation="relu")(x)
         for _ in range(3):
             shifts = layers.Dense(1024, activation="relu")(shifts)
-        shifts = layers.Dense(2, activation="linear", kernel_initializer=RandomNormal(stddev=0.0001))(shifts)
+        shifts = layers.Dense(2, activation="linear", kernel_initializer=RandomNormal(stddev=0.0001),
+                              dtype=tf.float32)(shifts)
 
         self.encoder = tf.keras.Model(x, [rows, shifts])
 
@@ -485,7 +446,7 @@ class HetEncoder(Model):
         latent = layers.Dense(256, activation="relu")(x)
         for _ in range(2):
             latent = layers.Dense(256, activation="relu")(latent)
-        latent = layers.Dense(latDim, activation="linear")(latent)
+        latent = layers.Dense(latDim, activation="linear", dtype=tf.float32)(latent)
 
         self.encoder = tf.keras.Model(images, latent)
 
@@ -509,9 +470,9 @@ class Decoder(Model):
             delta_vol = layers.Dense(10, activation=Sine(w0=1.0),
                                      kernel_initializer=SIRENInitializer(c=1.0))(delta_vol)
         if not only_pos:
-            delta_vol = layers.Dense(total_voxels, activation='linear')(delta_vol)  # If input volume, give near zero init?
+            delta_vol = layers.Dense(total_voxels, activation='linear', dtype=tf.float32)(delta_vol)  # If input volume, give near zero init?
         else:
-            delta_vol = layers.Dense(total_voxels, activation='relu')(delta_vol)  # For classes works fine
+            delta_vol = layers.Dense(total_voxels, activation='relu', dtype=tf.float32)(delta_vol)  # For classes works fine
 
         self.decoder = tf.keras.Model(coords, delta_vol)
 
@@ -533,7 +494,7 @@ class HetDecoder(Model):
                                kernel_initializer=SIRENInitializer())(latent)
             delta_het = layers.Add()([delta_het, aux])
         delta_het = layers.Dense(generator.total_voxels, activation="linear",
-                                 kernel_initializer=RandomUniform(-1e-5, 1e-5))(delta_het)
+                                 kernel_initializer=RandomUniform(-1e-5, 1e-5), dtype=tf.float32)(delta_het)
 
         self.delta_decoder = tf.keras.Model(latent, delta_het)
 
@@ -546,7 +507,8 @@ class AutoEncoder(Model):
     def __init__(self, generator, architecture="convnn", CTF="wiener",
                  l1_lambda=0.1, multires=None, tv_lambda=0.5, mse_lambda=0.5,
                  ud_lambda=0.000001, un_lambda=0.0001, useQuaternions=False,
-                 only_pos=True, only_pose=False, n_candidates=6, useHet=False, latDim=8, **kwargs):
+                 only_pos=True, only_pose=False, n_candidates=6, useHet=False, latDim=8, projector="real",
+                 accum_steps=1, **kwargs):
         super(AutoEncoder, self).__init__(**kwargs)
         self.CTF = CTF if generator.applyCTF == 1 else None
         self.applyCTF = bool(generator.applyCTF)
@@ -568,7 +530,15 @@ class AutoEncoder(Model):
         if multires is None:
             self.filters = None
         else:
-            self.filters = create_blur_filters(multires, 10, 30)
+            # Blur filters as Fourier masks (all the levels from a single FFT per image)
+            self.filters = create_blur_masks(multires, 10, 30, generator.xsize)
+
+        # Projection backend ("real": scatter voxels in real space, "fourier": Fourier slice theorem)
+        self.projector = projector
+        if projector == "fourier":
+            indices = np.round(generator.coords * generator.scale_factor + generator.xmipp_origin).astype(int)
+            self.fourier_projector = FourierSliceProjector(generator.xsize, indices[:, ::-1],
+                                                           pad_factor=generator.pad_factor, sigma=1.0)
 
         self.generator = generator
         self.xsize = generator.xsize
@@ -579,6 +549,7 @@ class AutoEncoder(Model):
         self.un_lambda = un_lambda
         self.only_pos = only_pos
         self.only_pose = only_pose
+        self.accum_steps = accum_steps
         if only_pose:
             self.cost = correlation_coefficient_loss
         else:
@@ -594,31 +565,8 @@ class AutoEncoder(Model):
         ]
 
     def prepare_batch(self, indexes):
-        # Update batch_size (in case it is incomplete)
-        batch_size_scope = tf.shape(indexes)[0]
-
-        if self.generator.refinement:
-            # Precompute batch alignments
-            self.generator.rot_batch = tf.gather(self.generator.angle_rot, indexes, axis=0)
-            self.generator.tilt_batch = tf.gather(self.generator.angle_tilt, indexes, axis=0)
-            self.generator.psi_batch = tf.gather(self.generator.angle_psi, indexes, axis=0)
-
-            # Precompute shifts
-            shifts_x = tf.gather(self.generator.shifts[0], indexes, axis=0)
-            shifts_y = tf.gather(self.generator.shifts[1], indexes, axis=0)
-            self.generator.shifts_batch = tf.stack([shifts_x, shifts_y], axis=1)
-
-        # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.generator.defocusU, indexes, axis=0)
-        defocusV_batch = tf.gather(self.generator.defocusV, indexes, axis=0)
-        defocusAngle_batch = tf.gather(self.generator.defocusAngle, indexes, axis=0)
-        cs_batch = tf.gather(self.generator.cs, indexes, axis=0)
-        kv_batch = self.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.generator.sr, self.generator.pad_factor,
-                         [self.generator.xsize, int(0.5 * self.generator.xsize + 1)],
-                         batch_size_scope, self.generator.applyCTF)
-        self.generator.ctf = ctf
+        # Alignment (only used for refinement) and CTFs of the batch
+        return self.generator.batchContext(indexes)
 
     def compile(self, e_optimizer, d_optimizer, het_optimizer, jit_compile=False):
         super().compile(jit_compile=jit_compile)
@@ -626,7 +574,7 @@ class AutoEncoder(Model):
         self.d_optimizer = d_optimizer
         self.het_optimizer = het_optimizer
 
-    def decode_images_with_loss(self, images, images_corrected):
+    def decode_images_with_loss(self, images, images_corrected, context, filt_images=None):
         B = tf.shape(images)[0]
 
         # Original coordinates
@@ -646,8 +594,40 @@ class AutoEncoder(Model):
         else:
             delta = 0.0
 
-        # Coordinates with batch dimension
-        o = self.generator.scale_factor * tf.tile(o, (B, 1, 1))
+        # Symmetry invariant quantities (computed once per step)
+        noSym = self.generator.noSym
+        sym_t = tf.transpose(self.generator.sym_matrices, perm=[0, 2, 1])[:, None, ...]  # (S, 1, 3, 3)
+        if self.generator.refinement:
+            r_o = euler_matrix_batch(context.euler[:, 0], context.euler[:, 1], context.euler[:, 2])
+            r_o = tf.stack(r_o, axis=1)
+            r_o = tf.matmul(r_o[None, ...], sym_t)  # (S, B, 3, 3)
+
+        if self.projector == "fourier":
+            # Fourier transform of the consensus volume (shared by all the particles and symmetry copies)
+            ft_volume = self.fourier_projector.volumeFourier(tf.cast(self.generator.values[None, :], tf.float32)
+                                                             + delta)
+        else:
+            # Image values (symmetry copies share the same volume)
+            original_values = tf.tile(self.generator.values[None, :], (B, 1))
+            values_sym = tf.tile((tf.cast(original_values, tf.float32) + delta)[None, ...], (noSym, 1, 1))
+            values_sym = tf.reshape(values_sym, [noSym * B, -1])
+
+            # Batch index of each symmetry copy (for a single fused scatter)
+            batch_idx = tf.tile(tf.range(noSym * B)[:, None, None], (1, self.generator.total_voxels, 1))
+
+        # Experimental images and CTFs expanded to the symmetry copies
+        images_sym = tf.tile(images, (noSym, 1, 1, 1))
+        if self.applyCTF:
+            # CTFs are fftshifted along all axes (batch included), so they are unshifted before tiling
+            ctf_sym = tf.tile(tf.signal.ifftshift(context.ctf), (noSym, 1, 1))
+            ctf_sym = tf.signal.fftshift(ctf_sym)
+        if self.multires is not None:
+            if filt_images is None:
+                filt_images = apply_blur_masks_to_batch(images_corrected, self.filters)
+            filt_images = tf.tile(filt_images, (noSym, 1, 1, 1))
+
+        # Coordinates with symmetry and batch broadcasting dimensions
+        o = self.generator.scale_factor * o[None, ...]  # (1, 1, N, 3)
 
         for idr in range(self.n_candidates):
             rows, shifts = self.head_encoder[idr](encoded)
@@ -659,52 +639,39 @@ class AutoEncoder(Model):
                 r_no_sym = gramSchmidt(rows)
 
             if self.generator.refinement:
-                shifts = shifts + self.generator.shifts_batch
-
-            # Symmetry loop
-            loss_rec = 0.0
-            for iSym in range(self.generator.noSym):
-                # Prepare symmetry matrix
-                R = tf.tile(self.generator.sym_matrices[iSym][None, ...], (B, 1, 1))
-
-                # Apply symmetrix matrix
-                r = tf.matmul(r_no_sym, tf.transpose(R, perm=[0, 2, 1]))
-
-                if self.generator.refinement:
-                    r_o = euler_matrix_batch(self.generator.rot_batch, self.generator.tilt_batch, self.generator.psi_batch)
-                    r_o = tf.stack(r_o, axis=1)
-                    r_o = tf.matmul(r_o, tf.transpose(R, perm=[0, 2, 1]))
-                    r = tf.matmul(r, r_o)
+                shifts = shifts + context.shifts
 
-                # Get rotated coords
-                ro = tf.matmul(o, tf.transpose(r, perm=[0, 2, 1]))
+            # Apply all symmetry matrices at once
+            r = tf.matmul(r_no_sym[None, ...], sym_t)  # (S, B, 3, 3)
+            if self.generator.refinement:
+                r = tf.matmul(r, r_o)
 
-                # Get XY coords
-                ro = ro[..., :-1]
+            if self.projector == "fourier":
+                # Central slices (CTF is applied in Fourier space)
+                interpolation = self.fourier_projector.interpolationWeights(tf.reshape(r, [-1, 3, 3]))
+                imgs = self.fourier_projector.project(ft_volume, interpolation, shifts=tf.tile(shifts, (noSym, 1)),
+                                                      ctf=ctf_sym if self.applyCTF else None)
+            else:
+                # Get rotated XY coords (only the first two rows of the rotation are needed)
+                ro = tf.matmul(o, tf.transpose(r[..., :-1, :], perm=[0, 1, 3, 2]))  # (S, B, N, 2)
 
                 # Apply shifts
-                ro = ro - (shifts[:, None, :]) + self.generator.xmipp_origin[0]
+                ro = ro - (shifts[None, :, None, :]) + self.generator.xmipp_origin[0]
 
                 # Permute coords
                 ro = tf.stack([ro[..., 1], ro[..., 0]], axis=-1)
-
-                # Initialize images
-                imgs = tf.zeros((B, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
-
-                # Image values
-                original_values = tf.tile(self.generator.values[None, :], (B, 1))
-                values = tf.cast(original_values, tf.float32) + delta
+                ro = tf.reshape(ro, [noSym * B, -1, 2])
 
                 # Backprop through coords
                 bpos_round = tf.round(ro)
                 bpos_flow = tf.cast(bpos_round, tf.int32)
                 num = tf.reduce_sum(((bpos_round - ro) ** 2.), axis=-1)
                 weight = tf.exp(-num / (2. * 1. ** 2.))
-                values = values * weight
+                values = values_sym * weight
 
-                # Scatter images
-                fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-                imgs = tf.map_fn(fn, [imgs, bpos_flow, values], fn_output_signature=tf.float32)
+                # Scatter images (all symmetry copies in one call)
+                imgs = tf.zeros((noSym * B, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
+                imgs = tf.tensor_scatter_nd_add(imgs, tf.concat([batch_idx, bpos_flow], axis=-1), values)
 
                 # Reshape images
                 imgs = tf.reshape(imgs, [-1, self.xsize, self.xsize, 1])
@@ -714,18 +681,18 @@ class AutoEncoder(Model):
 
                 # CTF corruption
                 if self.applyCTF:
-                    imgs = self.generator.ctfFilterImage(imgs)
+                    imgs = self.generator.ctfFilterImage(imgs, ctf=ctf_sym)
 
-                # Image loss
-                loss_rec += self.cost(images, imgs)
+            # Image loss
+            loss_rec = self.cost(images_sym, imgs)
 
-                if self.multires is not None:
-                    filt_images = apply_blur_filters_to_batch(images_corrected, self.filters)
-                    filt_decoded = apply_blur_filters_to_batch(imgs, self.filters)
-                    for idx in range(self.multires):
-                        loss_rec += 0.001 * self.cost(filt_images[..., idx], filt_decoded[..., idx])
+            if self.multires is not None:
+                filt_decoded = apply_blur_masks_to_batch(imgs, self.filters)
+                for idx in range(self.multires):
+                    loss_rec += 0.001 * self.cost(filt_images[..., idx], filt_decoded[..., idx])
 
-            loss_rec /= self.generator.noSym
+            # Average over symmetry copies
+            loss_rec = tf.reduce_mean(tf.reshape(loss_rec, [noSym, B]), axis=0)
 
             # Preparing indexing for "winner's takes it all"
             mask = tf.less_equal(loss_rec, prev_loss_rec)  # Shape: (B,)
@@ -790,7 +757,8 @@ class AutoEncoder(Model):
 
         return loss_rec, keep_r, keep_shifts, delta
 
-    def decode_images_het_with_loss(self, images, images_corrected, r_no_sym, shifts, delta):
+    def decode_images_het_with_loss(self, images, images_corrected, r_no_sym, shifts, delta, context,
+                                    filt_images=None):
         B = tf.shape(images)[0]
 
         # Original coordinates
@@ -804,10 +772,10 @@ class AutoEncoder(Model):
         o = self.generator.scale_factor * tf.tile(o, (B, 1, 1))
 
         if self.generator.refinement:
-            shifts = shifts + self.generator.shifts_batch
+            shifts = shifts + context.shifts
 
         if self.generator.refinement:
-            r_o = euler_matrix_batch(self.generator.rot_batch, self.generator.tilt_batch, self.generator.psi_batch)
+            r_o = euler_matrix_batch(context.euler[:, 0], context.euler[:, 1], context.euler[:, 2])
             r_o = tf.stack(r_o, axis=1)
             r_no_sym = tf.matmul(r_no_sym, r_o)
 
@@ -819,7 +787,7 @@ class AutoEncoder(Model):
         #     # r_het = tf.matmul(r_het, tf.transpose(R, perm=[0, 2, 1]))
         #     r = tf.matmul(r_het, r)
 
-        # Get rotated coords
+        # Get rotated coords (heterogeneous volumes differ per particle, so they are always scattered in real space)
         ro = tf.matmul(o, tf.transpose(r_no_sym, perm=[0, 2, 1]))
 
         # Get XY coords
@@ -857,13 +825,14 @@ class AutoEncoder(Model):
 
         # CTF corruption
         if self.applyCTF:
-            imgs_with_het = self.generator.ctfFilterImage(imgs_with_het)
+            imgs_with_het = self.generator.ctfFilterImage(imgs_with_het, ctf=context.ctf)
 
         loss_rec_with_het = self.cost(images, imgs_with_het)
 
         if self.multires is not None:
-            filt_images = apply_blur_filters_to_batch(images_corrected, self.filters)
-            filt_decoded = apply_blur_filters_to_batch(imgs_with_het, self.filters)
+            if filt_images is None:
+                filt_images = apply_blur_masks_to_batch(images_corrected, self.filters)
+            filt_decoded = apply_blur_masks_to_batch(imgs_with_het, self.filters)
             for idx in range(self.multires):
                 loss_rec_with_het += 0.001 * self.cost(filt_images[..., idx], filt_decoded[..., idx])
 
@@ -891,59 +860,76 @@ class AutoEncoder(Model):
 
         return loss_rec_with_het
 
-    def train_step(self, data):
+    def encoder_weights(self):
+        # Get weights encoder + pose + shifts
+        encoder_weights = self.common_encoder.trainable_weights
+        for model in self.head_encoder:
+            encoder_weights += model.trainable_weights
+        return encoder_weights
+
+    def compute_gradients(self, data):
         images = data[0]
 
         # Prepare batch
-        self.prepare_batch(data[1])
+        context = self.prepare_batch(data[1])
 
         # Wiener filter
         if self.applyCTF:
-            images_corrected = self.generator.wiener2DFilter(images)
+            images_corrected = self.generator.wiener2DFilter(images, ctf=context.ctf)
         else:
             images_corrected = images
 
+        # Multiresolution pyramid of the experimental images (shared by all the losses of the step)
+        if self.multires is not None:
+            filt_images = apply_blur_masks_to_batch(images_corrected, self.filters)
+        else:
+            filt_images = None
+
         # Encoder tape
         with tf.GradientTape() as tape_e:
-            loss_rec_e, r_no_sym, shifts, delta = self.decode_images_with_loss(images, images_corrected)
-
-        # Get weights encoder + pose + shifts + het
-        encoder_weights = self.common_encoder.trainable_weights
-        for model in self.head_encoder:
-            encoder_weights += model.trainable_weights
+            loss_rec_e, r_no_sym, shifts, delta = self.decode_images_with_loss(images, images_corrected, context,
+                                                                               filt_images)
 
         # Gradients
         if self.only_pose:
-            grads_e = tape_e.gradient(loss_rec_e, encoder_weights)
+            grads = [tape_e.gradient(loss_rec_e, self.encoder_weights())]
         else:
-            grads_e, grads_d = tape_e.gradient(loss_rec_e, [encoder_weights, self.decoder_delta.trainable_weights])
+            grads = tape_e.gradient(loss_rec_e, [self.encoder_weights(), self.decoder_delta.trainable_weights])
+        losses = {"rec_loss": loss_rec_e}
+
+        if self.useHet:
+            with tf.GradientTape() as tape_het:
+                loss_rec_with_het = self.decode_images_het_with_loss(images, images_corrected, tf.stop_gradient(r_no_sym),  tf.stop_gradient(shifts),  tf.stop_gradient(delta), context, filt_images)
+
+            grads += tape_het.gradient(loss_rec_with_het, [self.het_encoder.trainable_weights,
+                                                           self.het_decoder.trainable_weights])
+            losses["het_rec_loss"] = loss_rec_with_het
+
+        return grads, losses, batch_summed(*losses.values())
+
+    def train_step(self, data):
+        # Gradients of the whole batch (accumulated over micro batches if accum_steps > 1)
+        grads, losses = accumulate_gradients(self.compute_gradients, data, self.accum_steps)
 
         # Apply encoder gradients
-        self.e_optimizer[0].apply_gradients(zip(grads_e, encoder_weights))
+        self.e_optimizer[0].apply_gradients(zip(grads[0], self.encoder_weights()))
         # tf.cond(tf.less_equal(self.epoch_id, 25), lambda: self.apply_opt_ab_initio(grads_e, encoder_weights),
         #         lambda: self.apply_opt_refinement(grads_e, encoder_weights))
 
         # Apply decoder gradients
         if not self.only_pose:
-            self.d_optimizer.apply_gradients(zip(grads_d, self.decoder_delta.trainable_weights))
-
-        if self.useHet:
-            with tf.GradientTape() as tape_het:
-                loss_rec_with_het = self.decode_images_het_with_loss(images, images_corrected, tf.stop_gradient(r_no_sym),  tf.stop_gradient(shifts),  tf.stop_gradient(delta))
-
-        if self.useHet:
-            grads_het_e, grads_het_d = tape_het.gradient(loss_rec_with_het, [self.het_encoder.trainable_weights,
-                                                                             self.het_decoder.trainable_weights])
+            self.d_optimizer.apply_gradients(zip(grads[1], self.decoder_delta.trainable_weights))
 
         # Apply het encoder gradients
         if self.useHet:
+            grads_het_e, grads_het_d = grads[-2:]
             self.het_optimizer[0].apply_gradients(zip(grads_het_e, self.het_encoder.trainable_weights))
             self.het_optimizer[1].apply_gradients(zip(grads_het_d, self.het_decoder.trainable_weights))
 
-        self.rec_loss_tracker.update_state(loss_rec_e)
+        self.rec_loss_tracker.update_state(losses["rec_loss"])
         return_dict = {"rec_loss": self.rec_loss_tracker.result(),}
         if self.useHet:
-            self.het_rec_loss_tracker.update_state(loss_rec_with_het)
+            self.het_rec_loss_tracker.update_state(losses["het_rec_loss"])
             return_dict["het_rec_loss"] = self.het_rec_loss_tracker.result()
         return return_dict
 
@@ -957,21 +943,28 @@ class AutoEncoder(Model):
         images = data[0]
 
         # Prepare batch
-        self.prepare_batch(data[1])
+        context = self.prepare_batch(data[1])
 
         # Wiener filter
         if self.applyCTF:
-            images_corrected = self.generator.wiener2DFilter(images)
+            images_corrected = self.generator.wiener2DFilter(images, ctf=context.ctf)
         else:
             images_corrected = images
 
+        # Multiresolution pyramid of the experimental images (shared by all the losses of the step)
+        if self.multires is not None:
+            filt_images = apply_blur_masks_to_batch(images_corrected, self.filters)
+        else:
+            filt_images = None
+
         # Encoder
-        loss_rec_e, r_no_sym, shifts, delta = self.decode_images_with_loss(images, images_corrected)
+        loss_rec_e, r_no_sym, shifts, delta = self.decode_images_with_loss(images, images_corrected, context, filt_images)
 
         if self.useHet:
             loss_rec_with_het = self.decode_images_het_with_loss(images, images_corrected,
                                                                      tf.stop_gradient(r_no_sym),
-                                                                     tf.stop_gradient(shifts), tf.stop_gradient(delta))
+                                                                     tf.stop_gradient(shifts), tf.stop_gradient(delta),
+                                                                     context, filt_images)
 
         self.rec_loss_tracker.update_state(loss_rec_e)
         return_dict = {"rec_loss": self.rec_loss_tracker.result(), }
@@ -1018,40 +1011,17 @@ class AutoEncoder(Model):
         return volumes
 
     def predict_step(self, data):
-        self.generator.indexes = data[1]
-        self.generator.current_images = data[0]
-
         images = data[0]
 
         # Update batch_size (in case it is incomplete)
         batch_size_scope = tf.shape(data[0])[0]
 
-        if self.generator.refinement:
-            # Precompute batch alignments
-            rot_batch = tf.gather(self.generator.angle_rot, data[1], axis=0)
-            tilt_batch = tf.gather(self.generator.angle_tilt, data[1], axis=0)
-            psi_batch = tf.gather(self.generator.angle_psi, data[1], axis=0)
-
-            # Precompute shifts
-            shifts_x = tf.gather(self.generator.shifts[0], data[1], axis=0)
-            shifts_y = tf.gather(self.generator.shifts[1], data[1], axis=0)
-            shifts_batch = tf.stack([shifts_x, shifts_y], axis=1)
-
-        # Precompute batch CTFs
-        defocusU_batch = tf.gather(self.generator.defocusU, data[1], axis=0)
-        defocusV_batch = tf.gather(self.generator.defocusV, data[1], axis=0)
-        defocusAngle_batch = tf.gather(self.generator.defocusAngle, data[1], axis=0)
-        cs_batch = tf.gather(self.generator.cs, data[1], axis=0)
-        kv_batch = self.generator.kv
-        ctf = computeCTF(defocusU_batch, defocusV_batch, defocusAngle_batch, cs_batch, kv_batch,
-                         self.generator.sr, self.generator.pad_factor,
-                         [self.generator.xsize, int(0.5 * self.generator.xsize + 1)],
-                         batch_size_scope, self.generator.applyCTF)
-        self.generator.ctf = ctf
+        # Prepare batch
+        context = self.prepare_batch(data[1])
 
         # Wiener filter
         if self.applyCTF:
-            images_corrected = self.generator.wiener2DFilter(images)
+            images_corrected = self.generator.wiener2DFilter(images, ctf=context.ctf)
         else:
             images_corrected = images
 
@@ -1079,6 +1049,10 @@ class AutoEncoder(Model):
         # Coordinates with batch dimension
         o = self.generator.scale_factor * tf.tile(o, (batch_size_scope, 1, 1))
 
+        # Fourier transform of the consensus volume (computed once for all the candidates)
+        if self.projector == "fourier":
+            ft_volume_cons = self.fourier_projector.volumeFourier(self.generator.values[None, :] + delta)
+
         # Prepare outputs
         prev_loss_rec = 10000. * tf.ones(batch_size_scope, dtype=tf.float32)
         prev_loss_rec_cons = 10000. * tf.ones(batch_size_scope, dtype=tf.float32)
@@ -1092,7 +1066,7 @@ class AutoEncoder(Model):
             rows, shifts = self.head_encoder[idr](encoded)
 
             if self.generator.refinement:
-                shifts = shifts + shifts_batch
+                shifts = shifts + context.shifts
 
             # if self.useHet:
             #     shifts = shifts + shifts_het
@@ -1104,7 +1078,7 @@ class AutoEncoder(Model):
                 r = gramSchmidt(rows)
 
             if self.generator.refinement:
-                r_o = euler_matrix_batch(rot_batch, tilt_batch, psi_batch)
+                r_o = euler_matrix_batch(context.euler[:, 0], context.euler[:, 1], context.euler[:, 2])
                 r_o = tf.stack(r_o, axis=1)
                 r = tf.matmul(r, r_o)
 
@@ -1127,10 +1101,6 @@ class AutoEncoder(Model):
             # Permute coords
             ro = tf.stack([ro[..., 1], ro[..., 0]], axis=-1)
 
-            # Initialize images
-            imgs_cons = tf.zeros((batch_size_scope, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
-            imgs = tf.zeros((batch_size_scope, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
-
             # Image values
             original_values = tf.tile(self.generator.values[None, :], (batch_size_scope, 1))
             values_cons = original_values + delta
@@ -1144,23 +1114,40 @@ class AutoEncoder(Model):
             values_cons = values_cons * weight
             values = values * weight
 
-            # Scatter images
+            # Scatter images (heterogeneous volumes differ per particle, so they are always scattered in real space)
             fn = lambda inp: tf.tensor_scatter_nd_add(inp[0], inp[1], inp[2])
-            imgs_cons = tf.map_fn(fn, [imgs_cons, bpos_flow, values_cons], fn_output_signature=tf.float32)
+            imgs = tf.zeros((batch_size_scope, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
             imgs = tf.map_fn(fn, [imgs, bpos_flow, values], fn_output_signature=tf.float32)
 
             # Reshape images
-            imgs_cons = tf.reshape(imgs_cons, [-1, self.xsize, self.xsize, 1])
             imgs = tf.reshape(imgs, [-1, self.xsize, self.xsize, 1])
 
             # Gaussian filtering
-            imgs_cons = tfa.image.gaussian_filter2d(imgs_cons, 3, 1)
             imgs = tfa.image.gaussian_filter2d(imgs, 3, 1)
 
             # CTF corruption
             if self.applyCTF:
-                imgs_cons = self.generator.ctfFilterImage(imgs_cons)
-                imgs = self.generator.ctfFilterImage(imgs)
+                imgs = self.generator.ctfFilterImage(imgs, ctf=context.ctf)
+
+            if self.projector == "fourier":
+                # Central slices of the consensus volume (CTF is applied in Fourier space)
+                interpolation = self.fourier_projector.interpolationWeights(r)
+                imgs_cons = self.fourier_projector.project(ft_volume_cons, interpolation, shifts=shifts,
+                                                           ctf=context.ctf if self.applyCTF else None)
+            else:
+                # Scatter images
+                imgs_cons = tf.zeros((batch_size_scope, self.generator.xsize, self.generator.xsize), dtype=tf.float32)
+                imgs_cons = tf.map_fn(fn, [imgs_cons, bpos_flow, values_cons], fn_output_signature=tf.float32)
+
+                # Reshape images
+                imgs_cons = tf.reshape(imgs_cons, [-1, self.xsize, self.xsize, 1])
+
+                # Gaussian filtering
+                imgs_cons = tfa.image.gaussian_filter2d(imgs_cons, 3, 1)
+
+                # CTF corruption
+                if self.applyCTF:
+                    imgs_cons = self.generator.ctfFilterImage(imgs_cons, ctf=context.ctf)
 
             # Image loss
             loss_rec_cons = self.cost(images, imgs_cons)
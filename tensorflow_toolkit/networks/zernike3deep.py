@@ -38,7 +38,8 @@ except ImportError:
     allow_open3d = False
     print(YELLOW + "Open3D has not been installed. The program will continue without this package" + RESET)
 
-from tensorflow_toolkit.utils import computeCTF, full_fft_pad, full_ifft_pad, create_blur_filters
+from tensorflow_toolkit.utils import computeCTF, full_fft_pad, full_ifft_pad, create_blur_filters, accumulate_gradients, \
+    batch_summed
 from tensorflow_toolkit.layers.residue_conv2d import ResidueConv2D
 
 
@@ -257,14 +258,14 @@ class Decoder:
             # Gaussian filter image
             decoded = self.generator.gaussianFilterImage(decoded)
 
-            if self.CTF == "apply":
-                # CTF filter image
+            if self.CTF == "apply" and not self.generator.fourier_loss:
+                # CTF filter image (applied by the loss in Fourier space otherwise)
                 decoded_ctf = self.generator.ctfFilterImage(decoded, ctf)
             else:
                 decoded_ctf = decoded
         else:
-            if self.CTF == "apply":
-                # CTF filter image
+            if self.CTF == "apply" and not self.generator.fourier_loss:
+                # CTF filter image (applied by the loss in Fourier space otherwise)
                 decoded_ctf = self.generator.ctfFilterImage(decoded, ctf)
             else:
                 decoded_ctf = decoded
@@ -305,9 +306,10 @@ class Decoder:
 
 class AutoEncoder(tf.keras.Model):
     def __init__(self, generator, architecture="convnn", CTF="apply", mode=None, l_bond=0.01, l_angle=0.01,
-                 l_clashes=None, l_norm=1e-4, jit_compile=True, poseReg=0.0, ctfReg=0.0, **kwargs):
+                 l_clashes=None, l_norm=1e-4, jit_compile=True, poseReg=0.0, ctfReg=0.0, accum_steps=1, **kwargs):
         super(AutoEncoder, self).__init__(**kwargs)
         self.generator = generator
+        self.accum_steps = accum_steps
         self.CTF = CTF if generator.applyCTF == 1 else None
         self.refPose = 1.0 if generator.refinePose else 0.0
         self.mode = generator.mode if mode is None else mode
@@ -330,11 +332,12 @@ class AutoEncoder(tf.keras.Model):
             self.encoder_ctf = Encoder(generator.zernike_size.shape[0], generator.xsize, architecture=architecture,
                                        mode=self.mode, jit_compile=jit_compile)
         self.decoder = Decoder(generator, CTF=self.CTF, jit_compile=jit_compile)
-        self.z_space_x = layers.Dense(generator.zernike_size.shape[0], activation="linear", name="z_space_x", kernel_initializer=RandomUniform(-0.001, 0.001))
-        self.z_space_y = layers.Dense(generator.zernike_size.shape[0], activation="linear", name="z_space_y", kernel_initializer=RandomUniform(-0.001, 0.001))
-        self.z_space_z = layers.Dense(generator.zernike_size.shape[0], activation="linear", name="z_space_z", kernel_initializer=RandomUniform(-0.001, 0.001))
-        self.delta_euler = layers.Dense(3, activation="linear", name="delta_euler", trainable=generator.refinePose)
-        self.delta_shifts = layers.Dense(2, activation="linear", name="delta_shifts", trainable=generator.refinePose)
+        # Output heads in float32 (encoders may compute in a reduced precision, the physical decoder does not)
+        self.z_space_x = layers.Dense(generator.zernike_size.shape[0], activation="linear", name="z_space_x", kernel_initializer=RandomUniform(-0.001, 0.001), dtype=tf.float32)
+        self.z_space_y = layers.Dense(generator.zernike_size.shape[0], activation="linear", name="z_space_y", kernel_initializer=RandomUniform(-0.001, 0.001), dtype=tf.float32)
+        self.z_space_z = layers.Dense(generator.zernike_size.shape[0], activation="linear", name="z_space_z", kernel_initializer=RandomUniform(-0.001, 0.001), dtype=tf.float32)
+        self.delta_euler = layers.Dense(3, activation="linear", name="delta_euler", trainable=generator.refinePose, dtype=tf.float32)
+        self.delta_shifts = layers.Dense(2, activation="linear", name="delta_shifts", trainable=generator.refinePose, dtype=tf.float32)
         self.total_loss_tracker = tf.keras.metrics.Mean(name="total_loss")
         self.img_loss_tracker = tf.keras.metrics.Mean(name="img_loss")
         self.bond_loss_tracker = tf.keras.metrics.Mean(name="bond_loss")
@@ -346,8 +349,11 @@ class AutoEncoder(tf.keras.Model):
         # XLA compilation of cost function
         if jit_compile:
             self.cost_function = tf.function(jit_compile=jit_compile)(self.generator.cost_function)
+            self.fourier_cost_function = tf.function(jit_compile=jit_compile)(self.generator.fourier_cost_function) \
+                if self.generator.fourier_loss else None
         else:
             self.cost_function = self.generator.cost_function
+            self.fourier_cost_function = self.generator.fourier_cost_function
 
         if allow_open3d and self.generator.ref_is_struct:
             # Continuous convolution
@@ -379,7 +385,7 @@ class AutoEncoder(tf.keras.Model):
             self.loss_disantangle_tracker,
         ]
 
-    def train_step(self, data):
+    def compute_gradients(self, data):
         inputs = data[0]
 
         if self.mode == "spa":
@@ -402,7 +408,7 @@ class AutoEncoder(tf.keras.Model):
             points_row_splits = tf.range(B + 1, dtype=tf.int64) * num_points
             queries_row_splits = tf.range(B + 1, dtype=tf.int64) * num_points
 
-        if self.CTF == "wiener":
+        if self.CTF == "wiener" and not self.generator.wiener_pipeline:
             # Precompute batch CTFs
             batch_size_scope = tf.shape(indexes)[0]
             defocusU_batch = tf.gather(self.generator.defocusU, indexes, axis=0)
@@ -450,6 +456,8 @@ class AutoEncoder(tf.keras.Model):
 
                 # Forward pass (third encoder - permuted CTF)
                 if self.disantangle_ctf and self.CTF is not None:
+                    if self.generator.fourier_loss and self.CTF == "apply":
+                        decoded_ctf = self.decoder.generator.ctfFilterImage(decoded, ctf)
                     x = self.encoder_ctf(decoded_ctf)
                     encoded_ctf = [self.z_space_x(x), self.z_space_y(x), self.z_space_z(x)]
                     encoded_ctf[0] = encoded_ctf[0] + z_x_batch
@@ -490,7 +498,7 @@ class AutoEncoder(tf.keras.Model):
             else:
                 clashes = tf.constant(0.0, tf.float32)
 
-            img_loss = self.cost_function(images, decoded_ctf)
+            img_loss = self.image_loss(images, decoded, decoded_ctf, ctf)
 
             # Bond and angle losses
             if self.generator.ref_is_struct:
@@ -525,14 +533,22 @@ class AutoEncoder(tf.keras.Model):
                           self.ctf_lambda * loss_disantagled_ctf)  # 0.001 works on HetSIREN
 
         grads = tape.gradient(total_loss, self.trainable_weights)
+        losses = {"loss": total_loss, "img_loss": img_loss, "angle": angle_loss, "bond": bond_loss,
+                  "clashes": clashes, "norm": norm_loss,
+                  "loss_disentangled": loss_disantagled_pose + loss_disantagled_ctf}
+        return [grads], losses, batch_summed(total_loss)
+
+    def train_step(self, data):
+        # Gradients of the whole batch (accumulated over micro batches if accum_steps > 1)
+        (grads,), losses = accumulate_gradients(self.compute_gradients, data, self.accum_steps)
         self.optimizer.apply_gradients(zip(grads, self.trainable_weights))
-        self.total_loss_tracker.update_state(total_loss)
-        self.img_loss_tracker.update_state(img_loss)
-        self.angle_loss_tracker.update_state(angle_loss)
-        self.bond_loss_tracker.update_state(bond_loss)
-        self.clash_loss_tracker.update_state(clashes)
-        self.norm_loss_tracker.update_state(norm_loss)
-        self.loss_disantangle_tracker.update_state(loss_disantagled_pose + loss_disantagled_ctf)
+        self.total_loss_tracker.update_state(losses["loss"])
+        self.img_loss_tracker.update_state(losses["img_loss"])
+        self.angle_loss_tracker.update_state(losses["angle"])
+        self.bond_loss_tracker.update_state(losses["bond"])
+        self.clash_loss_tracker.update_state(losses["clashes"])
+        self.norm_loss_tracker.update_state(losses["norm"])
+        self.loss_disantangle_tracker.update_state(losses["loss_disentangled"])
         return {
             "loss": self.total_loss_tracker.result(),
             "img_loss": self.img_loss_tracker.result(),
@@ -566,7 +582,7 @@ class AutoEncoder(tf.keras.Model):
             points_row_splits = tf.range(B + 1, dtype=tf.int64) * num_points
             queries_row_splits = tf.range(B + 1, dtype=tf.int64) * num_points
 
-        if self.CTF == "wiener":
+        if self.CTF == "wiener" and not self.generator.wiener_pipeline:
             # Precompute batch CTFs
             batch_size_scope = tf.shape(indexes)[0]
             defocusU_batch = tf.gather(self.generator.defocusU, indexes, axis=0)
@@ -614,6 +630,8 @@ class AutoEncoder(tf.keras.Model):
 
             # Forward pass (third encoder - permuted CTF)
             if self.disantangle_ctf and self.CTF is not None:
+                if self.generator.fourier_loss and self.CTF == "apply":
+                    decoded_ctf = self.decoder.generator.ctfFilterImage(decoded, ctf)
                 x = self.encoder_ctf(decoded_ctf)
                 encoded_ctf = [self.z_space_x(x), self.z_space_y(x), self.z_space_z(x)]
                 encoded_ctf[0] = encoded_ctf[0] + z_x_batch
@@ -656,7 +674,7 @@ class AutoEncoder(tf.keras.Model):
         else:
             clashes = tf.constant(0.0, tf.float32)
 
-        img_loss = self.cost_function(images, decoded_ctf)
+        img_loss = self.image_loss(images, decoded, decoded_ctf, ctf)
 
         # Bond and angle losses
         if self.generator.ref_is_struct:
@@ -737,6 +755,18 @@ class AutoEncoder(tf.keras.Model):
 
         return encoded
 
+    def image_loss(self, images, decoded, decoded_ctf, ctf):
+        if self.generator.fourier_loss:
+            # Opt-in loss on the padded Fourier transforms (one transform per image, CTF applied on the
+            # transform, no crop to the box)
+            ft_images = self.generator.fourierImages(images)
+            ft_decoded = self.generator.fourierImages(decoded)
+            if self.CTF == "apply":
+                ft_decoded = self.generator.ctfFilterFourier(ft_decoded, ctf)
+            return self.fourier_cost_function(ft_images, ft_decoded)
+        else:
+            return self.cost_function(images, decoded_ctf)
+
     def call(self, input_features):
         if allow_open3d and self.generator.ref_is_struct:
             # To know this weights exist
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import numpy as np
+from importlib.metadata import version
+
+if version("tensorflow") >= "2.16.0":
+    os.environ["TF_USE_LEGACY_KERAS"] = "1"
+import tensorflow as tf
+
+from tensorflow_toolkit.scripts.benchmark_harness import StepTimer, build_autoencoder, add_benchmark_arguments, \
+    benchmark_inputs
+
+
+def benchmark(network, md_file, batch_size, steps=50, **kwargs):
+    results = {}
+    for compile_mode in ["islands", "fused"]:
+        generator, autoencoder = build_autoencoder(network, md_file, batch_size, compile_mode=compile_mode,
+                                                   **kwargs)
+        dataset = generator.return_tf_dataset().repeat().take(steps + 1)
+
+        timer = StepTimer()
+        autoencoder.fit(dataset, epochs=1, verbose=0, callbacks=[timer])
+        results[compile_mode] = (timer.times[0], np.mean(timer.times[1:]), np.std(timer.times[1:]))
+
+        # Release graphs and compiled clusters before the next mode
+        del autoencoder, generator
+        tf.keras.backend.clear_session()
+
+    print("%-8s %18s %18s" % ("Mode", "First step (s)", "Step (ms)"))
+    for compile_mode, (first, mean, std) in results.items():
+        print("%-8s %18.2f %11.2f +- %.2f" % (compile_mode, first, 1000. * mean, 1000. * std))
+
+    return results
+
+
+def main():
+    import argparse
+
+    # Input parameters
+    parser = argparse.ArgumentParser()
+    add_benchmark_arguments(parser, ["flexsiren", "zernike3deep"], steps=50)
+    parser.add_argument('--gpu', type=str)
+
+    args = parser.parse_args()
+
+    if args.gpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    physical_devices = tf.config.list_physical_devices('GPU')
+    for gpu_instance in physical_devices:
+        tf.config.experimental.set_memory_growth(gpu_instance, True)
+
+    inputs = benchmark_inputs(args)
+
+    benchmark(**inputs)
@@ -0,0 +1,144 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import time
+import multiprocessing
+from importlib.metadata import version
+
+if version("tensorflow") >= "2.16.0":
+    os.environ["TF_USE_LEGACY_KERAS"] = "1"
+import tensorflow as tf
+
+from tensorflow_toolkit.utils import set_precision_policy
+
+
+class StepTimer(tf.keras.callbacks.Callback):
+    """Wall time of every train step (the first one includes tracing and compilation)."""
+
+    def __init__(self):
+        super().__init__()
+        self.times = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.times.append(time.perf_counter() - self.start)
+
+
+def build_autoencoder(network, md_file, batch_size, step=1, L1=7, L2=7, pad=2, sr=1.0, applyCTF=1,
+                      ctfType="apply", architecture="convnn", latDim=8, shuffle=True, precision=None, remat=None,
+                      compile_mode=None):
+    """
+    Network and data generator used by the benchmarks. Only the option under test differs between runs:
+
+    - precision: Keras precision policy (the global policy is set, so every policy needs its own process).
+    - remat: Rematerialized blocks (FlexSIREN and HetSIREN).
+    - compile_mode: "islands" (jit_compile of the network blocks) or "fused" (whole train step compiled). Without
+      a compile mode, nothing is compiled with XLA.
+    """
+    network_kwargs, generator_kwargs = {}, {}
+    if precision is not None:
+        precision, precision_scaled = set_precision_policy(precision)
+        network_kwargs.update(precision=precision, precision_scaled=precision_scaled)
+        generator_kwargs.update(precision=precision)
+    if remat is not None:
+        network_kwargs.update(remat=remat)
+    jit_islands = compile_mode == "islands"
+
+    if network == "flexsiren":
+        from tensorflow_toolkit.generators.generator_flexsiren import Generator
+        from tensorflow_toolkit.networks.flexsiren import AutoEncoder
+        generator = Generator(md_file=md_file, shuffle=shuffle, batch_size=batch_size, step=step, splitTrain=1.0,
+                              cost="corr", pad_factor=pad, sr=sr, applyCTF=applyCTF, **generator_kwargs)
+        autoencoder = AutoEncoder(generator, latDim=latDim, architecture=architecture, CTF=ctfType,
+                                  jit_compile=jit_islands, **network_kwargs)
+    elif network == "het_siren":
+        from tensorflow_toolkit.generators.generator_het_siren import Generator
+        from tensorflow_toolkit.networks.het_siren import AutoEncoder
+        generator = Generator(md_file=md_file, shuffle=shuffle, batch_size=batch_size, step=step, splitTrain=1.0,
+                              cost="corr", pad_factor=pad, sr=sr, applyCTF=applyCTF, **generator_kwargs)
+        autoencoder = AutoEncoder(generator, het_dim=latDim, architecture=architecture, CTF=ctfType,
+                                  **network_kwargs)
+    elif network == "zernike3deep":
+        from tensorflow_toolkit.generators.generator_zernike3deep import Generator
+        from tensorflow_toolkit.networks.zernike3deep import AutoEncoder
+        network_kwargs.pop("precision", None)
+        network_kwargs.pop("precision_scaled", None)
+        generator = Generator(L1, L2, md_file=md_file, shuffle=shuffle, batch_size=batch_size, step=step,
+                              splitTrain=1.0, cost="corr", pad_factor=pad, sr=sr, applyCTF=applyCTF)
+        autoencoder = AutoEncoder(generator, architecture=architecture, CTF=ctfType, jit_compile=jit_islands,
+                                  **network_kwargs)
+    else:
+        raise ValueError("Network must be one of: flexsiren, het_siren, zernike3deep")
+
+    autoencoder.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=1e-5),
+                        jit_compile=compile_mode == "fused")
+    return generator, autoencoder
+
+
+def run_in_processes(target, args_list):
+    """
+    Run target(queue, *args) in a spawned process for every tuple of args_list and return the first value put
+    in the queue (e.g. by the chief worker). Used to isolate global state (precision policies, peak memory,
+    thread pools...) between the configurations of a benchmark.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    processes = [context.Process(target=target, args=(queue,) + tuple(args)) for args in args_list]
+    for process in processes:
+        process.start()
+    result = queue.get()
+    for process in processes:
+        process.join()
+    return result
+
+
+def add_benchmark_arguments(parser, networks, steps=20):
+    """Input parameters shared by the benchmarks (network, data and model options)."""
+    parser.add_argument('--network', type=str, required=True, choices=networks)
+    parser.add_argument('--md_file', type=str, required=True)
+    parser.add_argument('--batch_size', type=int, required=True)
+    parser.add_argument('--steps', type=int, required=False, default=steps)
+    parser.add_argument('--step', type=int, required=False, default=1)
+    parser.add_argument('--L1', type=int, required=False, default=7)
+    parser.add_argument('--L2', type=int, required=False, default=7)
+    parser.add_argument('--lat_dim', type=int, required=False, default=8)
+    parser.add_argument('--architecture', type=str, required=False, default="convnn")
+    parser.add_argument('--ctf_type', type=str, required=False, default="apply")
+    parser.add_argument('--pad', type=int, required=False, default=2)
+    parser.add_argument('--sr', type=float, required=False, default=1.0)
+    parser.add_argument('--apply_ctf', type=int, required=False, default=1)
+
+
+def benchmark_inputs(args):
+    """Inputs of the benchmark functions for the parameters added by add_benchmark_arguments."""
+    return {"network": args.network, "md_file": args.md_file, "batch_size": args.batch_size, "steps": args.steps,
+            "step": args.step, "L1": args.L1, "L2": args.L2, "latDim": args.lat_dim,
+            "architecture": args.architecture, "ctfType": args.ctf_type, "pad": args.pad, "sr": args.sr,
+            "applyCTF": args.apply_ctf}
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import numpy as np
+from importlib.metadata import version
+
+if version("tensorflow") >= "2.16.0":
+    os.environ["TF_USE_LEGACY_KERAS"] = "1"
+import tensorflow as tf
+
+from tensorflow_toolkit.utils import set_cpu_profile, create_strategy, local_workers, split_cpus
+from tensorflow_toolkit.scripts.benchmark_harness import StepTimer, build_autoencoder, run_in_processes, \
+    add_benchmark_arguments, benchmark_inputs
+
+
+def run_worker(queue, workers, worker_index, cpus, network, md_file, batch_size, steps, kwargs):
+    # Every worker runs in its own process, bound to its own CPUs
+    os.sched_setaffinity(0, cpus)
+    set_cpu_profile(report=False)
+    if len(workers) > 1:
+        os.environ["TF_CONFIG"] = json.dumps({"cluster": {"worker": workers},
+                                              "task": {"type": "worker", "index": worker_index}})
+    strategy = create_strategy(multiWorker=len(workers) > 1)
+
+    with strategy.scope():
+        generator, autoencoder = build_autoencoder(network, md_file, batch_size, **kwargs)
+    if len(workers) > 1:
+        dataset = strategy.distribute_datasets_from_function(
+            lambda input_context: generator.return_tf_dataset(input_context=input_context).repeat().take(steps + 1))
+    else:
+        dataset = generator.return_tf_dataset().repeat().take(steps + 1)
+
+    timer = StepTimer()
+    autoencoder.fit(dataset, epochs=1, verbose=0, callbacks=[timer])
+    if worker_index == 0:
+        queue.put((np.mean(timer.times[1:]), np.std(timer.times[1:])))
+
+
+def benchmark(network, md_file, batch_size, num_workers="1,2,4", cpus_per_worker=None, steps=20, **kwargs):
+    num_workers = sorted(int(workers) for workers in str(num_workers).split(","))
+
+    # Same CPUs per worker in every configuration (weak scaling: the global batch grows with the workers)
+    if cpus_per_worker is None:
+        cpus_per_worker = len(split_cpus(num_workers[-1])[0])
+
+    results = {}
+    for workers in num_workers:
+        addresses = local_workers(workers)
+        results[workers] = run_in_processes(run_worker,
+                                            [(addresses, worker_index, cpus, network, md_file, batch_size, steps,
+                                              kwargs)
+                                             for worker_index, cpus in enumerate(split_cpus(workers, cpus_per_worker))])
+
+    # Throughput of a single worker in the smallest configuration
+    base_throughput = batch_size / results[num_workers[0]][0]
+    print("%-8s %18s %20s %12s" % ("Workers", "Step (ms)", "Throughput (img/s)", "Efficiency"))
+    for workers, (mean, std) in results.items():
+        throughput = workers * batch_size / mean
+        print("%-8d %9.2f +- %5.2f %20.1f %11.1f%%" % (workers, 1000. * mean, 1000. * std, throughput,
+                                                       100. * throughput / (workers * base_throughput)))
+
+    return results
+
+
+def main():
+    import argparse
+
+    # Input parameters
+    parser = argparse.ArgumentParser()
+    add_benchmark_arguments(parser, ["flexsiren", "het_siren", "zernike3deep"])
+    parser.add_argument('--num_workers', type=str, required=False, default="1,2,4")
+    parser.add_argument('--cpus_per_worker', type=int, required=False, default=None)
+
+    args = parser.parse_args()
+
+    # CPU benchmark
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+    inputs = benchmark_inputs(args)
+    inputs.update(num_workers=args.num_workers, cpus_per_worker=args.cpus_per_worker)
+
+    benchmark(**inputs)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import time
+import tempfile
+import numpy as np
+from importlib.metadata import version
+
+if version("tensorflow") >= "2.16.0":
+    os.environ["TF_USE_LEGACY_KERAS"] = "1"
+import tensorflow as tf
+
+from tensorflow_toolkit.scripts.benchmark_harness import build_autoencoder, run_in_processes, \
+    add_benchmark_arguments, benchmark_inputs
+
+
+def flatten_gradients(grads):
+    return np.concatenate([tf.reshape(tf.cast(tf.convert_to_tensor(grad), tf.float32), [-1]).numpy()
+                           for group in grads for grad in group if grad is not None])
+
+
+def run_policy(queue, network, md_file, batch_size, precision, weights_file, steps, kwargs):
+    # Keras precision policies are global, so every policy runs in its own process
+    generator, autoencoder = build_autoencoder(network, md_file, batch_size, shuffle=False, precision=precision,
+                                               **kwargs)
+    data = next(iter(generator.return_tf_dataset().take(1)))
+    compute_gradients = tf.function(autoencoder.compute_gradients)
+
+    # The first call builds the network (and traces the step), then all the policies share the same weights
+    compute_gradients(data)
+    if precision == "float32":
+        autoencoder.save_weights(weights_file)
+    else:
+        autoencoder.load_weights(weights_file)
+
+    times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        grads, losses, _ = compute_gradients(data)
+        float(losses["loss"])
+        times.append(time.perf_counter() - start)
+
+    queue.put((np.mean(times), np.std(times), float(losses["loss"]), flatten_gradients(grads)))
+
+
+def benchmark(network, md_file, batch_size, precision="mixed_bfloat16", steps=20, **kwargs):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        weights_file = os.path.join(tmp_dir, "float32_weights.h5")
+        for policy in ["float32", precision]:
+            results[policy] = run_in_processes(run_policy, [(network, md_file, batch_size, policy, weights_file,
+                                                             steps, kwargs)])
+
+    base_time, _, base_loss, base_grads = results["float32"]
+    print("%-16s %18s %10s %14s %14s" % ("Precision", "Step (ms)", "Speedup", "Loss rel. err", "Grad cosine"))
+    for policy, (mean, std, loss, grads) in results.items():
+        loss_error = abs(loss - base_loss) / max(abs(base_loss), 1e-12)
+        cosine = np.dot(grads, base_grads) / max(np.linalg.norm(grads) * np.linalg.norm(base_grads), 1e-12)
+        print("%-16s %9.2f +- %5.2f %9.2fx %14.2e %14.6f" % (policy, 1000. * mean, 1000. * std, base_time / mean,
+                                                            loss_error, cosine))
+
+    return results
+
+
+def main():
+    import argparse
+
+    # Input parameters
+    parser = argparse.ArgumentParser()
+    add_benchmark_arguments(parser, ["flexsiren", "het_siren", "zernike3deep"])
+    parser.add_argument('--precision', type=str, required=False, default="mixed_bfloat16",
+                        choices=["mixed_float16", "mixed_bfloat16"])
+    parser.add_argument('--gpu', type=str)
+
+    args = parser.parse_args()
+
+    if args.gpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+
+    inputs = benchmark_inputs(args)
+    inputs["precision"] = args.precision
+
+    benchmark(**inputs)
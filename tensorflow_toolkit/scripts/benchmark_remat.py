@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import numpy as np
+from importlib.metadata import version
+
+if version("tensorflow") >= "2.16.0":
+    os.environ["TF_USE_LEGACY_KERAS"] = "1"
+import tensorflow as tf
+
+from tensorflow_toolkit.utils import peak_memory
+from tensorflow_toolkit.scripts.benchmark_harness import StepTimer, build_autoencoder, run_in_processes, \
+    add_benchmark_arguments, benchmark_inputs
+
+
+def run_config(queue, network, md_file, batch_size, remat, steps, kwargs):
+    # Peak memory can not be reset on CPU, so every configuration runs in its own process
+    for gpu_instance in tf.config.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu_instance, True)
+
+    # No XLA: fused clusters may merge the recomputed activations with the stored ones
+    generator, autoencoder = build_autoencoder(network, md_file, batch_size, remat=remat, **kwargs)
+    dataset = generator.return_tf_dataset().repeat().take(steps + 1)
+
+    timer = StepTimer()
+    autoencoder.fit(dataset, epochs=1, verbose=0, callbacks=[timer])
+    queue.put((np.mean(timer.times[1:]), np.std(timer.times[1:]), peak_memory()))
+
+
+def benchmark(network, md_file, batch_size, remat, steps=20, **kwargs):
+    blocks = [block.strip() for block in remat.split(",") if block.strip()]
+    configs = ["none"] + blocks + ([",".join(blocks)] if len(blocks) > 1 else [])
+
+    results = {}
+    for config in configs:
+        results[config] = run_in_processes(run_config, [(network, md_file, batch_size,
+                                                         None if config == "none" else config, steps, kwargs)])
+
+    base_time, _, base_memory = results["none"]
+    print("%-28s %18s %12s %10s %10s" % ("Remat", "Step (ms)", "Peak (MB)", "Time", "Memory"))
+    for config, (mean, std, memory) in results.items():
+        print("%-28s %9.2f +- %5.2f %12.1f %+9.1f%% %+9.1f%%" % (config, 1000. * mean, 1000. * std, memory,
+                                                              100. * (mean / base_time - 1.),
+                                                              100. * (memory / base_memory - 1.)))
+
+    return results
+
+
+def main():
+    import argparse
+
+    # Input parameters
+    parser = argparse.ArgumentParser()
+    add_benchmark_arguments(parser, ["flexsiren", "het_siren"])
+    parser.add_argument('--remat', type=str, required=True)
+    parser.add_argument('--gpu', type=str)
+
+    args = parser.parse_args()
+
+    if args.gpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+
+    inputs = benchmark_inputs(args)
+    inputs["remat"] = args.remat
+
+    benchmark(**inputs)
@@ -36,7 +36,7 @@ from xmipp_metadata.image_handler import ImageHandler
 
 import tensorflow as tf
 
-from tensorflow_toolkit.utils import epochs_from_iterations, computeBasis
+from tensorflow_toolkit.utils import epochs_from_iterations, computeBasis, set_cpu_profile
 
 
 def compute_distance_matrix(outPath, references_file, targets_file, L1, L2, batch_size, epochs, cost,
@@ -151,11 +151,18 @@ def main():
     parser.add_argument('--jit_compile', action='store_true')
     parser.add_argument('--regNorm', type=float, default=0.001)
     parser.add_argument('--num_projections', type=int, default=20)
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
+    parser.add_argument('--pipeline_share', type=float, required=False, default=None)
     parser.add_argument('--gpu', type=str)
     parser.add_argument('--thr', type=int)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None or args.pipeline_share is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node, pipeline_share=args.pipeline_share)
+
     inputs = {"references_file": args.references_file, "targets_file": args.targets_file,
               "outPath": args.out_path, "L1": args.L1,
               "L2": args.L2, "batch_size": args.batch_size, "epochs": args.epochs,
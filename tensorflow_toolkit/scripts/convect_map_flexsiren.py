@@ -39,9 +39,10 @@ import tensorflow as tf
 
 from tensorflow_toolkit.generators.generator_flexsiren import Generator
 from tensorflow_toolkit.networks.flexsiren import AutoEncoder
+from tensorflow_toolkit.utils import set_cpu_profile
 
 def predict(weigths_file, het_file, out_path, architecture="mlpnn",
-            poseReg=0.0, ctfReg=0.0, refinePose=True, **kwargs):
+            poseReg=0.0, ctfReg=0.0, refinePose=True, outSize=None, batch_size=8, chunk_size=65536, **kwargs):
     x_het = np.loadtxt(het_file)
     if len(x_het.shape) == 1:
         x_het = x_het.reshape((1, -1))
@@ -65,9 +66,9 @@ def predict(weigths_file, het_file, out_path, architecture="mlpnn",
                                        [None, generator.sinusoid_table.shape[1]]])
     autoencoder.load_weights(weigths_file)
 
-    # Convect maps
-    convected_maps = autoencoder.convect_maps(x_het)
-    for idx, decoded_map in enumerate(convected_maps):
+    # Convect maps (written as soon as they are computed)
+    convected_maps = autoencoder.convect_maps(x_het, batch_size=batch_size, chunk_size=chunk_size, out_size=outSize)
+    for idx, decoded_map in convected_maps:
         decoded_path = Path(out_path, 'decoded_map_class_%02d.mrc' % (idx + 1))
         ImageHandler().write(decoded_map, decoded_path, overwrite=True)
 
@@ -85,10 +86,22 @@ def main():
     parser.add_argument('--pose_reg', type=float, required=False, default=0.0)
     parser.add_argument('--ctf_reg', type=float, required=False, default=0.0)
     parser.add_argument('--refine_pos', type=float, required=False, default=0.0)
+    parser.add_argument('--outSize', type=int, required=False, default=None)
+    parser.add_argument('--batch_size', type=int, required=False, default=8)
+    parser.add_argument('--chunk_size', type=int, required=False, default=65536)
+    parser.add_argument('--hierarchical_block', type=int, required=False, default=0)
+    parser.add_argument('--hierarchical_tol', type=float, required=False, default=1e-3)
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
+    parser.add_argument('--pipeline_share', type=float, required=False, default=None)
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None or args.pipeline_share is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node, pipeline_share=args.pipeline_share)
+
     if args.gpu:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     else:
@@ -99,7 +112,9 @@ def main():
 
     inputs = {"weigths_file": args.weigths_file, "het_file": args.het_file,
               "out_path": args.out_path, "step": args.step, "architecture": args.architecture,
-              "poseReg": args.pose_reg, "ctfReg": args.ctf_reg, "refinePose": args.refine_pose}
+              "poseReg": args.pose_reg, "ctfReg": args.ctf_reg, "refinePose": args.refine_pos,
+              "outSize": args.outSize, "batch_size": args.batch_size, "chunk_size": args.chunk_size,
+              "hierarchical_block": args.hierarchical_block, "hierarchical_tol": args.hierarchical_tol}
 
     # Initialize volume slicer
     predict(**inputs)
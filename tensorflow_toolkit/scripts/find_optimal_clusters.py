@@ -34,6 +34,7 @@ import pandas as pd
 
 from tensorflow_toolkit.utils.Clustering.utils import getClusterMethod
 import tensorflow_toolkit.utils.Clustering.methods as mth
+from tensorflow_toolkit.utils import set_cpu_profile, clustering_threadpool
 
 
 def clusterAnalysis(dataFile, outPath, maxClusters=15, clusterMethod="KMeans"):
@@ -52,8 +53,9 @@ def clusterAnalysis(dataFile, outPath, maxClusters=15, clusterMethod="KMeans"):
                    if not name.replace("Analysis", "") in exclude_list and "Analysis" in name)
 
     # Clustering analysis
-    for key in methods:
-        methods[key][1] = methods[key][0](flex_space, fn_cluster, maxClusters=maxClusters, outPath=outPath)
+    with clustering_threadpool():
+        for key in methods:
+            methods[key][1] = methods[key][0](flex_space, fn_cluster, maxClusters=maxClusters, outPath=outPath)
 
     # Scatter plot of auto-clusters
     sns.set_theme()
@@ -82,9 +84,15 @@ def main():
     parser.add_argument('--out_path', type=str, required=True)
     parser.add_argument('--max_clusters', type=int, required=True)
     parser.add_argument('--cluster_method', type=str, required=True)
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node)
+
     inputs = {"dataFile": args.data_file, "outPath": args.out_path,
               "maxClusters": args.max_clusters, "clusterMethod": args.cluster_method}
 
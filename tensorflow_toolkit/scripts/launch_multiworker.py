@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import sys
+
+from tensorflow_toolkit.utils import launch_workers
+
+
+def main():
+    import argparse
+
+    # Input parameters
+    parser = argparse.ArgumentParser(
+        description="Run a train script as a multi-worker job in this host, e.g.: launch_multiworker.py "
+                    "--num_workers 4 -- train_het_siren.py --md_file particles.xmd ...")
+    parser.add_argument('--num_workers', type=int, required=True)
+    parser.add_argument('--cpus_per_worker', type=int, required=False, default=None)
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command and args.command[0] == "--" else args.command
+    if not command:
+        parser.error("A worker command is needed")
+
+    exit_codes = launch_workers(command, args.num_workers, cpus_per_worker=args.cpus_per_worker)
+    sys.exit(next((code for code in exit_codes if code != 0), 0))
@@ -40,6 +40,7 @@ import tensorflow as tf
 
 from tensorflow_toolkit.generators.generator_flex_consensus import Generator
 from tensorflow_toolkit.networks.flex_consensus import AutoEncoder
+from tensorflow_toolkit.utils import set_cpu_profile
 
 # # os.environ["CUDA_VISIBLE_DEVICES"]="0,2,3,4"
 # physical_devices = tf.config.list_physical_devices('GPU')
@@ -126,10 +127,17 @@ def main():
     parser.add_argument('--out_path', type=str, required=True)
     parser.add_argument('--weigths_file', type=str, required=True)
     parser.add_argument('--lat_dim', type=int, required=True)
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
+    parser.add_argument('--pipeline_share', type=float, required=False, default=None)
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None or args.pipeline_share is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node, pipeline_share=args.pipeline_share)
+
     if args.gpu:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     physical_devices = tf.config.list_physical_devices('GPU')
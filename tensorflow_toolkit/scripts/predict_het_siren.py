@@ -30,9 +30,9 @@ import os
 import numpy as np
 from pathlib import Path
 from sklearn.cluster import KMeans
+from threadpoolctl import threadpool_info
 from importlib.metadata import version
 from xmipp_metadata.image_handler import ImageHandler
-from threadpoolctl import threadpool_limits, threadpool_info
 
 if version("tensorflow") >= "2.16.0":
     os.environ["TF_USE_LEGACY_KERAS"] = "1"
@@ -41,6 +41,8 @@ from tensorboard.plugins import projector
 
 from tensorflow_toolkit.generators.generator_het_siren import Generator
 from tensorflow_toolkit.networks.het_siren import AutoEncoder
+from tensorflow_toolkit.utils import enable_xla_cache, set_cpu_profile, clustering_threadpool, \
+    shard_indices, predict_sharded, fourier_shell_indices, fsc, resolution_from_fsc
 # from tensorflow_toolkit.datasets.dataset_template import sequence_to_data_pipeline, create_dataset
 
 from xmipp_metadata.metadata import XmippMetaData
@@ -52,14 +54,18 @@ from xmipp_metadata.metadata import XmippMetaData
 #     tf.config.experimental.set_memory_growth(gpu_instance, True)
 
 
-def predict(md_file, weigths_file, refinePose, architecture, ctfType, pad=2, sr=1.0,
-            applyCTF=1, filter=False, only_pos=False, hetDim=10, numVol=20, trainSize=None, outSize=None,
-            poseReg=0.0, ctfReg=0.0, use_hyper_network=True):
+def load_autoencoder(md_file, weigths_file, refinePose, architecture, ctfType, pad=2, sr=1.0, applyCTF=1,
+                     hetDim=10, trainSize=None, outSize=None, poseReg=0.0, ctfReg=0.0, use_hyper_network=True,
+                     shard=None):
     # Create data generator
     generator = Generator(md_file=md_file, shuffle=False, batch_size=16,
                           step=1, splitTrain=1.0, pad_factor=pad, sr=sr,
                           applyCTF=applyCTF, xsize=outSize)
 
+    # Particles of this shard (shard index, number of shards)
+    if shard is not None:
+        generator.file_idx = shard_indices(generator.file_idx, *shard)
+
     # Tensorflow data pipeline
     # generator_dataset, generator = sequence_to_data_pipeline(generator)
     # dataset = create_dataset(generator_dataset, generator, shuffle=False, batch_size=16)
@@ -71,19 +77,47 @@ def predict(md_file, weigths_file, refinePose, architecture, ctfType, pad=2, sr=
     _ = autoencoder(next(iter(generator.return_tf_dataset()))[0])
     autoencoder.load_weights(weigths_file)
 
-    # Metadata
-    metadata = XmippMetaData(md_file)
+    return generator, autoencoder
 
-    # Get poses
-    print("------------------ Predicting particles... ------------------")
+
+def encode_dataset(generator, autoencoder):
     if generator.mode == "spa":
         alignment, shifts, het = autoencoder.predict(generator.return_tf_dataset(), predict_mode="het")
     elif generator.mode == "tomo":
         alignment, shifts, _, het = autoencoder.predict(generator.return_tf_dataset(), predict_mode="het")
+    return {"alignment": np.vstack(alignment), "shifts": np.vstack(shifts), "het": np.vstack(het)}
+
+
+def encode_particles(shard=None, **kwargs):
+    return encode_dataset(*load_autoencoder(shard=shard, **kwargs))
+
+
+def predict(md_file, weigths_file, refinePose, architecture, ctfType, pad=2, sr=1.0,
+            applyCTF=1, filter=False, only_pos=False, hetDim=10, numVol=20, trainSize=None, outSize=None,
+            poseReg=0.0, ctfReg=0.0, use_hyper_network=True, numWorkers=1, cpusPerWorker=None):
+    model_args = {"md_file": md_file, "weigths_file": weigths_file, "refinePose": refinePose,
+                  "architecture": architecture, "ctfType": ctfType, "pad": pad, "sr": sr, "applyCTF": applyCTF,
+                  "hetDim": hetDim, "trainSize": trainSize, "outSize": outSize, "poseReg": poseReg,
+                  "ctfReg": ctfReg, "use_hyper_network": use_hyper_network}
+
+    # Metadata
+    metadata = XmippMetaData(md_file)
+
+    # Get poses (particles split in shards processed by numWorkers processes)
+    print("------------------ Predicting particles... ------------------")
+    if numWorkers > 1:
+        encoded = predict_sharded(encode_particles, num_workers=numWorkers, cpus_per_worker=cpusPerWorker,
+                                  shard_dir=os.path.dirname(os.path.abspath(md_file)), **model_args)
+
+    # Model used to decode the volumes
+    generator, autoencoder = load_autoencoder(**model_args)
+    if numWorkers <= 1:
+        encoded = encode_dataset(generator, autoencoder)
+    alignment, shifts, het = encoded["alignment"], encoded["shifts"], encoded["het"]
 
     # Get map
     pool_info = threadpool_info()
-    with threadpool_limits(limits=1, user_api=pool_info[1]["user_api"]):
+    with clustering_threadpool(default_threads=1, default_user_api=pool_info[1]["user_api"]):
         kmeans = KMeans(n_clusters=numVol).fit(het)
     centers = kmeans.cluster_centers_
     print("------------------ Decoding volume... ------------------")
@@ -121,6 +155,18 @@ def predict(md_file, weigths_file, refinePose, architecture, ctfType, pad=2, sr=
         decoded_path = Path(Path(md_file).parent, 'decoded_map_class_%02d.mrc' % (idx + 1))
         ImageHandler().write(decoded_map, decoded_path, overwrite=True)
 
+    # Resolution of the decoded maps against the reference map (FSC = 0.5)
+    volume_path = Path(Path(md_file).parent, 'volume.mrc')
+    if volume_path.exists():
+        reference = ImageHandler(str(volume_path)).getData()
+        if reference.shape == decoded_maps.shape[1:]:
+            shell_indices = tf.constant(fourier_shell_indices(reference.shape[0], ndim=3), dtype=tf.int32)
+            for idx, decoded_map in enumerate(decoded_maps):
+                fsc_curve = fsc(decoded_map[None, ...], reference[None, ...], shell_indices=shell_indices)
+                resolution = resolution_from_fsc(fsc_curve.numpy(), sr, threshold=0.5)[0]
+                print("Decoded map class %02d: %.2f A resolution (FSC = 0.5 against %s)"
+                      % (idx + 1, resolution, volume_path.name))
+
 
 def main():
     import argparse
@@ -144,10 +190,25 @@ def main():
     parser.add_argument('--trainSize', type=int, required=True)
     parser.add_argument('--outSize', type=int, required=True)
     parser.add_argument('--use_hyper_network', action='store_true')
+    parser.add_argument('--xla_cache_dir', type=str, required=False, default=None)
+    parser.add_argument('--xla_cache', action='store_true')
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
+    parser.add_argument('--pipeline_share', type=float, required=False, default=None)
+    parser.add_argument('--num_workers', type=int, required=False, default=1)
+    parser.add_argument('--cpus_per_worker', type=int, required=False, default=None)
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None or args.pipeline_share is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node, pipeline_share=args.pipeline_share)
+
+    # Persistent cache of XLA executables (opt-in, reused by runs with the same network, box, batch and flags)
+    if args.xla_cache:
+        enable_xla_cache("het_siren", vars(args), cache_dir=args.xla_cache_dir)
+
     if args.gpu:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     physical_devices = tf.config.list_physical_devices('GPU')
@@ -160,7 +221,8 @@ def main():
               "applyCTF": args.apply_ctf, "filter": args.apply_filter,
               "only_pos": args.only_pos, "hetDim": args.het_dim, "numVol": args.num_vol,
               "trainSize": args.trainSize, "outSize": args.outSize, "poseReg": args.pose_reg, "ctfReg": args.ctf_reg,
-              "use_hyper_network": args.use_hyper_network}
+              "use_hyper_network": args.use_hyper_network, "numWorkers": args.num_workers,
+              "cpusPerWorker": args.cpus_per_worker}
 
     # Initialize volume slicer
     predict(**inputs)
@@ -41,6 +41,7 @@ import tensorflow as tf
 
 from tensorflow_toolkit.generators.generator_het_siren import Generator
 from tensorflow_toolkit.networks.het_siren import AutoEncoder
+from tensorflow_toolkit.utils import set_cpu_profile
 
 
 # # os.environ["CUDA_VISIBLE_DEVICES"]="0,2,3,4"
@@ -96,10 +97,17 @@ def main():
     parser.add_argument('--ctf_reg', type=float, required=False, default=0.0)
     parser.add_argument('--refine_pose', action='store_true')
     parser.add_argument('--use_hyper_network', action='store_true')
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
+    parser.add_argument('--pipeline_share', type=float, required=False, default=None)
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None or args.pipeline_share is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node, pipeline_share=args.pipeline_share)
+
     if args.gpu:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     else:
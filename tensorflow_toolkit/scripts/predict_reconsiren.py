@@ -39,33 +39,66 @@ import tensorflow as tf
 
 from tensorflow_toolkit.generators.generator_reconsiren import Generator
 from tensorflow_toolkit.networks.reconsiren import AutoEncoder
-from tensorflow_toolkit.utils import xmippEulerFromMatrix
+from tensorflow_toolkit.utils import xmippEulerFromMatrix, enable_xla_cache, set_cpu_profile, \
+    clustering_threadpool, shard_indices, predict_sharded
 
 
-def predict(md_file, weigths_file, architecture, ctfType, pad=2, sr=1.0, n_candidates=6,
-            applyCTF=1, filter=True, only_pose=False, only_pos=False, useHet=False):
+def load_autoencoder(md_file, weigths_file, architecture, pad=2, sr=1.0, n_candidates=6, only_pose=False,
+                     only_pos=False, useHet=False, projector="real", shard=None):
     # Create data generator
     generator = Generator(md_file=md_file, shuffle=False, batch_size=32,
                           step=1, splitTrain=1.0, cost="mse", pad_factor=pad, sr=sr,
                           applyCTF=0)
 
+    # Particles of this shard (shard index, number of shards)
+    if shard is not None:
+        generator.file_idx = shard_indices(generator.file_idx, *shard)
+
     # Load model
     autoencoder = AutoEncoder(generator, architecture=architecture, CTF=None,
                               l1_lambda=0.0, tv_lambda=0.0, mse_lambda=0.0, un_lambda=0.0001,
                               ud_lambda=0.000001, only_pose=only_pose, n_candidates=n_candidates,
-                              only_pos=only_pos, useHet=useHet)
+                              only_pos=only_pos, useHet=useHet, projector=projector)
     _ = autoencoder(next(iter(generator.return_tf_dataset()))[0])
     autoencoder.load_weights(weigths_file)
 
+    return generator, autoencoder
+
+
+def encode_dataset(generator, autoencoder):
+    r, shifts, _, het, loss, loss_cons = autoencoder.predict(generator.return_tf_dataset())
+    outputs = {"r": r, "shifts": shifts, "loss": loss, "loss_cons": loss_cons}
+    if autoencoder.useHet:
+        outputs["het"] = het
+    return outputs
+
+
+def encode_particles(shard=None, **kwargs):
+    return encode_dataset(*load_autoencoder(shard=shard, **kwargs))
+
+
+def predict(md_file, weigths_file, architecture, ctfType, pad=2, sr=1.0, n_candidates=6,
+            applyCTF=1, filter=True, only_pose=False, only_pos=False, useHet=False, projector="real",
+            numWorkers=1, cpusPerWorker=None):
+    model_args = {"md_file": md_file, "weigths_file": weigths_file, "architecture": architecture, "pad": pad,
+                  "sr": sr, "n_candidates": n_candidates, "only_pose": only_pose, "only_pos": only_pos,
+                  "useHet": useHet, "projector": projector}
+
     # Metadata
     metadata = XmippMetaData(md_file)
 
-    # Dataset
-    predict_dataset = generator.return_tf_dataset()
-
-    # Get poses
+    # Get poses (particles split in shards processed by numWorkers processes)
     print("------------------ Predicting angles and shifts... ------------------")
-    r, shifts, imgs, het, loss, loss_cons = autoencoder.predict(predict_dataset)
+    if numWorkers > 1:
+        encoded = predict_sharded(encode_particles, num_workers=numWorkers, cpus_per_worker=cpusPerWorker,
+                                  shard_dir=os.path.dirname(os.path.abspath(md_file)), **model_args)
+
+    # Model used to decode the volumes
+    generator, autoencoder = load_autoencoder(**model_args)
+    if numWorkers <= 1:
+        encoded = encode_dataset(generator, autoencoder)
+    r, shifts, loss, loss_cons = encoded["r"], encoded["shifts"], encoded["loss"], encoded["loss_cons"]
+    het = encoded.get("het")
 
     # Rotation matrix to euler angles
     euler_angles = np.zeros((r.shape[0], 3))
@@ -79,7 +112,8 @@ def predict(md_file, weigths_file, architecture, ctfType, pad=2, sr=1.0, n_candi
     decoded_map = autoencoder.eval_volume(filter=True)
 
     if useHet:
-        kmeans = KMeans(n_clusters=20).fit(het)
+        with clustering_threadpool():
+            kmeans = KMeans(n_clusters=20).fit(het)
         centers = kmeans.cluster_centers_
         labels = kmeans.predict(het)
         unique_labels = np.unique(labels)
@@ -123,11 +157,27 @@ def main():
     parser.add_argument('--only_pose', action='store_true')
     parser.add_argument('--only_pos', action='store_true')
     parser.add_argument('--heterogeneous', action='store_true')
+    parser.add_argument('--projector', type=str, required=False, default="real", choices=["real", "fourier"])
     parser.add_argument('--n_candidates', type=int, required=True)
+    parser.add_argument('--xla_cache_dir', type=str, required=False, default=None)
+    parser.add_argument('--xla_cache', action='store_true')
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
+    parser.add_argument('--pipeline_share', type=float, required=False, default=None)
+    parser.add_argument('--num_workers', type=int, required=False, default=1)
+    parser.add_argument('--cpus_per_worker', type=int, required=False, default=None)
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None or args.pipeline_share is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node, pipeline_share=args.pipeline_share)
+
+    # Persistent cache of XLA executables (opt-in, reused by runs with the same network, box, batch and flags)
+    if args.xla_cache:
+        enable_xla_cache("reconsiren", vars(args), cache_dir=args.xla_cache_dir)
+
     if args.gpu:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     physical_devices = tf.config.list_physical_devices('GPU')
@@ -138,7 +188,8 @@ def main():
               "architecture": args.architecture, "ctfType": None, "pad": args.pad, "sr": args.sr,
               "applyCTF": 0, "filter": args.apply_filter,
               "only_pose": args.only_pose, "only_pos": args.only_pos, "n_candidates": args.n_candidates,
-              "useHet": args.heterogeneous}
+              "useHet": args.heterogeneous, "projector": args.projector, "numWorkers": args.num_workers,
+              "cpusPerWorker": args.cpus_per_worker}
 
     # Initialize volume slicer
     predict(**inputs)
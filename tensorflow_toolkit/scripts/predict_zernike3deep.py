@@ -37,6 +37,8 @@ from tensorboard.plugins import projector
 
 from xmipp_metadata.metadata import XmippMetaData
 
+from tensorflow_toolkit.utils import enable_xla_cache, set_cpu_profile, shard_indices, predict_sharded
+
 # from tensorflow_toolkit.datasets.dataset_template import sequence_to_data_pipeline, create_dataset
 
 
@@ -46,8 +48,8 @@ from xmipp_metadata.metadata import XmippMetaData
 #     tf.config.experimental.set_memory_growth(gpu_instance, True)
 
 
-def predict(md_file, weigths_file, L1, L2, refinePose, architecture, ctfType, pad=2,
-            sr=1.0, applyCTF=1, poseReg=0.0, ctfReg=0.0):
+def encode_particles(md_file, weigths_file, L1, L2, refinePose, architecture, ctfType, pad=2,
+                     sr=1.0, applyCTF=1, poseReg=0.0, ctfReg=0.0, shard=None):
 
     # We need to import network and generators here instead of at the beginning of the script to allow Tensorflow
     # get the right GPUs set in CUDA_VISIBLE_DEVICES
@@ -59,6 +61,10 @@ def predict(md_file, weigths_file, L1, L2, refinePose, architecture, ctfType, pa
                           step=1, splitTrain=1.0, refinePose=refinePose, pad_factor=pad,
                           sr=sr, applyCTF=applyCTF)
 
+    # Particles of this shard (shard index, number of shards)
+    if shard is not None:
+        generator.file_idx = shard_indices(generator.file_idx, *shard)
+
     # Tensorflow data pipeline
     # generator_dataset, generator = sequence_to_data_pipeline(generator)
     # dataset = create_dataset(generator_dataset, generator, shuffle=False, batch_size=32)
@@ -68,6 +74,22 @@ def predict(md_file, weigths_file, L1, L2, refinePose, architecture, ctfType, pa
     _ = autoencoder(next(iter(generator.return_tf_dataset()))[0])
     autoencoder.load_weights(weigths_file)
 
+    # Predict step
+    encoded = autoencoder.predict(generator.return_tf_dataset())
+
+    # Get encoded data in right format
+    outputs = {"zernike_space": np.hstack([encoded[0], encoded[1], encoded[2]])}
+
+    if refinePose:
+        outputs["delta_euler"] = encoded[3]
+        outputs["delta_shifts"] = encoded[4]
+
+    return outputs
+
+
+def predict(md_file, weigths_file, L1, L2, refinePose, architecture, ctfType, pad=2,
+            sr=1.0, applyCTF=1, poseReg=0.0, ctfReg=0.0, numWorkers=1, cpusPerWorker=None):
+
     # Get Zernike3DSpace
     # zernike_space = []
     # delta_euler = []
@@ -76,16 +98,20 @@ def predict(md_file, weigths_file, L1, L2, refinePose, architecture, ctfType, pa
     # Metadata
     metadata = XmippMetaData(md_file)
 
-    # Predict step
+    # Predict step (particles split in shards processed by numWorkers processes)
     print("------------------ Predicting Zernike3D coefficients... ------------------")
-    encoded = autoencoder.predict(generator.return_tf_dataset())
+    encoded = predict_sharded(encode_particles, num_workers=numWorkers, cpus_per_worker=cpusPerWorker,
+                              shard_dir=os.path.dirname(os.path.abspath(md_file)), md_file=md_file,
+                              weigths_file=weigths_file, L1=L1, L2=L2, refinePose=refinePose,
+                              architecture=architecture, ctfType=ctfType, pad=pad, sr=sr, applyCTF=applyCTF,
+                              poseReg=poseReg, ctfReg=ctfReg)
 
     # Get encoded data in right format
-    zernike_space = np.hstack([encoded[0], encoded[1], encoded[2]])
+    zernike_space = encoded["zernike_space"]
 
     if refinePose:
-        delta_euler = encoded[3]
-        delta_shifts = encoded[4]
+        delta_euler = encoded["delta_euler"]
+        delta_shifts = encoded["delta_shifts"]
 
     # Tensorboard projector
     log_dir = os.path.join(os.path.dirname(md_file), "network", "logs")
@@ -142,12 +168,27 @@ def main():
     parser.add_argument('--ctf_reg', type=float, required=False, default=0.0)
     parser.add_argument('--ctf_type', type=str, required=True)
     parser.add_argument('--pad', type=int, required=False, default=2)
+    parser.add_argument('--xla_cache_dir', type=str, required=False, default=None)
+    parser.add_argument('--xla_cache', action='store_true')
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
+    parser.add_argument('--pipeline_share', type=float, required=False, default=None)
+    parser.add_argument('--num_workers', type=int, required=False, default=1)
+    parser.add_argument('--cpus_per_worker', type=int, required=False, default=None)
     parser.add_argument('--gpu', type=str)
     parser.add_argument('--sr', type=float, required=True)
     parser.add_argument('--apply_ctf', type=int, required=True)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None or args.pipeline_share is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node, pipeline_share=args.pipeline_share)
+
+    # Persistent cache of XLA executables (opt-in, reused by runs with the same network, box, batch and flags)
+    if args.xla_cache:
+        enable_xla_cache("zernike3deep", vars(args), cache_dir=args.xla_cache_dir)
+
     if args.gpu:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     physical_devices = tf.config.list_physical_devices('GPU')
@@ -158,7 +199,8 @@ def main():
               "L1": args.L1, "L2": args.L2, "refinePose": args.refine_pose,
               "architecture": args.architecture, "ctfType": args.ctf_type,
               "pad": args.pad, "sr": args.sr, "applyCTF": args.apply_ctf,
-              "poseReg": args.pose_reg, "ctfReg": args.ctf_reg}
+              "poseReg": args.pose_reg, "ctfReg": args.ctf_reg,
+              "numWorkers": args.num_workers, "cpusPerWorker": args.cpus_per_worker}
 
     # Initialize volume slicer
     predict(**inputs)
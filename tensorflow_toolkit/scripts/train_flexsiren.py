@@ -39,7 +39,9 @@ import tensorflow as tf
 from tensorflow.keras import mixed_precision
 
 # from tensorflow_toolkit.datasets.dataset_template import sequence_to_data_pipeline, create_dataset
-from tensorflow_toolkit.utils import epochs_from_iterations
+from tensorflow_toolkit.utils import epochs_from_iterations, enable_xla_cache, tune_batch_size, \
+    set_precision_policy, PRECISION_POLICIES, set_cpu_profile, \
+    create_strategy, worker_output_path, set_worker_config, is_multi_worker
 
 # # os.environ["CUDA_VISIBLE_DEVICES"]="0,2,3,4"
 # physical_devices = tf.config.list_physical_devices('GPU')
@@ -50,30 +52,44 @@ from tensorflow_toolkit.utils import epochs_from_iterations
 def train(outPath, md_file, latDim, batch_size, shuffle, step, splitTrain, epochs, cost,
           radius_mask, smooth_mask, refinePose, architecture="convnn", ctfType="apply", pad=2,
           sr=1.0, applyCTF=1, lr=1e-5, jit_compile=True, regNorm=1e-4, regBond=0.01, regAngle=0.01, regClashes=None,
-          tensorboard=True, weigths_file=None, poseReg=0.0, ctfReg=0.0, useMirrorStrategy=False, precision="mixed_float16"):
+          tensorboard=True, weigths_file=None, poseReg=0.0, ctfReg=0.0, useMirrorStrategy=False, precision="mixed_float16",
+          jacobianMode="autograd", hierarchicalBlock=0, compileMode=None,
+          wienerCache=None, fourierLoss=False, accumSteps=1,
+          remat=None, autoBatch=None, multiWorker=False):
 
     # We need to import network and generators here instead of at the beginning of the script to allow Tensorflow
     # get the right GPUs set in CUDA_VISIBLE_DEVICES
-    assert precision in ["float32", "mixed_float16"]
-    mixed_precision.set_global_policy(precision)
-    precision = tf.float32 if precision == "float32" else tf.float16
-    precision_scaled = tf.float32 if os.environ["TF_USE_LEGACY_KERAS"] == "1" else precision
+    precision, precision_scaled = set_precision_policy(precision)
     from tensorflow_toolkit.generators.generator_flexsiren import Generator
     from tensorflow_toolkit.networks.flexsiren import AutoEncoder
 
+    # Distribution strategy (created before any other TensorFlow operation). In multi-worker runs only the
+    # chief writes to outPath
+    if multiWorker and autoBatch is not None:
+        raise ValueError("Automatic batch size can not be used in multi-worker runs (all the workers must "
+                         "run the same batch size)")
+    strategy = create_strategy(useMirrorStrategy=useMirrorStrategy, multiWorker=multiWorker)
+    workerPath = worker_output_path(outPath, strategy)
+
     try:
         # Create data generator
         generator = Generator(md_file=md_file, shuffle=shuffle, batch_size=batch_size,
                               step=step, splitTrain=splitTrain, cost=cost, radius_mask=radius_mask,
                               smooth_mask=smooth_mask, refinePose=refinePose, pad_factor=pad,
-                              sr=sr, applyCTF=applyCTF, precision=precision)
+                              sr=sr, applyCTF=applyCTF, precision=precision,
+                              wiener_pipeline=ctfType == "wiener",
+                              wiener_cache=wienerCache if ctfType == "wiener" else None,
+                              fourier_loss=fourierLoss)
 
         # Create validation generator
         if splitTrain < 1.0:
             generator_val = Generator(md_file=md_file, shuffle=shuffle, batch_size=batch_size,
                                       step=step, splitTrain=(splitTrain - 1.0), cost=cost, radius_mask=radius_mask,
                                       smooth_mask=smooth_mask, refinePose=refinePose, pad_factor=pad,
-                                      sr=sr, applyCTF=applyCTF, precision=precision)
+                                      sr=sr, applyCTF=applyCTF, precision=precision,
+                                      wiener_pipeline=ctfType == "wiener",
+                                      wiener_cache=wienerCache if ctfType == "wiener" else None,
+                                      fourier_loss=fourierLoss)
         else:
             generator_val = None
 
@@ -81,31 +97,38 @@ def train(outPath, md_file, latDim, batch_size, shuffle, step, splitTrain, epoch
         # generator_dataset, generator = sequence_to_data_pipeline(generator)
         # dataset = create_dataset(generator_dataset, generator, batch_size=batch_size)
 
-        if useMirrorStrategy:
-            strategy = tf.distribute.MirroredStrategy()
-            strategy.run = tf.function()(strategy.run)
-        else:
-            strategy = tf.distribute.get_strategy()  # Default strategy
-
         with strategy.scope():
+            # Compilation layout: the whole train step as a single compiled function ("fused") or XLA
+            # compiled helpers called from an uncompiled step ("islands"). Open3D kernels cannot be XLA
+            # compiled, so clashes use islands by default and a fused step is traced without XLA
+            if compileMode is None:
+                compileMode = "islands" if regClashes is not None else "fused"
+
             # Train model
-            if regClashes is not None:
-                autoencoder = AutoEncoder(generator, latDim=latDim, architecture=architecture, CTF=ctfType, l_bond=regBond,
-                                          l_angle=regAngle, l_clashes=regClashes, jit_compile=jit_compile,
-                                          poseReg=poseReg, ctfReg=ctfReg, precision=precision,
-                                          precision_scaled=precision_scaled)
+            autoencoder = AutoEncoder(generator, latDim=latDim, architecture=architecture, CTF=ctfType, l_bond=regBond,
+                                      l_angle=regAngle, l_clashes=regClashes,
+                                      jit_compile=jit_compile if compileMode == "islands" else False,
+                                      poseReg=poseReg, ctfReg=ctfReg, precision=precision,
+                                      precision_scaled=precision_scaled, jacobian_mode=jacobianMode,
+                                      hierarchical_block=hierarchicalBlock, accum_steps=accumSteps,
+                                      remat=remat)
+            if compileMode == "islands" or regClashes is not None:
                 jit_compile = False
-            else:
-                autoencoder = AutoEncoder(generator, latDim=latDim, architecture=architecture, CTF=ctfType, l_bond=regBond,
-                                          l_angle=regAngle, l_clashes=regClashes, jit_compile=False,
-                                          poseReg=poseReg, ctfReg=ctfReg, precision=precision,
-                                          precision_scaled=precision_scaled)
 
             # Fine tune a previous model
             if weigths_file:
                 _ = autoencoder(next(iter(generator.return_tf_dataset()))[0])
                 autoencoder.load_weights(weigths_file)
 
+            # Largest batch size (or micro batch size with accumulation) that fits in memory
+            if autoBatch is not None:
+                batch_size, accumSteps = tune_batch_size(autoencoder, generator, batch_size, mode=autoBatch,
+                                                         jit_compile=jit_compile)
+                generator.batch_size = batch_size
+                if generator_val is not None:
+                    generator_val.batch_size = batch_size
+                autoencoder.accum_steps = accumSteps
+
             optimizer = tf.keras.optimizers.Adam(learning_rate=lr)
             autoencoder.compile(optimizer=optimizer, jit_compile=jit_compile)
             # optimizer = mixed_precision.LossScaleOptimizer(optimizer)
@@ -116,9 +139,9 @@ def train(outPath, md_file, latDim, batch_size, shuffle, step, splitTrain, epoch
             # Create a callback that saves the model's weights
             initial_epoch = 0
             if tf.__version__ < "2.16.0" or os.environ["TF_USE_LEGACY_KERAS"] == "1":
-                checkpoint_path = os.path.join(outPath, "training", "cp-{epoch:04d}.hdf5")
+                checkpoint_path = os.path.join(workerPath, "training", "cp-{epoch:04d}.hdf5")
             else:
-                checkpoint_path = os.path.join(outPath, "training", "cp-{epoch:04d}.weights.h5")
+                checkpoint_path = os.path.join(workerPath, "training", "cp-{epoch:04d}.weights.h5")
             if not os.path.isdir(os.path.dirname(checkpoint_path)):
                 os.mkdir(os.path.dirname(checkpoint_path))
             cp_callback = tf.keras.callbacks.ModelCheckpoint(filepath=checkpoint_path,
@@ -129,7 +152,7 @@ def train(outPath, md_file, latDim, batch_size, shuffle, step, splitTrain, epoch
             # Callbacks list
             if tensorboard:
                 # Tensorboard callback
-                log_dir = os.path.join(outPath, "logs")
+                log_dir = os.path.join(workerPath, "logs")
                 if not os.path.isdir(log_dir):
                     os.mkdir(log_dir)
                 tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1,
@@ -153,10 +176,11 @@ def train(outPath, md_file, latDim, batch_size, shuffle, step, splitTrain, epoch
                     initial_epoch = int(re.findall(r'\d+', latest)[0]) - 1
 
         if generator_val is not None:
-            autoencoder.fit(generator.return_tf_dataset(), validation_data=generator_val.return_tf_dataset(), epochs=epochs, validation_freq=2,
+            autoencoder.fit(generator.return_distributed_dataset(strategy),
+                            validation_data=generator_val.return_distributed_dataset(strategy), epochs=epochs, validation_freq=2,
                             callbacks=callbacks, initial_epoch=initial_epoch)
         else:
-            autoencoder.fit(generator.return_tf_dataset(), epochs=epochs,
+            autoencoder.fit(generator.return_distributed_dataset(strategy), epochs=epochs,
                             initial_epoch=initial_epoch)
     except tf.errors.ResourceExhaustedError as error:
         msg = "GPU memory has been exhausted. Usually this can be solved by " \
@@ -167,12 +191,12 @@ def train(outPath, md_file, latDim, batch_size, shuffle, step, splitTrain, epoch
 
     # Save model
     if tf.__version__ < "2.16.0" or os.environ["TF_USE_LEGACY_KERAS"] == "1":
-        autoencoder.save_weights(os.path.join(outPath, "flexsiren_model.h5"))
+        autoencoder.save_weights(os.path.join(workerPath, "flexsiren_model.h5"))
     else:
-        autoencoder.save_weights(os.path.join(outPath, "flexsiren_model.weights.h5"))
+        autoencoder.save_weights(os.path.join(workerPath, "flexsiren_model.weights.h5"))
 
-    # Remove checkpoints
-    shutil.rmtree(checkpoint)
+    # Remove checkpoints (and the scratch folder of the other workers)
+    shutil.rmtree(checkpoint if workerPath == outPath else workerPath)
 
 
 def main():
@@ -207,11 +231,41 @@ def main():
     parser.add_argument('--regClashes', type=float, default=None)
     parser.add_argument('--pose_reg', type=float, required=False, default=0.0)
     parser.add_argument('--ctf_reg', type=float, required=False, default=0.0)
+    parser.add_argument('--jacobian_mode', type=str, required=False, default="autograd",
+                        choices=["autograd", "finite_diff", "hutchinson"])
+    parser.add_argument('--hierarchical_block', type=int, required=False, default=0)
+    parser.add_argument('--compile_mode', type=str, required=False, default=None, choices=["fused", "islands"])
     parser.add_argument('--tensorboard', action='store_true')
+    parser.add_argument('--wiener_cache', type=str, required=False, default=None)
+    # Opt-in image loss on the padded Fourier transforms (not equivalent to the default real space loss)
+    parser.add_argument('--fourier_loss', action='store_true')
+    parser.add_argument('--accum_steps', type=int, required=False, default=1)
+    parser.add_argument('--auto_batch', type=str, required=False, default=None, choices=["batch", "accum"])
+    parser.add_argument('--precision', type=str, required=False, default="mixed_float16", choices=PRECISION_POLICIES)
+    parser.add_argument('--remat', type=str, required=False, default=None)
+    parser.add_argument('--xla_cache_dir', type=str, required=False, default=None)
+    parser.add_argument('--xla_cache', action='store_true')
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
+    parser.add_argument('--pipeline_share', type=float, required=False, default=None)
+    parser.add_argument('--workers', type=str, required=False, default=None)
+    parser.add_argument('--worker_index', type=int, required=False, default=0)
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None or args.pipeline_share is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node, pipeline_share=args.pipeline_share)
+
+    # Multi-worker cluster (TF_CONFIG may also be set by launch_multiworker.py)
+    if args.workers:
+        set_worker_config(args.workers, args.worker_index)
+
+    # Persistent cache of XLA executables (opt-in, reused by runs with the same network, box, batch and flags)
+    if args.xla_cache:
+        enable_xla_cache("flexsiren", vars(args), cache_dir=args.xla_cache_dir)
+
     if args.gpu:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     physical_devices = tf.config.list_physical_devices('GPU')
@@ -238,7 +292,12 @@ def main():
               "regNorm": args.regNorm, "regBond": args.regBond, "regAngle": args.regAngle,
               "poseReg": args.pose_reg, "ctfReg": args.ctf_reg,
               "regClashes": args.regClashes, "tensorboard": args.tensorboard, "weigths_file": args.weigths_file,
-              "useMirrorStrategy": useMirrorStrategy}
+              "useMirrorStrategy": useMirrorStrategy, "jacobianMode": args.jacobian_mode,
+              "hierarchicalBlock": args.hierarchical_block, "compileMode": args.compile_mode,
+              "wienerCache": args.wiener_cache,
+              "fourierLoss": args.fourier_loss, "accumSteps": args.accum_steps,
+              "remat": args.remat, "autoBatch": args.auto_batch,
+              "precision": args.precision, "multiWorker": is_multi_worker()}
 
     # Initialize volume slicer
     train(**inputs)
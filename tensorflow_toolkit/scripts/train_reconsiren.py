@@ -44,18 +44,34 @@ os.environ["TF_USE_LEGACY_KERAS"] = "0"
 import tensorflow as tf
 # from tensorflow.keras import mixed_precision
 
-from tensorflow_toolkit.utils import epochs_from_iterations, xmippEulerFromMatrix
+from tensorflow_toolkit.utils import epochs_from_iterations, xmippEulerFromMatrix, enable_xla_cache, \
+    tune_batch_size, set_precision_policy, PRECISION_POLICIES, set_cpu_profile, \
+    create_strategy, worker_output_path, set_worker_config, is_multi_worker, clustering_threadpool
 
 
 def train(outPath, md_file, batch_size, shuffle, splitTrain, epochs, only_pose=False, n_candidates=6,
           architecture="convnn", weigths_file=None, ctfType=None, pad=4, sr=1.0, applyCTF=0, l1Reg=0.5,
           tvReg=0.1, mseReg=0.1, udLambda=0.000001, unLambda=0.0001, only_pos=False, useHet=False,
-          jit_compile=True, tensorboard=True):
+          jit_compile=True, tensorboard=True, projector="real", accumSteps=1,
+          autoBatch=None, precision="float32", multiWorker=False):
     # We need to import network and generators here instead of at the beginning of the script to allow Tensorflow
     # get the right GPUs set in CUDA_VISIBLE_DEVICES
+    # ReconSIREN projections and losses always run in float32
+    # float16 gradients would need loss scaling, which is not implemented for ReconSIREN
+    if precision == "mixed_float16":
+        raise ValueError("ReconSIREN only supports float32 and mixed_bfloat16 precision")
+    set_precision_policy(precision)
     from tensorflow_toolkit.generators.generator_reconsiren import Generator
     from tensorflow_toolkit.networks.reconsiren import AutoEncoder
 
+    # Distribution strategy (created before any other TensorFlow operation). In multi-worker runs only the
+    # chief writes to outPath
+    if multiWorker and autoBatch is not None:
+        raise ValueError("Automatic batch size can not be used in multi-worker runs (all the workers must "
+                         "run the same batch size)")
+    strategy = create_strategy(multiWorker=multiWorker)
+    workerPath = worker_output_path(outPath, strategy)
+
     try:
         # Create data generator
         generator = Generator(md_file=md_file, shuffle=shuffle, batch_size=batch_size,
@@ -73,20 +89,28 @@ def train(outPath, md_file, batch_size, shuffle, splitTrain, epochs, only_pose=F
         else:
             generator_val = None
 
-        strategy = tf.distribute.get_strategy()  # Default strategy
-
         with strategy.scope():
             # Train model
             autoencoder = AutoEncoder(generator, architecture=architecture, CTF=None,
                                       l1_lambda=l1Reg, tv_lambda=tvReg, mse_lambda=mseReg, un_lambda=unLambda,
                                       ud_lambda=udLambda, only_pose=only_pose, n_candidates=n_candidates,
-                                      only_pos=only_pos, multires=None, useHet=useHet)
+                                      only_pos=only_pos, multires=None, useHet=useHet, projector=projector,
+                                      accum_steps=accumSteps)
 
             # Fine tune a previous model
             if weigths_file:
                 _ = autoencoder(next(iter(generator.return_tf_dataset()))[0])
                 autoencoder.load_weights(weigths_file)
 
+            # Largest batch size (or micro batch size with accumulation) that fits in memory
+            if autoBatch is not None:
+                batch_size, accumSteps = tune_batch_size(autoencoder, generator, batch_size, mode=autoBatch,
+                                                         jit_compile=jit_compile)
+                generator.batch_size = batch_size
+                if generator_val is not None:
+                    generator_val.batch_size = batch_size
+                autoencoder.accum_steps = accumSteps
+
             if only_pose:
                 optimizer_encoder = [tf.keras.optimizers.RMSprop(learning_rate=1e-5),
                                      tf.keras.optimizers.Adam(learning_rate=1e-5)]
@@ -113,9 +137,9 @@ def train(outPath, md_file, batch_size, shuffle, splitTrain, epochs, only_pose=F
             # Create a callback that saves the model's weights
             initial_epoch = 0
             if tf.__version__ < "2.16.0" or os.environ["TF_USE_LEGACY_KERAS"] == "1":
-                checkpoint_path = os.path.join(outPath, "training", "cp-{epoch:04d}.hdf5")
+                checkpoint_path = os.path.join(workerPath, "training", "cp-{epoch:04d}.hdf5")
             else:
-                checkpoint_path = os.path.join(outPath, "training", "cp-{epoch:04d}.weights.h5")
+                checkpoint_path = os.path.join(workerPath, "training", "cp-{epoch:04d}.weights.h5")
             if not os.path.isdir(os.path.dirname(checkpoint_path)):
                 os.mkdir(os.path.dirname(checkpoint_path))
             cp_callback = tf.keras.callbacks.ModelCheckpoint(filepath=checkpoint_path,
@@ -126,7 +150,7 @@ def train(outPath, md_file, batch_size, shuffle, splitTrain, epochs, only_pose=F
             # Callbacks list
             if tensorboard:
                 # Tensorboard callback
-                log_dir = os.path.join(outPath, "logs")
+                log_dir = os.path.join(workerPath, "logs")
                 if not os.path.isdir(log_dir):
                     os.mkdir(log_dir)
                 tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1,
@@ -151,10 +175,10 @@ def train(outPath, md_file, batch_size, shuffle, splitTrain, epochs, only_pose=F
             steps = ceil(epochs / 5)
             md = XmippMetaData(md_file)
 
-            train_dataset = generator.return_tf_dataset(preShuffle=True)
+            train_dataset = generator.return_distributed_dataset(strategy, preShuffle=True)
             predict_dataset = generator_pred.return_tf_dataset()
             if generator_val is not None:
-                validation_dataset = generator_val.return_tf_dataset()
+                validation_dataset = generator_val.return_distributed_dataset(strategy)
 
             for idx in range(steps):
                 if generator_val is not None:
@@ -185,24 +209,25 @@ def train(outPath, md_file, batch_size, shuffle, splitTrain, epochs, only_pose=F
                 if not autoencoder.only_pose:
 
                     decoded_map = autoencoder.eval_volume(filter=True, het=None)
-                    decoded_path = os.path.join(outPath, f'decoded_map_no_het.mrc')
+                    decoded_path = os.path.join(workerPath, f'decoded_map_no_het.mrc')
                     ImageHandler().write(decoded_map, decoded_path, overwrite=True)
 
                 if useHet:
-                    kmeans = KMeans(n_clusters=20).fit(het)
+                    with clustering_threadpool():
+                        kmeans = KMeans(n_clusters=20).fit(het)
                     labels = kmeans.predict(het)
                     unique_labels = np.unique(labels)
                     centers = kmeans.cluster_centers_
                     decoded_maps = autoencoder.eval_volume(filter=True, het=centers)
                     idx = 0
                     for decoded_map in decoded_maps:
-                        decoded_path = os.path.join(outPath, f'decoded_map_{unique_labels[idx]:02}.mrc')
+                        decoded_path = os.path.join(workerPath, f'decoded_map_{unique_labels[idx]:02}.mrc')
                         ImageHandler().write(decoded_map, decoded_path, overwrite=True)
                         idx += 1
                     md[:, "cluster_labels"] = labels
                     md[:, "reproj_het_error"] = loss
 
-                md.write(os.path.join(outPath, f'metadata_pred_angles.xmd'), overwrite=True)
+                md.write(os.path.join(workerPath, f'metadata_pred_angles.xmd'), overwrite=True)
 
     except tf.errors.ResourceExhaustedError as error:
         msg = "GPU memory has been exhausted. Usually this can be solved by " \
@@ -213,12 +238,12 @@ def train(outPath, md_file, batch_size, shuffle, splitTrain, epochs, only_pose=F
 
     # Save model
     if tf.__version__ < "2.16.0" or os.environ["TF_USE_LEGACY_KERAS"] == "1":
-        autoencoder.save_weights(os.path.join(outPath, "reconsiren_model.h5"))
+        autoencoder.save_weights(os.path.join(workerPath, "reconsiren_model.h5"))
     else:
-        autoencoder.save_weights(os.path.join(outPath, "reconsiren_model.weights.h5"))
+        autoencoder.save_weights(os.path.join(workerPath, "reconsiren_model.weights.h5"))
 
-    # Remove checkpoints
-    shutil.rmtree(checkpoint)
+    # Remove checkpoints (and the scratch folder of the other workers)
+    shutil.rmtree(checkpoint if workerPath == outPath else workerPath)
 
 
 def main():
@@ -250,11 +275,35 @@ def main():
     parser.add_argument('--sr', type=float, required=True)
     # parser.add_argument('--apply_ctf', type=int, required=True)
     parser.add_argument('--jit_compile', action='store_true')
+    parser.add_argument('--projector', type=str, required=False, default="real", choices=["real", "fourier"])
+    parser.add_argument('--accum_steps', type=int, required=False, default=1)
+    parser.add_argument('--auto_batch', type=str, required=False, default=None, choices=["batch", "accum"])
+    parser.add_argument('--precision', type=str, required=False, default="float32",
+                        choices=[policy for policy in PRECISION_POLICIES if policy != "mixed_float16"])
     parser.add_argument('--tensorboard', action='store_true')
+    parser.add_argument('--xla_cache_dir', type=str, required=False, default=None)
+    parser.add_argument('--xla_cache', action='store_true')
+    parser.add_argument('--cpu_threads', type=int, required=False, default=None)
+    parser.add_argument('--numa_node', type=int, required=False, default=None)
+    parser.add_argument('--pipeline_share', type=float, required=False, default=None)
+    parser.add_argument('--workers', type=str, required=False, default=None)
+    parser.add_argument('--worker_index', type=int, required=False, default=0)
     parser.add_argument('--gpu', type=str)
 
     args = parser.parse_args()
 
+    # Thread pools of TensorFlow, BLAS and OpenMP (before TensorFlow creates them, only if a profile is requested)
+    if args.cpu_threads is not None or args.numa_node is not None or args.pipeline_share is not None:
+        set_cpu_profile(threads=args.cpu_threads, numa_node=args.numa_node, pipeline_share=args.pipeline_share)
+
+    # Multi-worker cluster (TF_CONFIG may also be set by launch_multiworker.py)
+    if args.workers:
+        set_worker_config(args.workers, args.worker_index)
+
+    # Persistent cache of XLA executables (opt-in, reused by runs with the same network, box, batch and flags)
+    if args.xla_cache:
+        enable_xla_cache("reconsiren", vars(args), cache_dir=args.xla_cache_dir)
+
     if args.gpu:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
     physical_devices = tf.config.list_physical_devices('GPU')
@@ -279,7 +328,9 @@ def main():
               "udLambda": args.ud_lambda, "unLambda": args.un_lambda,
               "jit_compile": args.jit_compile, "tensorboard": args.tensorboard,
               "only_pose": args.only_pose, "only_pos": args.only_pos, "n_candidates": args.n_candidates,
-              "useHet": args.heterogeneous}
+              "useHet": args.heterogeneous, "projector": args.projector,
+              "accumSteps": args.accum_steps, "autoBatch": args.auto_batch,
+              "precision": args.precision, "multiWorker": is_multi_worker()}
 
     # Initialize volume slicer
     train(**inputs)
@@ -26,3 +26,13 @@
 
 from .utils import *
 from .utils_zernike3d import *
+from .utils_fourier_slice import *
+from .utils_xla_cache import *
+from .utils_particle_cache import *
+from .utils_gradient_accumulation import *
+from .utils_remat import *
+from .utils_batch_tuner import *
+from .utils_precision import *
+from .utils_cpu_profile import *
+from .utils_distributed import *
+from .utils_sharded_inference import *
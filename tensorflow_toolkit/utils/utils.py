@@ -26,6 +26,7 @@
 
 
 import math
+from collections import namedtuple
 import numpy as np
 import scipy.stats as st
 
@@ -223,6 +224,9 @@ def eval_ctf(s, a, def1, def2, angast=0, phase=0, kv=300, ac=0.1, cs=2.0, bf=0,
         ctf *= tf.exp(-k4 * s_2)
     return ctf
 
+# Per batch information of the particles (Euler angles, shifts and CTFs), passed explicitly to the networks
+BatchContext = namedtuple("BatchContext", ["euler", "shifts", "ctf"])
+
 def computeCTF(defocusU, defocusV, defocusAngle, cs, kv, sr, pad_factor, img_shape, batch_size, applyCTF):
     if applyCTF == 1:
         # s, a = ctf_freqs([img_shape[0], img_shape[0]], 1 / sr)
@@ -390,3 +394,192 @@ def apply_blur_filters_to_batch(images, filters):
     # Apply the filters
     blurred_images = tf.nn.depthwise_conv2d(images, filters, strides=[1, 1, 1, 1], padding='SAME')
     return blurred_images
+
+def create_blur_masks(num_filters, max_std, filter_size, boxsize):
+    """
+    Create the Fourier space version of the blur filters of create_blur_filters (transfer function of every
+    filter on the real FFT grid of the images).
+
+    Args:
+    - num_filters: The number of blur filters to create.
+    - max_std: The maximum standard deviation for the Gaussian blur.
+    - filter_size: The size of each filter.
+    - boxsize: The size of the images the masks are applied to.
+
+    Returns:
+    - A complex64 tensor with shape (N, boxsize, boxsize // 2 + 1).
+    """
+    std_intervals = np.linspace(0.1, max_std, num_filters)
+    center = (filter_size - 1) // 2
+    kernel_idx = (np.arange(filter_size) - center) % boxsize
+    masks = []
+    for std in std_intervals:
+        # Periodic kernel with the center of the 'SAME' convolution at the origin
+        kernel = np.zeros((boxsize, boxsize))
+        np.add.at(kernel, (kernel_idx[:, None], kernel_idx[None, :]), gaussian_kernel(filter_size, std))
+
+        # TF convolutions are cross-correlations (conjugated transfer function)
+        masks.append(np.conj(np.fft.rfft2(kernel)))
+
+    masks = np.stack(masks, axis=0)
+    return tf.constant(masks, dtype=tf.complex64)
+
+def apply_blur_masks_to_batch(images, masks):
+    """
+    Apply a set of Fourier blur masks to a batch of images. All the levels are computed from a single
+    FFT of every image (same result as apply_blur_filters_to_batch with periodic boundaries).
+
+    Args:
+    - images: Batch of images with shape (B, W, H, 1).
+    - masks: Masks to apply, with shape (N, W, H // 2 + 1) (see create_blur_masks).
+
+    Returns:
+    - Batch of blurred images with shape (B, W, H, N).
+    """
+    ft_images = tf.signal.rfft2d(tf.cast(images[..., 0], tf.float32))
+    blurred_images = tf.signal.irfft2d(ft_images[:, None, :, :] * masks[None, ...], fft_length=tf.shape(images)[1:3])
+    return tf.cast(tf.transpose(blurred_images, perm=[0, 2, 3, 1]), images.dtype)
+
+def fourier_shell_indices(boxsize, ndim=2):
+    """
+    Compute the Fourier ring (2D) or shell (3D) index of every frequency of a real FFT (unshifted layout).
+
+    Args:
+    - boxsize: Size of the images or volumes.
+    - ndim: Number of dimensions (2 for rings, 3 for shells).
+
+    Returns:
+    - An int32 numpy array with shape (boxsize, boxsize // 2 + 1) or (boxsize, boxsize, boxsize // 2 + 1).
+      Frequencies beyond the last ring (boxsize // 2 - 1) are assigned to an extra ring (boxsize // 2).
+    """
+    freqs = (ndim - 1) * [np.fft.fftfreq(boxsize) * boxsize] + [np.fft.rfftfreq(boxsize) * boxsize]
+    grids = np.meshgrid(*freqs, indexing="ij")
+    radius = np.round(np.sqrt(np.sum([grid ** 2. for grid in grids], axis=0))).astype(np.int32)
+    return np.minimum(radius, boxsize // 2)
+
+def fourier_shell_sum(values, shell_indices, num_shells):
+    """
+    Sum a batch of Fourier space values over rings/shells (segment reduction, no dense ring masks).
+
+    Args:
+    - values: Real values with shape (B, ...), where the trailing shape matches shell_indices.
+    - shell_indices: Ring/shell index of every frequency (see fourier_shell_indices).
+    - num_shells: Number of rings/shells to keep.
+
+    Returns:
+    - A tensor with shape (B, num_shells).
+    """
+    batch_size_scope = tf.shape(values)[0]
+    values = tf.transpose(tf.reshape(values, [batch_size_scope, -1]))
+    sums = tf.math.unsorted_segment_sum(values, tf.reshape(shell_indices, [-1]), num_shells + 1)
+    return tf.transpose(sums[:num_shells])
+
+def fourier_shell_correlation(ft_1, ft_2, shell_indices, num_shells):
+    """
+    Fourier ring/shell correlation between two batches of Fourier transforms.
+
+    Args:
+    - ft_1: Batch of Fourier transforms with shape (B, ...) (real FFT, unshifted layout).
+    - ft_2: Batch of Fourier transforms with the same shape as ft_1.
+    - shell_indices: Ring/shell index of every frequency (see fourier_shell_indices).
+    - num_shells: Number of rings/shells to keep.
+
+    Returns:
+    - A tensor with shape (B, num_shells).
+    """
+    real_1, imag_1 = tf.math.real(ft_1), tf.math.imag(ft_1)
+    real_2, imag_2 = tf.math.real(ft_2), tf.math.imag(ft_2)
+
+    # Normalization per ring
+    nrm_1 = fourier_shell_sum(real_1 ** 2. + imag_1 ** 2., shell_indices, num_shells)
+    nrm_2 = fourier_shell_sum(real_2 ** 2. + imag_2 ** 2., shell_indices, num_shells)
+    nrm = tf.maximum(tf.sqrt(nrm_1) * tf.sqrt(nrm_2), 1e-4)  # So we do not divide by 0
+
+    # Cross correlation per ring
+    ccc = fourier_shell_sum(real_1 * real_2 + imag_1 * imag_2, shell_indices, num_shells)
+    return ccc / nrm
+
+def fsc(volumes_1, volumes_2, shell_indices=None):
+    """
+    Fourier shell correlation between two batches of volumes with shape (B, N, N, N) (a batch of one volume
+    is broadcast against the other batch).
+
+    Returns:
+    - A tensor with shape (B, N // 2).
+    """
+    boxsize = volumes_1.shape[1]
+    if shell_indices is None:
+        shell_indices = tf.constant(fourier_shell_indices(boxsize, ndim=3), dtype=tf.int32)
+    ft_1 = tf.signal.rfft3d(tf.cast(volumes_1, tf.float32))
+    ft_2 = tf.signal.rfft3d(tf.cast(volumes_2, tf.float32))
+    return fourier_shell_correlation(ft_1, ft_2, shell_indices, boxsize // 2)
+
+def resolution_from_fsc(fsc_curve, sr, threshold=0.143):
+    """
+    Estimate the resolution (in Angstroms) at which a FSC curve drops below a threshold.
+
+    Args:
+    - fsc_curve: FSC values with shape (N // 2,) or (B, N // 2).
+    - sr: Sampling rate (Angstroms / pixel).
+    - threshold: Correlation threshold (0.143 for half maps, 0.5 for map vs reference).
+
+    Returns:
+    - The resolution for each curve (Nyquist if the curve never drops below the threshold).
+    """
+    fsc_curve = np.atleast_2d(np.asarray(fsc_curve))
+    boxsize = 2 * fsc_curve.shape[1]
+    resolution = []
+    for curve in fsc_curve:
+        below = np.where(curve[1:] < threshold)[0]
+        shell = below[0] + 1 if below.size > 0 else fsc_curve.shape[1]
+        resolution.append(boxsize * sr / shell)
+    return np.asarray(resolution)
+
+def trilinear_splat(volumes, positions, values):
+    """
+    Accumulate (splat) values at continuous positions into a batch of volumes with trilinear weights.
+
+    Args:
+    - volumes: Volumes with shape (B, N, N, N) where the values are accumulated.
+    - positions: Continuous voxel positions (Z, Y, X) with shape (B, M, 3).
+    - values: Values to splat with shape (B, M).
+
+    Returns:
+    - The updated volumes. Contributions falling outside the box are discarded.
+    """
+    boxsize = tf.shape(volumes)[1:]
+    B, M = tf.shape(positions)[0], tf.shape(positions)[1]
+    positions = tf.cast(positions, tf.float32)
+    values = tf.cast(values, tf.float32)
+
+    pos_floor = tf.floor(positions)
+    frac = positions - pos_floor
+    pos_floor = tf.cast(pos_floor, tf.int32)
+    batch_idx = tf.tile(tf.range(B)[:, None, None], (1, M, 1))
+
+    for corner in range(8):
+        offset = tf.constant([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1], dtype=tf.int32)
+        weights = tf.reduce_prod(tf.where(offset[None, None, :] == 1, frac, 1. - frac), axis=-1)
+        pos = pos_floor + offset[None, None, :]
+
+        # Out of box contributions are discarded
+        inside = tf.reduce_all((pos >= 0) & (pos < boxsize[None, None, :]), axis=-1)
+        weights = tf.where(inside, weights, tf.zeros_like(weights))
+        pos = tf.clip_by_value(pos, 0, boxsize[None, None, :] - 1)
+
+        volumes = tf.tensor_scatter_nd_add(volumes, tf.concat([batch_idx, pos], axis=-1), weights * values)
+
+    return volumes
+
+def gaussian_filter_fourier(volumes, sigma=1.0):
+    """
+    Gaussian filter of a batch of volumes with shape (B, N, N, N) in a single batched Fourier pass.
+    """
+    boxsize = volumes.shape[-1]
+    freq = np.fft.fftfreq(boxsize)
+    freq_r = np.fft.rfftfreq(boxsize)
+    freq_2 = freq[:, None, None] ** 2. + freq[None, :, None] ** 2. + freq_r[None, None, :] ** 2.
+    transfer = tf.constant(np.exp(-2. * (np.pi * sigma) ** 2. * freq_2), dtype=tf.complex64)
+
+    ft_volumes = tf.signal.rfft3d(tf.cast(volumes, tf.float32))
+    return tf.signal.irfft3d(ft_volumes * transfer[None, ...], fft_length=[boxsize, boxsize, boxsize])
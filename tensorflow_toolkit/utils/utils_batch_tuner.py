@@ -0,0 +1,179 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import os
+import time
+import resource
+import subprocess
+import numpy as np
+
+import tensorflow as tf
+
+
+def peak_memory():
+    """Peak memory of the process in MB (device memory on GPU, resident set size on CPU)."""
+    if tf.config.list_physical_devices('GPU'):
+        return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 1024 ** 2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_memory():
+    """Reset the peak memory counter (only possible on GPU, the resident set size peak never decreases)."""
+    if tf.config.list_physical_devices('GPU'):
+        tf.config.experimental.reset_memory_stats("GPU:0")
+
+
+def available_memory():
+    """
+    Memory that the process may use in MB: total memory of the first visible GPU or, on CPU, the current
+    resident set size plus the free host memory. Returns None if it can not be determined.
+    """
+    if tf.config.list_physical_devices('GPU'):
+        device = os.environ.get("CUDA_VISIBLE_DEVICES", "0").split(",")[0]
+        try:
+            output = subprocess.check_output(["nvidia-smi", "--query-gpu=memory.total",
+                                              "--format=csv,noheader,nounits", "-i", device])
+            return float(output.decode().strip().splitlines()[0])
+        except (OSError, subprocess.CalledProcessError, ValueError, IndexError):
+            return None
+
+    try:
+        with open("/proc/meminfo") as meminfo:
+            free = [int(line.split()[1]) for line in meminfo if line.startswith("MemAvailable:")][0] / 1024
+        with open("/proc/self/status") as status:
+            rss = [int(line.split()[1]) for line in status if line.startswith("VmRSS:")][0] / 1024
+        return free + rss
+    except (OSError, IndexError, ValueError):
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def synthetic_batch(generator, batch_size, xsize=None):
+    """
+    Random batch with the structure, shapes and types of the batches of generator.return_tf_dataset.
+
+    Args:
+    - generator: Data generator of the network.
+    - batch_size: Number of particles in the batch.
+    - xsize: Box size of the particles fed to the network (generator.xsize if None).
+
+    Returns:
+    - The batch (images, indexes) or, in tomo mode, ((images, labels), (indexes, indexes)).
+    """
+    xsize = generator.xsize if xsize is None else xsize
+    indexes = np.random.choice(generator.file_idx, batch_size)
+    images = np.random.randn(batch_size, xsize, xsize, 1).astype(np.float32)
+    if generator.mode == "tomo":
+        labels = generator.sinusoid_table[np.random.randint(0, generator.sinusoid_table.shape[0], batch_size)]
+        return (images, labels), (indexes, indexes)
+    return images, indexes
+
+
+def tune_batch_size(autoencoder, generator, batch_size, mode="batch", safety=0.8, trial_steps=3, xsize=None,
+                    jit_compile=False):
+    """
+    Choose the batch size (or the micro batch size and number of accumulation steps) that fits in memory.
+
+    A few train steps (forward and backward passes, no weights are updated) are run with synthetic batches
+    of increasing size (powers of two up to batch_size). For every size, the peak memory and the throughput
+    are measured. Sizes whose peak memory (extrapolated linearly from the previous trials) exceeds the
+    safety fraction of the available memory are not run.
+
+    Args:
+    - autoencoder: Network to tune. It must implement compute_gradients (see accumulate_gradients).
+    - generator: Data generator of the network.
+    - batch_size: Requested (global) batch size.
+    - mode: "batch" chooses the largest batch size that fits (not larger than batch_size). "accum" keeps
+      batch_size as the logical batch and chooses the micro batch size and the accumulation steps with the
+      shortest time per batch.
+    - safety: Fraction of the available memory that the training may use.
+    - trial_steps: Steps per trial size (the first one, which includes tracing and compilation, is not timed).
+    - xsize: Box size of the particles fed to the network (generator.xsize if None).
+    - jit_compile: Whether the train step is compiled with XLA.
+
+    Returns:
+    - The batch size and the number of gradient accumulation steps.
+    """
+    if mode not in ["batch", "accum"]:
+        raise ValueError("Batch tuning mode must be one of: batch, accum")
+
+    # Trial sizes refer to a single replica
+    replicas = tf.distribute.get_strategy().num_replicas_in_sync
+    replica_batch_size = max(batch_size // replicas, 1)
+    sizes = [2 ** idx for idx in range(int(np.log2(replica_batch_size)) + 1)]
+    if sizes[-1] != replica_batch_size:
+        sizes.append(replica_batch_size)
+
+    budget = available_memory()
+    budget = np.inf if budget is None else safety * budget
+
+    step_fn = tf.function(autoencoder.compute_gradients, jit_compile=jit_compile)
+    trials = {}
+    for size in sizes:
+        # Skip sizes predicted not to fit (linear fit of the measured peaks)
+        if len(trials) >= 2:
+            fit = np.polyfit(list(trials.keys()), [memory for memory, _ in trials.values()], 1)
+            if np.polyval(fit, size) > budget:
+                break
+
+        try:
+            reset_peak_memory()
+            times = []
+            for _ in range(trial_steps):
+                batch = synthetic_batch(generator, size, xsize=xsize)
+                start = time.perf_counter()
+                _, losses, _ = step_fn(batch)
+                _ = [loss.numpy() for loss in tf.nest.flatten(losses)]
+                times.append(time.perf_counter() - start)
+        except tf.errors.ResourceExhaustedError:
+            break
+
+        memory = peak_memory()
+        if memory > budget:
+            break
+        trials[size] = (memory, size / np.mean(times[1:] if len(times) > 1 else times))
+
+    if not trials:
+        raise MemoryError("Not even a batch with a single particle fits in the available memory")
+
+    print("Batch size tuner (memory budget %.1f MB)" % budget)
+    print("%-12s %14s %18s" % ("Batch size", "Peak (MB)", "Particles / s"))
+    for size, (memory, throughput) in trials.items():
+        print("%-12d %14.1f %18.1f" % (size, memory, throughput))
+
+    if mode == "batch":
+        tuned_size, accum_steps = max(trials.keys()), 1
+    else:
+        # Shortest time per logical batch (accumulation steps times the time of a micro batch)
+        batch_time = {size: int(np.ceil(replica_batch_size / size)) * size / throughput
+                      for size, (_, throughput) in trials.items()}
+        micro_size = min(batch_time, key=batch_time.get)
+        tuned_size, accum_steps = replica_batch_size, int(np.ceil(replica_batch_size / micro_size))
+
+    print("Batch size tuner: batch size %d with %d accumulation steps (%d replicas)"
+          % (replicas * tuned_size, accum_steps, replicas))
+    return replicas * tuned_size, accum_steps
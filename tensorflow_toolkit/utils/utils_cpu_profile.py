@@ -0,0 +1,180 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import os
+from contextlib import nullcontext
+
+import tensorflow as tf
+
+
+# Execution profile of the current process (set by set_cpu_profile)
+_CPU_PROFILE = None
+
+# Environment variables read by the BLAS / OpenMP runtimes loaded after the profile is set (and by subprocesses)
+_THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "BLIS_NUM_THREADS",
+                    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+
+def parse_cpu_list(cpu_list):
+    """CPU ids in a kernel cpulist string (e.g. "0-15,64-79")."""
+    cpus = []
+    for cpu_range in cpu_list.strip().split(","):
+        if not cpu_range:
+            continue
+        if "-" in cpu_range:
+            first, last = cpu_range.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(cpu_range))
+    return cpus
+
+
+def numa_node_cpus(numa_node):
+    """CPU ids of a NUMA node (read from sysfs)."""
+    cpu_list_file = "/sys/devices/system/node/node%d/cpulist" % numa_node
+    if not os.path.isfile(cpu_list_file):
+        raise ValueError("NUMA node %d not found" % numa_node)
+    with open(cpu_list_file) as fid:
+        return parse_cpu_list(fid.read())
+
+
+def bind_cpus(cpus):
+    """
+    Bind all the threads of the current process to a set of CPUs. Threads created afterwards (TensorFlow
+    thread pools, tf.data workers...) inherit the affinity, and their memory is allocated on the local NUMA
+    node by the first touch policy of the kernel.
+    """
+    task_dir = "/proc/self/task"
+    tids = [int(tid) for tid in os.listdir(task_dir)] if os.path.isdir(task_dir) else [0]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            # Thread finished in the meantime
+            pass
+
+
+def set_cpu_profile(threads=None, numa_node=None, pipeline_share=None, inter_op_threads=2, report=True):
+    """
+    Configure coherently the thread pools of the current process, so every stage gets a predictable share of
+    the cores instead of each runtime grabbing all of them:
+
+    - Input pipeline: tf.data private thread pool (see pipeline_options), pipeline_share of the threads.
+    - Model: TensorFlow intra-op pool (and BLAS / OpenMP pools of the linear algebra libraries), the rest.
+    - Clustering: sklearn / BLAS pools while clustering (see clustering_threadpool). Clustering runs after
+      the network, so it gets all the threads of the profile.
+
+    It must be called before TensorFlow executes any operation (thread pools are created at that moment).
+
+    Args:
+    - threads: Number of threads of the process (all the CPUs available if None).
+    - numa_node: Bind the process to the CPUs (and local memory) of this NUMA node.
+    - pipeline_share: Fraction of the threads reserved for the input pipeline workers (0.125 if None).
+    - inter_op_threads: Number of independent operations executed concurrently.
+    - report: Print the execution profile.
+
+    Returns:
+    - Dictionary with the CPUs and the number of threads of each stage.
+    """
+    global _CPU_PROFILE
+
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    if numa_node is not None:
+        cpus = [cpu for cpu in numa_node_cpus(numa_node) if cpu in cpus]
+        if not cpus:
+            raise ValueError("None of the CPUs of NUMA node %d is available to this process" % numa_node)
+    if threads is not None:
+        cpus = cpus[:threads]
+    if hasattr(os, "sched_setaffinity"):
+        bind_cpus(cpus)
+
+    threads = len(cpus)
+    pipeline_share = 0.125 if pipeline_share is None else pipeline_share
+    pipeline_threads = max(1, int(round(pipeline_share * threads)))
+    model_threads = max(1, threads - pipeline_threads)
+    inter_op_threads = max(1, min(inter_op_threads, model_threads))
+
+    # TensorFlow thread pools
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(model_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        print("Warning: TensorFlow is already initialized, its thread pools keep their previous size")
+
+    # BLAS / OpenMP thread pools (already loaded runtimes through threadpoolctl)
+    for env_var in _THREAD_ENV_VARS:
+        os.environ[env_var] = str(model_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=model_threads)
+    except ImportError:
+        pass
+
+    _CPU_PROFILE = {"cpus": cpus, "numa_node": numa_node, "threads": threads, "model_threads": model_threads,
+                    "inter_op_threads": inter_op_threads, "pipeline_threads": pipeline_threads,
+                    "clustering_threads": threads}
+
+    if report:
+        print("CPU profile: %d CPUs%s | model %d threads (%d inter-op) | input pipeline %d threads | "
+              "clustering %d threads" % (threads, "" if numa_node is None else " (NUMA node %d)" % numa_node,
+                                         model_threads, inter_op_threads, pipeline_threads, threads))
+
+    return _CPU_PROFILE
+
+
+def cpu_profile():
+    """Execution profile of the current process (None if set_cpu_profile was not called)."""
+    return _CPU_PROFILE
+
+
+def pipeline_options():
+    """
+    Options of the tf.data pipelines, so their workers run in a private pool with the threads of the
+    input pipeline stage (None if no execution profile was set).
+    """
+    if _CPU_PROFILE is None:
+        return None
+    options = tf.data.Options()
+    options.threading.private_threadpool_size = _CPU_PROFILE["pipeline_threads"]
+    options.threading.max_intra_op_parallelism = 1
+    return options
+
+
+def clustering_threadpool(default_threads=None, default_user_api=None):
+    """
+    Context manager limiting the sklearn / BLAS thread pools while clustering to the threads of the
+    clustering stage. If no execution profile was set, the pools of default_user_api (all of them if None)
+    are limited to default_threads (None does not limit them).
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return nullcontext()
+    if _CPU_PROFILE is None:
+        return threadpool_limits(limits=default_threads, user_api=default_user_api)
+    return threadpool_limits(limits=_CPU_PROFILE["clustering_threads"])
@@ -0,0 +1,157 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import os
+import json
+import socket
+import tempfile
+import subprocess
+
+import tensorflow as tf
+
+
+def set_worker_config(workers, worker_index):
+    """
+    Describe the cluster of a multi-worker run to TensorFlow (TF_CONFIG environment variable).
+
+    Args:
+    - workers: Comma separated string or list with the "host:port" addresses of all the workers (same order
+      in every worker).
+    - worker_index: Index of this process in the list of workers (worker 0 is the chief).
+    """
+    if isinstance(workers, str):
+        workers = [worker.strip() for worker in workers.split(",") if worker.strip()]
+    if not 0 <= worker_index < len(workers):
+        raise ValueError("Worker index must be between 0 and %d" % (len(workers) - 1))
+    os.environ["TF_CONFIG"] = json.dumps({"cluster": {"worker": list(workers)},
+                                          "task": {"type": "worker", "index": int(worker_index)}})
+
+
+def is_multi_worker():
+    """Whether the process is part of a cluster with more than one worker (TF_CONFIG)."""
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    return len(tf_config.get("cluster", {}).get("worker", [])) > 1
+
+
+def create_strategy(useMirrorStrategy=False, multiWorker=False):
+    """
+    Distribution strategy of a training run. It must be created before any other TensorFlow operation
+    (multi-worker collectives are configured when the strategy is created).
+
+    - multiWorker: Data parallel training across the processes described in TF_CONFIG (local or remote,
+      CPUs or GPUs). Gradients are all-reduced with ring collectives over gRPC, which also work for CPU
+      workers.
+    - useMirrorStrategy: Data parallel training across the GPUs of this process.
+    - Default strategy otherwise.
+    """
+    if multiWorker:
+        options = tf.distribute.experimental.CommunicationOptions(
+            implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+        strategy = tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+        print("Multi-worker training: worker %d of %d" % (strategy.cluster_resolver.task_id,
+                                                           len(strategy.cluster_resolver.cluster_spec().as_dict()
+                                                               ["worker"])))
+    elif useMirrorStrategy:
+        strategy = tf.distribute.MirroredStrategy()
+        strategy.run = tf.function()(strategy.run)
+    else:
+        strategy = tf.distribute.get_strategy()  # Default strategy
+    return strategy
+
+
+def is_chief(strategy):
+    """Whether this process writes the outputs of the run (always true for single process strategies)."""
+    cluster_resolver = getattr(strategy, "cluster_resolver", None)
+    if cluster_resolver is None or cluster_resolver.task_type is None:
+        return True
+    return cluster_resolver.task_type == "chief" or \
+        (cluster_resolver.task_type == "worker" and cluster_resolver.task_id == 0)
+
+
+def worker_output_path(outPath, strategy):
+    """
+    Folder where a worker writes its checkpoints, logs and weights. The chief writes to outPath, the other
+    workers to a scratch folder (they hold the same weights, so their outputs are discarded).
+    """
+    if is_chief(strategy):
+        return outPath
+    return tempfile.mkdtemp(prefix="worker_%d_" % strategy.cluster_resolver.task_id)
+
+
+def local_workers(num_workers):
+    """Addresses of num_workers workers in this host (free ports)."""
+    sockets = []
+    for _ in range(num_workers):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("localhost", 0))
+        sockets.append(sock)
+    workers = ["localhost:%d" % sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return workers
+
+
+def split_cpus(num_workers, cpus_per_worker=None):
+    """
+    Disjoint sets of CPUs for the workers running in this host (all the available CPUs are split evenly if
+    cpus_per_worker is None).
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    if cpus_per_worker is None:
+        cpus_per_worker = max(1, len(cpus) // num_workers)
+    if cpus_per_worker * num_workers > len(cpus):
+        raise ValueError("Not enough CPUs for %d workers with %d CPUs each" % (num_workers, cpus_per_worker))
+    return [cpus[idx * cpus_per_worker:(idx + 1) * cpus_per_worker] for idx in range(num_workers)]
+
+
+def launch_workers(command, num_workers, cpus_per_worker=None):
+    """
+    Run a multi-worker job in this host: the command is started once per worker, with its own TF_CONFIG
+    and bound to its own set of CPUs.
+
+    Args:
+    - command: List with the command line of a worker (e.g. a train script and its arguments).
+    - num_workers: Number of worker processes.
+    - cpus_per_worker: CPUs of every worker (the available CPUs are split evenly if None).
+
+    Returns:
+    - List with the exit codes of the workers.
+    """
+    workers = local_workers(num_workers)
+    worker_cpus = split_cpus(num_workers, cpus_per_worker)
+
+    processes = []
+    for worker_index, cpus in enumerate(worker_cpus):
+        env = dict(os.environ)
+        env["TF_CONFIG"] = json.dumps({"cluster": {"worker": workers},
+                                       "task": {"type": "worker", "index": worker_index}})
+        preexec_fn = (lambda cpus=cpus: os.sched_setaffinity(0, cpus)) if hasattr(os, "sched_setaffinity") \
+            else None
+        processes.append(subprocess.Popen(command, env=env, preexec_fn=preexec_fn))
+
+    return [process.wait() for process in processes]
@@ -0,0 +1,182 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import numpy as np
+
+import tensorflow as tf
+
+from .utils import ifft_pad
+
+
+class FourierSliceProjector:
+    """
+    Projection of volumes based on the Fourier slice theorem.
+
+    The volumes (defined at a set of voxel indices) are padded and Fourier transformed once, and every
+    projection is extracted as a central slice of that transform with trilinear interpolation. Therefore,
+    the cost of projecting scales with the number of image pixels instead of with the number of voxels.
+    The projections are returned in the same (shifted) layout used by fft_pad, so they can be directly
+    multiplied by the CTFs returned by computeCTF.
+
+    Parameters:
+    xsize (int): Box size of the volumes and images.
+    indices (ndarray): Voxel indices (Z, Y, X) of shape (N, 3) where the volume values are defined.
+    pad_factor (int): Padding factor of the Fourier transforms (should match the one of the CTFs).
+    sigma (float): Standard deviation (pixels) of the Gaussian filter applied to the projections (0 disables it).
+    """
+
+    def __init__(self, xsize, indices, pad_factor=2, sigma=0.0):
+        self.xsize = int(xsize)
+        self.pad_factor = pad_factor
+        self.pad_size = int(pad_factor * xsize)
+        self.sigma = sigma
+        self.indices = tf.constant(np.asarray(indices, dtype=np.int32), dtype=tf.int32)
+
+        # Centered padding of the volume box
+        self.pad_left = self.pad_size // 2 - self.xsize // 2
+        self.pad_right = self.pad_size - self.xsize - self.pad_left
+
+        # Frequencies of the padded images (rfft2d layout, in pixels)
+        k_y, k_x = np.meshgrid(np.fft.fftfreq(self.pad_size) * self.pad_size,
+                               np.fft.rfftfreq(self.pad_size) * self.pad_size, indexing="ij")
+        self.freq_shape = k_x.shape
+        k_2d = np.stack([k_x, k_y, np.zeros_like(k_x)], axis=-1).reshape(-1, 3)
+        self.k_2d = tf.constant(k_2d, dtype=tf.float32)
+
+        # Frequency filter (Nyquist sphere, projection origin at the center of the box and Gaussian envelope)
+        freq_mask = np.sqrt(k_x ** 2. + k_y ** 2.) < 0.5 * self.pad_size
+        center_phase = (-1.0) ** (k_x + k_y)
+        envelope = np.exp(-2. * (np.pi * sigma / self.pad_size) ** 2. * (k_x ** 2. + k_y ** 2.))
+        self.freq_filter = tf.constant((freq_mask * center_phase * envelope).reshape(-1), dtype=tf.float32)
+
+        # Trilinear interpolation corners (Z, Y, X)
+        self.corners = tf.constant([[dz, dy, dx] for dz in (0, 1) for dy in (0, 1) for dx in (0, 1)],
+                                   dtype=tf.float32)
+
+    def volumeFourier(self, values):
+        """
+        Padded and centered 3D Fourier transform of a batch of volumes.
+
+        Parameters:
+        values (Tensor): Volume values at the voxel indices, of shape (V, N).
+
+        Returns:
+        Tensor: Flattened Fourier transforms of shape (V, P * P * P), with the zero frequency at the center.
+        """
+        num_vols = values.shape[0] if values.shape[0] is not None else tf.shape(values)[0]
+        num_voxels = tf.shape(self.indices)[0]
+
+        # Place values in the volume grids (single scatter for the whole batch)
+        vol_idx = tf.tile(tf.range(num_vols)[:, None, None], (1, num_voxels, 1))
+        scatter_idx = tf.concat([vol_idx, tf.tile(self.indices[None, ...], (num_vols, 1, 1))], axis=-1)
+        volumes = tf.scatter_nd(scatter_idx, tf.cast(values, tf.float32),
+                                tf.stack([num_vols, self.xsize, self.xsize, self.xsize]))
+
+        # Pad and move the origin to the first voxel
+        paddings = [[0, 0]] + 3 * [[self.pad_left, self.pad_right]]
+        volumes = tf.signal.ifftshift(tf.pad(volumes, paddings), axes=[1, 2, 3])
+
+        # Fourier transform (zero frequency at the center)
+        ft_volumes = tf.signal.fft3d(tf.cast(volumes, tf.complex64))
+        ft_volumes = tf.signal.fftshift(ft_volumes, axes=[1, 2, 3])
+
+        return tf.reshape(ft_volumes, [num_vols, -1])
+
+    def interpolationWeights(self, r):
+        """
+        Interpolation indices and weights of the central slices defined by a batch of rotations. They only
+        depend on the orientations, so they can be reused to project several volumes in the same poses.
+
+        Parameters:
+        r (Tensor): Rotation matrices of shape (B, 3, 3) (rotated coordinates are r @ coords).
+
+        Returns:
+        tuple: Flat indices of shape (B, M, 8) and trilinear weights of shape (B, M, 8).
+        """
+        P = self.pad_size
+
+        # Slice coordinates in the volume Fourier space (array order Z, Y, X)
+        k_3d = tf.matmul(self.k_2d[None, ...], tf.cast(r, tf.float32))
+        pos = tf.reverse(k_3d, axis=[-1]) + float(P // 2)
+        pos = tf.clip_by_value(pos, 0.0, float(P - 1))
+
+        # Corners and fractional parts
+        pos_0 = tf.floor(pos)
+        frac = pos - pos_0
+        corners = pos_0[..., None, :] + self.corners  # (B, M, 8, 3)
+        corners = tf.cast(tf.clip_by_value(corners, 0.0, float(P - 1)), tf.int32)
+        indices = corners[..., 0] * P * P + corners[..., 1] * P + corners[..., 2]
+
+        # Trilinear weights
+        frac = frac[..., None, :]
+        weights = tf.reduce_prod(self.corners * frac + (1.0 - self.corners) * (1.0 - frac), axis=-1)
+        weights = weights * self.freq_filter[None, :, None]
+
+        return indices, weights
+
+    def project(self, ft_volumes, interpolation, shifts=None, ctf=None):
+        """
+        Extract the projections from the Fourier transform of the volumes.
+
+        Parameters:
+        ft_volumes (Tensor): Output of volumeFourier. One volume (shared by all the projections) or one
+                             volume per projection.
+        interpolation (tuple): Output of interpolationWeights.
+        shifts (Tensor): In plane shifts (X, Y) of shape (B, 2) (optional).
+        ctf (Tensor): CTFs in the layout returned by computeCTF, of shape (B, P, P // 2 + 1) (optional).
+
+        Returns:
+        Tensor: Projections of shape (B, xsize, xsize, 1).
+        """
+        indices, weights = interpolation
+        batch_size_scope = tf.shape(indices)[0]
+
+        # Trilinear interpolation of the central slices
+        if ft_volumes.shape[0] == 1:
+            ft_values = tf.gather(ft_volumes[0], indices)
+        else:
+            ft_values = tf.gather(ft_volumes, indices, batch_dims=1)
+        ft_images = tf.reduce_sum(ft_values * tf.cast(weights, tf.complex64), axis=-1)
+
+        # Apply shifts as phase ramps
+        if shifts is not None:
+            phase = (2. * np.pi / self.pad_size) * tf.matmul(tf.cast(shifts, tf.float32), self.k_2d[:, :2],
+                                                             transpose_b=True)
+            ft_images = ft_images * tf.complex(tf.cos(phase), tf.sin(phase))
+
+        # Same layout as fft_pad
+        ft_images = tf.reshape(ft_images, [batch_size_scope, self.freq_shape[0], self.freq_shape[1]])
+        ft_images = tf.signal.fftshift(ft_images)
+
+        # CTF corruption
+        if ctf is not None:
+            ctf = tf.cast(ctf, tf.float32)
+            ft_images = tf.complex(tf.math.real(ft_images) * ctf, tf.math.imag(ft_images) * ctf)
+
+        images = ifft_pad(ft_images, self.xsize, self.xsize)
+        return tf.reshape(images, [batch_size_scope, self.xsize, self.xsize, 1])
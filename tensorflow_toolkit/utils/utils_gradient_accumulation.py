@@ -0,0 +1,116 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import tensorflow as tf
+
+
+def split_micro_batches(data, accum_steps):
+    """
+    Split a batch into interleaved micro batches (sizes differ at most by one element).
+
+    Args:
+    - data: Batch (nested structure of tensors with the batch in the first axis, e.g. (images, indexes)).
+    - accum_steps: Number of micro batches.
+
+    Returns:
+    - A list with the indices of every micro batch in the batch and the batch size.
+    """
+    batch_size = tf.shape(tf.nest.flatten(data)[0])[0]
+    return [tf.range(idx, batch_size, accum_steps) for idx in range(accum_steps)], batch_size
+
+
+def batch_summed(*losses):
+    """Whether the gradients of the losses are summed over the batch (losses with a batch dimension)."""
+    return any(tf.convert_to_tensor(loss).shape.rank > 0 for loss in losses)
+
+
+def average_replica_gradients(grads, summed=False):
+    """
+    Scale the gradients of a replica, so the sum all-reduced by the optimizer across replicas (e.g. the
+    workers of a multi-worker run) is the gradient of the global batch: averaged losses are divided by the
+    number of replicas, summed losses are left as they are.
+    """
+    replica_context = tf.distribute.get_replica_context()
+    num_replicas = 1 if replica_context is None else replica_context.num_replicas_in_sync
+    if num_replicas == 1 or summed:
+        return grads
+    return [[None if grad is None else tf.convert_to_tensor(grad) / tf.cast(num_replicas, grad.dtype)
+             for grad in group] for group in grads]
+
+
+def accumulate_gradients(step_fn, data, accum_steps=1):
+    """
+    Compute the gradients of a batch as the accumulation of the gradients of several micro batches, so the
+    memory needed by the forward and backward passes is the one of a single micro batch.
+
+    Micro batches are run one after the other and their gradients are accumulated in float32 (also for
+    mixed precision). The gradients are applied once per batch by the caller, so the optimizer and the
+    distribution strategy only see a regular train step.
+
+    Args:
+    - step_fn: Function computing the gradients of a (micro) batch. It must return a list with the gradients
+      of every group of variables, a dictionary with the losses to report and whether the differentiated loss
+      is summed over the batch (see batch_summed) or averaged.
+    - data: Batch received by train_step.
+    - accum_steps: Number of micro batches (1 computes the gradients of the whole batch at once).
+
+    Returns:
+    - The list with the gradients of every group of variables (see average_replica_gradients) and the
+      dictionary with the (averaged) losses.
+    """
+    if accum_steps <= 1:
+        grads, losses, summed = step_fn(data)
+        return average_replica_gradients(grads, summed), losses
+
+    micro_indices, batch_size = split_micro_batches(data, accum_steps)
+    acc_grads, acc_losses = None, None
+    for indices in micro_indices:
+        # Next micro batch starts when the previous gradients are ready (only one set of activations alive)
+        dependencies = [grad for grad in tf.nest.flatten(acc_grads) if grad is not None] if acc_grads else []
+        with tf.control_dependencies(dependencies):
+            micro_data = tf.nest.map_structure(lambda x: tf.gather(x, indices, axis=0), data)
+
+        grads, losses, summed = step_fn(micro_data)
+
+        # Empty micro batches (batch smaller than accum_steps) have zero weight
+        weight = tf.cast(tf.size(indices), tf.float32) / tf.cast(batch_size, tf.float32)
+        grad_weight = tf.constant(1.0, tf.float32) if summed else weight
+        grads = [[None if grad is None else
+                  tf.math.multiply_no_nan(tf.cast(tf.convert_to_tensor(grad), tf.float32), grad_weight)
+                  for grad in group] for group in grads]
+        losses = {key: tf.math.multiply_no_nan(tf.reduce_mean(tf.cast(value, tf.float32)), weight)
+                  for key, value in losses.items()}
+
+        if acc_grads is None:
+            acc_grads, acc_losses = grads, losses
+        else:
+            acc_grads = [[acc if grad is None else acc + grad for acc, grad in zip(acc_group, group)]
+                         for acc_group, group in zip(acc_grads, grads)]
+            acc_losses = {key: acc_losses[key] + losses[key] for key in losses}
+
+    return average_replica_gradients(acc_grads, summed), acc_losses
@@ -0,0 +1,153 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import tensorflow as tf
+from xmipp_metadata.metadata import XmippMetaData
+
+
+# Metadata labels the CTF corrected particles depend on
+_PARTICLE_CACHE_LABELS = ["ctfDefocusU", "ctfDefocusV", "ctfDefocusAngle", "ctfSphericalAberration", "ctfVoltage"]
+
+
+def particle_cache_key(md_file, xsize, sr, pad_factor, applyCTF):
+    """
+    Key identifying the Wiener filtered particles of a metadata file (particle images, CTF parameters and
+    filter parameters).
+
+    Args:
+    - md_file: Path to the metadata file.
+    - xsize: Box size of the particles.
+    - sr: Sampling rate of the particles.
+    - pad_factor: Padding factor used to compute the CTF.
+    - applyCTF: Whether the CTF is applied (1) or not (0).
+
+    Returns:
+    - A short string used as name of the cache folder.
+    """
+    metadata = XmippMetaData(file_name=str(md_file))
+    key = hashlib.sha1()
+
+    # Particle images (stack paths and modification times)
+    images = np.asarray(metadata[:, "image"]).astype(str)
+    key.update(images.tobytes())
+    for stack in sorted(set(image.split("@")[-1] for image in images)):
+        if os.path.isfile(stack):
+            key.update(("%s:%f" % (stack, os.path.getmtime(stack))).encode())
+
+    # CTF parameters
+    for label in _PARTICLE_CACHE_LABELS:
+        key.update(np.asarray(metadata[:, label], dtype=np.float64).tobytes())
+
+    # Filter parameters
+    params = {"filter": "wiener", "xsize": int(xsize), "sr": float(sr), "pad_factor": int(pad_factor),
+              "applyCTF": int(applyCTF)}
+    key.update(json.dumps(params, sort_keys=True).encode())
+
+    return "wiener_" + key.hexdigest()[:16]
+
+
+def open_particle_cache(generator, cache_dir, batch_size=256, poll_interval=5.):
+    """
+    Open the memory mapped cache of Wiener filtered particles of a generator, computing it if it does not
+    exist yet.
+
+    The cache holds every particle in the metadata (so training and validation generators share it) and is
+    keyed by particle_cache_key, so any change in the particles, CTF or filter parameters leads to a new
+    cache instead of stale images. When several processes share the same cache folder, only the one holding
+    the lock file computes the cache while the rest wait for it to be complete.
+
+    Args:
+    - generator: Data generator providing the metadata, batchCTF and wiener2DFilter.
+    - cache_dir: Folder where the caches are stored.
+    - batch_size: Number of particles filtered at once when the cache is computed.
+    - poll_interval: Seconds between checks while waiting for another process to compute the cache.
+
+    Returns:
+    - Dictionary with the cache folder and the memory mapped particles ("images", with shape (N, X, X)).
+    """
+    xsize, pad_factor = generator.xsize, generator.pad_factor
+    sr = float(generator.sr.numpy()) if tf.is_tensor(generator.sr) else float(generator.sr)
+    key = particle_cache_key(generator.filename, xsize, sr, pad_factor, generator.applyCTF)
+    path = os.path.join(cache_dir, key)
+    images_file = os.path.join(path, "particles.npy")
+    info_file = os.path.join(path, "info.json")
+    lock_file = os.path.join(path, "cache.lock")
+
+    # Info file is written last, so its presence means the cache is complete
+    os.makedirs(path, exist_ok=True)
+    while not os.path.isfile(info_file):
+        try:
+            lock = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another process is computing the cache
+            print("Waiting for the Wiener filtered particles cache in %s (remove %s if no process is computing "
+                  "it)" % (path, lock_file))
+            time.sleep(poll_interval)
+            continue
+
+        try:
+            os.write(lock, str(os.getpid()).encode())
+            if not os.path.isfile(info_file):
+                _compute_particle_cache(generator, path, images_file, info_file, sr, batch_size)
+        finally:
+            os.close(lock)
+            os.remove(lock_file)
+
+    return {"path": path, "images": np.load(images_file, mmap_mode="r")}
+
+
+def _compute_particle_cache(generator, path, images_file, info_file, sr, batch_size):
+    metadata = XmippMetaData(file_name=str(generator.filename))
+    n_particles = len(metadata)
+    xsize = generator.xsize
+
+    # Temporary file unique to this process (renamed once complete)
+    tmp_file = "%s.%d.tmp" % (images_file, os.getpid())
+    images_cache = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float32,
+                                             shape=(n_particles, xsize, xsize))
+
+    print("Computing Wiener filtered particles cache in %s" % path)
+    for start in range(0, n_particles, batch_size):
+        indexes = np.arange(start, min(start + batch_size, n_particles))
+        images = tf.constant(metadata.getMetaDataImage(indexes)[..., None], dtype=tf.float32)
+        ctf = generator.batchCTF(tf.constant(indexes, dtype=tf.int32))
+        w_images = tf.cast(generator.wiener2DFilter(images, ctf), tf.float32)
+        images_cache[indexes] = w_images.numpy()[..., 0]
+
+    images_cache.flush()
+    del images_cache
+    os.replace(tmp_file, images_file)
+
+    with open(info_file, "w") as fid:
+        json.dump({"md_file": str(generator.filename), "n_particles": n_particles, "xsize": int(xsize),
+                   "sr": sr, "pad_factor": int(generator.pad_factor), "applyCTF": int(generator.applyCTF)},
+                  fid, indent=2)
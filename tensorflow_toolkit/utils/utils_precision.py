@@ -0,0 +1,67 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import os
+
+import tensorflow as tf
+from tensorflow.keras import mixed_precision
+
+
+# Precision policies supported by the train scripts
+PRECISION_POLICIES = ["float32", "mixed_float16", "mixed_bfloat16"]
+
+
+def set_precision_policy(precision):
+    """
+    Set the global Keras precision policy used to build the networks.
+
+    - float32: everything in float32.
+    - mixed_float16: network layers and physical decoders (projection, CTF...) in float16 (GPU).
+    - mixed_bfloat16: network layers compute in bfloat16 with float32 variables (CPUs with AVX512-BF16 / AMX
+      support), while coordinates, projections, CTF and losses are kept in float32, as bfloat16 does not have
+      enough mantissa for them.
+
+    Args:
+    - precision: One of PRECISION_POLICIES.
+
+    Returns:
+    - Tuple (precision, precision_scaled) with the dtypes to be used by the generators and physical decoders.
+    """
+    if precision not in PRECISION_POLICIES:
+        raise ValueError("Precision must be one of: " + ", ".join(PRECISION_POLICIES))
+    mixed_precision.set_global_policy(precision)
+
+    if precision == "mixed_float16":
+        precision = tf.float16
+        precision_scaled = tf.float32 if os.environ.get("TF_USE_LEGACY_KERAS") == "1" else precision
+    else:
+        # Physics stays in float32 also for bfloat16 networks
+        precision = tf.float32
+        precision_scaled = tf.float32
+
+    return precision, precision_scaled
@@ -0,0 +1,84 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import tensorflow as tf
+
+
+def parse_remat_blocks(remat, blocks):
+    """
+    Blocks of a network whose activations are rematerialized (recomputed in the backward pass).
+
+    Args:
+    - remat: Comma separated string or list with the names of the blocks (None or "" disables it).
+    - blocks: Names of the blocks supported by the network.
+
+    Returns:
+    - A set with the names of the blocks to rematerialize.
+    """
+    if not remat:
+        return set()
+    if isinstance(remat, str):
+        remat = [block.strip() for block in remat.split(",") if block.strip()]
+    remat = set(remat)
+    if not remat.issubset(blocks):
+        raise ValueError("Rematerialization blocks must be some of: " + ", ".join(blocks))
+    return remat
+
+
+def rematerialize(fn, enabled=True):
+    """
+    Wrap a function so its intermediate activations are not stored for the backward pass, but recomputed
+    from its inputs when the gradients are needed (tf.recompute_grad). This trades one extra forward pass of
+    the block for the memory of its activations.
+
+    The wrapped function may receive and return (nested lists of) tensors. Variables used inside the
+    function (e.g. the weights of a built Keras layer) receive their gradients as usual.
+
+    Args:
+    - fn: Function to wrap.
+    - enabled: Whether to wrap the function (fn is returned unchanged otherwise).
+
+    Returns:
+    - The rematerialized function.
+    """
+    if not enabled:
+        return fn
+
+    def remat_fn(*args):
+        structure = {}
+
+        @tf.recompute_grad
+        def flat_fn(*flat_args):
+            outputs = fn(*tf.nest.pack_sequence_as(args, list(flat_args)))
+            structure["outputs"] = outputs
+            return [tf.convert_to_tensor(output) for output in tf.nest.flatten(outputs)]
+
+        flat_outputs = flat_fn(*[tf.convert_to_tensor(arg) for arg in tf.nest.flatten(args)])
+        return tf.nest.pack_sequence_as(structure["outputs"], flat_outputs)
+
+    return remat_fn
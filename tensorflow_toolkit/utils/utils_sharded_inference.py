@@ -0,0 +1,109 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+
+import os
+import time
+import tempfile
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf
+
+from .utils_cpu_profile import set_cpu_profile
+from .utils_distributed import split_cpus
+
+
+def shard_indices(indices, shard_index, num_shards):
+    """Contiguous shard of a range of particle indices (shards differ at most by one particle)."""
+    return np.array_split(np.asarray(indices), num_shards)[shard_index]
+
+
+def run_shard(fn, shard_index, num_shards, cpus, partial_file, kwargs):
+    """Inference worker: process a shard bound to its own CPUs and save its outputs to partial_file."""
+    if cpus is not None:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        set_cpu_profile(report=False)
+    for gpu_instance in tf.config.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu_instance, True)
+    outputs = fn(shard=(shard_index, num_shards), **kwargs)
+    np.savez(partial_file, **outputs)
+
+
+def merge_shards(partial_files):
+    """Concatenate the outputs of the shards (in shard order, so particles keep the order of the metadata)."""
+    shards = [np.load(partial_file) for partial_file in partial_files]
+    merged = {key: np.concatenate([shard[key] for shard in shards], axis=0) for key in shards[0].files}
+    for shard in shards:
+        shard.close()
+    return merged
+
+
+def predict_sharded(fn, num_workers=1, cpus_per_worker=None, shard_dir=None, **kwargs):
+    """
+    Run inference over the particles split in num_workers contiguous shards, each one processed by its own
+    process (that loads the network weights once). Partial outputs are written to disk by every worker and
+    merged in shard order, so the result does not depend on the number of workers.
+
+    Args:
+    - fn: Module level function computing the outputs of the particles of a shard. It receives kwargs and
+      shard=(shard_index, num_shards) (None for all the particles), and returns a dictionary of arrays with
+      the particles in the first axis.
+    - num_workers: Number of worker processes (1 runs fn in this process).
+    - cpus_per_worker: CPUs of every worker (the available CPUs are split evenly if None).
+    - shard_dir: Folder for the partial outputs (system temporary folder if None).
+
+    Returns:
+    - Dictionary with the merged outputs.
+    """
+    if num_workers <= 1:
+        return fn(shard=None, **kwargs)
+
+    start = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(dir=shard_dir) as tmp_dir:
+        partial_files = [os.path.join(tmp_dir, "shard_%03d.npz" % shard_index) for shard_index in range(num_workers)]
+        processes = [context.Process(target=run_shard,
+                                     args=(fn, shard_index, num_workers, cpus, partial_files[shard_index], kwargs))
+                     for shard_index, cpus in enumerate(split_cpus(num_workers, cpus_per_worker))]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        for shard_index, process in enumerate(processes):
+            if process.exitcode != 0:
+                raise RuntimeError("Inference worker %d failed (exit code %d)" % (shard_index, process.exitcode))
+
+        merged = merge_shards(partial_files)
+
+    num_particles = len(next(iter(merged.values())))
+    elapsed = time.perf_counter() - start
+    print("Sharded inference: %d particles in %.1f s with %d workers (%.1f particles/s)"
+          % (num_particles, elapsed, num_workers, num_particles / elapsed))
+    return merged
@@ -0,0 +1,157 @@
+# **************************************************************************
+# *
+# * Authors:  David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import glob
+import json
+import atexit
+import hashlib
+
+
+# Arguments that do not change the compiled executables (paths, run length, logging...)
+_XLA_CACHE_IGNORED_ARGS = ["md_file", "out_path", "outPath", "weigths_file", "het_file", "gpu", "epochs",
+                           "max_samples_seen", "tensorboard", "lr", "xla_cache_dir", "xla_cache",
+                           "wiener_cache", "cpu_threads", "numa_node", "pipeline_share", "workers",
+                           "worker_index", "num_workers", "cpus_per_worker"]
+
+
+def xla_cache_key(network, flags, xsize=None):
+    """
+    Key identifying the compiled executables of a run (network type, box size, batch size and flags).
+
+    Args:
+    - network: Name of the network (e.g. "flexsiren").
+    - flags: Dictionary with the parameters of the run (e.g. vars(args)). Paths and other parameters that
+      do not change the compiled code are ignored.
+    - xsize: Box size of the particles (if known).
+
+    Returns:
+    - A short string used as file prefix of the cache entries.
+    """
+    flags = {key: value for key, value in flags.items() if key not in _XLA_CACHE_IGNORED_ARGS}
+    if xsize is not None:
+        flags["xsize"] = int(xsize)
+
+    key = json.dumps(flags, sort_keys=True, default=str)
+    return network + "_" + hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def metadata_box_size(md_file):
+    """Box size of the particles in a metadata file (None if it cannot be read)."""
+    try:
+        from xmipp_metadata.metadata import XmippMetaData
+        return XmippMetaData(file_name=str(md_file)).getMetaDataImage(0).shape[1]
+    except Exception:
+        return None
+
+
+def xla_cache_supported():
+    """Whether the installed TensorFlow knows the persistent XLA cache flags (TensorFlow >= 2.13)."""
+    import tensorflow as tf
+    try:
+        major, minor = (int(v) for v in tf.__version__.split(".")[:2])
+    except ValueError:
+        return False
+    return (major, minor) >= (2, 13)
+
+
+def enable_xla_cache(network, flags, cache_dir=None, report=True):
+    """
+    Enable the persistent on disk cache of XLA executables for the current process.
+
+    The cache is configured through TF_XLA_FLAGS, so it must be called before the first XLA compilation.
+    Older TensorFlow versions (< 2.13) abort when they find these flags, so the cache is not enabled for them.
+    Entries are stored with a prefix derived from xla_cache_key, so repeated runs with the same network,
+    box size, batch size and flags (e.g. the jobs of a parameter sweep or several predictions with
+    the same model) load the executables instead of compiling them again.
+
+    Args:
+    - network: Name of the network (e.g. "flexsiren").
+    - flags: Dictionary with the parameters of the run (e.g. vars(args)).
+    - cache_dir: Cache folder. Defaults to $TENSORFLOW_TOOLKIT_XLA_CACHE or ~/.cache/tensorflow_toolkit/xla.
+    - report: Print the number of executables reused from and written to the cache when the process ends.
+
+    Returns:
+    - Dictionary with the cache folder, the entry prefix and the entries found before the run (None if the
+      cache is not supported by the installed TensorFlow).
+    """
+    if not xla_cache_supported():
+        print("Persistent XLA compilation cache requires TensorFlow >= 2.13 (disabled)")
+        return None
+
+    if cache_dir is None:
+        cache_dir = os.environ.get("TENSORFLOW_TOOLKIT_XLA_CACHE",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "tensorflow_toolkit", "xla"))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    xsize = metadata_box_size(flags["md_file"]) if flags.get("md_file") is not None else None
+    prefix = xla_cache_key(network, flags, xsize=xsize)
+
+    xla_flags = os.environ.get("TF_XLA_FLAGS", "")
+    xla_flags += " --tf_xla_persistent_cache_directory=%s --tf_xla_persistent_cache_prefix=%s" % (cache_dir, prefix)
+    os.environ["TF_XLA_FLAGS"] = xla_flags.strip()
+
+    # Access times of the entries found before the run (moved before their modification time, so the
+    # kernel also updates them on the next read with relatime mounts)
+    entries = {}
+    for entry in glob.glob(os.path.join(cache_dir, prefix + "*")):
+        try:
+            stat = os.stat(entry)
+            os.utime(entry, (stat.st_mtime - 1., stat.st_mtime))
+            entries[entry] = os.stat(entry).st_atime
+        except OSError:
+            pass
+
+    cache = {"cache_dir": cache_dir, "prefix": prefix, "entries": entries}
+
+    if report:
+        atexit.register(report_xla_cache, cache)
+
+    return cache
+
+
+def report_xla_cache(cache):
+    """
+    Report the executables reused from the cache (entries found before the run that were read during it)
+    and the executables compiled and written to the cache during the run. Reads are detected from the access
+    time of the entries, so reused executables are not counted on file systems mounted with noatime.
+
+    Returns:
+    - Tuple (reused, compiled).
+    """
+    reused, compiled = 0, 0
+    for entry in glob.glob(os.path.join(cache["cache_dir"], cache["prefix"] + "*")):
+        if entry not in cache["entries"]:
+            compiled += 1
+            continue
+        try:
+            if os.stat(entry).st_atime > cache["entries"][entry]:
+                reused += 1
+        except OSError:
+            pass
+    print("XLA compilation cache (%s): %d reused / %d compiled" % (cache["prefix"], reused, compiled))
+    return reused, compiled